@@ -0,0 +1,198 @@
+"""Benchmark and regression-check the LDAP class against a local slapd.
+
+For each data size a throwaway server is started (see
+:py:mod:`slapd_fixture`) and the following are measured:
+
+* ``search``: ``search()`` of one person by uid in the people tree,
+* ``sunetid_info``: ``sunetid_info()`` of one person (both trees),
+* ``process_result``: decoding raw people-tree entries (no server round trips),
+* ``bulk_scan``: ``search_iter()`` over the whole people tree (paged), and
+* ``bulk_scan_compact``: ``search_compact()`` over the whole people tree.
+
+Lookups report latency percentiles; scans and decoding report entries
+per second. Before measuring, a few results are checked against the
+generated data, so a behaviour change shows up as a failed check (and a
+non-zero exit status) rather than as a fast benchmark.
+
+The results are written as JSON (to compare releases)::
+
+  PYTHONPATH=.:benchmarks python3 benchmarks/bench_ldap.py --sizes 1000,10000,100000 \\
+      --output bench-0.4.0.json
+
+Needs the OpenLDAP server programs (``slapd``, ``slapadd``).
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import random
+import sys
+import time
+from importlib import metadata
+
+import ldap  # type: ignore
+
+from stanford.green.ldap import BASEDN_PEOPLE, GreenLDAPNoResultsException
+from slapd_fixture import SlapdFixture, SimpleBindLDAP
+
+## TYPING
+from typing import Any, Callable
+## END OF TYPING
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """Return the ``fraction`` (0 to 1) percentile of ``sorted_values``."""
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def latency_result(name: str, size: int, latencies: list[float]) -> dict[str, Any]:
+    latencies = sorted(latencies)
+    total     = sum(latencies)
+    return {
+        'benchmark':  name,
+        'size':       size,
+        'operations': len(latencies),
+        'seconds':    total,
+        'per_second': len(latencies) / total,
+        'p50_ms':     percentile(latencies, 0.50) * 1000,
+        'p90_ms':     percentile(latencies, 0.90) * 1000,
+        'p99_ms':     percentile(latencies, 0.99) * 1000,
+        'max_ms':     latencies[-1] * 1000,
+    }
+
+def throughput_result(name: str, size: int, entries: int, seconds: float) -> dict[str, Any]:
+    return {
+        'benchmark':  name,
+        'size':       size,
+        'entries':    entries,
+        'seconds':    seconds,
+        'per_second': entries / seconds,
+    }
+
+def time_each(operation: Callable[[Any], Any], arguments: list[Any]) -> list[float]:
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        operation(argument)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+def check(ldap1: SimpleBindLDAP, size: int) -> list[str]:
+    """Return a list of failed checks against the generated data."""
+    failures = []
+
+    sunetid = SlapdFixture.sunetid(size // 2)
+    results = ldap1.sunetid_info(sunetid)
+    if (len(results) != 2):
+        failures.append(f"sunetid_info({sunetid}) returned {len(results)} entries, not 2")
+    for (dn, attribute_values) in results.items():
+        uid: Any = attribute_values.get('uid')
+        if (isinstance(uid, list)):
+            uid = uid[0] if uid else None
+        if (uid != sunetid):
+            failures.append(f"{dn} has uid {uid!r}, not {sunetid!r}")
+
+    account = ldap1.sunetid_account_info(sunetid)
+    (attribute_values,) = account.values()
+    if (not isinstance(attribute_values.get('suPrivilegeGroup'), list)):
+        failures.append("suPrivilegeGroup is not decoded as multi-valued")
+
+    try:
+        ldap1.sunetid_info('nosuchuser')
+        failures.append("sunetid_info('nosuchuser') did not raise GreenLDAPNoResultsException")
+    except GreenLDAPNoResultsException:
+        pass
+
+    people = sum(1 for _ in ldap1.search_iter(BASEDN_PEOPLE, filterstr='(objectClass=inetOrgPerson)'))
+    if (people != size):
+        failures.append(f"the people tree has {people} entries, not {size}")
+
+    return failures
+
+def run_size(size: int, lookups: int, repeat: int) -> tuple[list[dict[str, Any]], list[str]]:
+    results: list[dict[str, Any]] = []
+
+    with SlapdFixture(size) as fixture:
+        ldap1 = SimpleBindLDAP(fixture.host, fixture.rootdn, fixture.rootpw)
+
+        failures = check(ldap1, size)
+
+        sunetids = [SlapdFixture.sunetid(random.randrange(size)) for _ in range(lookups)]
+
+        latencies = time_each(lambda sunetid: ldap1.search(BASEDN_PEOPLE, filterstr=f"uid={sunetid}"), sunetids)
+        results.append(latency_result('search', size, latencies))
+
+        latencies = time_each(ldap1.sunetid_info, sunetids)
+        results.append(latency_result('sunetid_info', size, latencies))
+
+        raw_entries = list(ldap1._search_raw(BASEDN_PEOPLE, ldap.SCOPE_SUBTREE, '(objectClass=inetOrgPerson)',
+                                             None, page_size=500))
+        best = min(time_each(lambda _: [ldap1.process_result(entry) for entry in raw_entries], [None] * repeat))
+        results.append(throughput_result('process_result', size, len(raw_entries), best))
+
+        best = min(time_each(lambda _: sum(1 for _ in ldap1.search_iter(BASEDN_PEOPLE)), [None] * repeat))
+        results.append(throughput_result('bulk_scan', size, size, best))
+
+        best = min(time_each(lambda _: ldap1.search_compact(BASEDN_PEOPLE), [None] * repeat))
+        results.append(throughput_result('bulk_scan_compact', size, size, best))
+
+        ldap1.close()
+
+    return (results, failures)
+
+def package_version() -> str:
+    try:
+        return metadata.version('stanford_green')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1000,10000',
+                        help="comma-separated numbers of people to generate (default: 1000,10000)")
+    parser.add_argument('--lookups', type=int, default=1000,
+                        help="number of single-person lookups to time per size (default: 1000)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="repeat scans this many times and keep the best (default: 3)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument('--output', default='bench_ldap.json', help="JSON output file (default: bench_ldap.json)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+
+    report: dict[str, Any] = {
+        'meta': {
+            'stanford_green': package_version(),
+            'python_ldap':    ldap.__version__,
+            'python':         platform.python_version(),
+            'platform':       platform.platform(),
+            'date':           datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'lookups':        args.lookups,
+            'repeat':         args.repeat,
+            'seed':           args.seed,
+        },
+        'results':  [],
+        'failures': [],
+    }
+
+    for size in (int(size) for size in args.sizes.split(',')):
+        (results, failures) = run_size(size, args.lookups, args.repeat)
+        report['results'].extend(results)
+        report['failures'].extend(f"size {size}: {failure}" for failure in failures)
+
+        for result in results:
+            print(f"{size:>9} {result['benchmark']:<18} {result['per_second']:>14,.0f}/s"
+                  + (f"  p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms" if 'p50_ms' in result else ''))
+
+    with open(args.output, 'w', encoding='utf-8') as fh:
+        json.dump(report, fh, indent=2)
+    print(f"wrote {args.output}")
+
+    for failure in report['failures']:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    sys.exit(1 if report['failures'] else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Benchmark the attribute multiplicity predicates.
+
+Classifies the attribute names of a typical people-tree entry with the
+original dict-lookup predicate, with the current
+:py:func:`stanford.green.ldap.attribute_is_single_valued` (a wrapper over
+the frozen :py:data:`stanford.green.ldap.MULTIPLICITY` index), with
+:py:meth:`~stanford.green.ldap.schema.MultiplicityIndex.is_single_valued`
+called directly, and with the bulk
+:py:meth:`~stanford.green.ldap.schema.MultiplicityIndex.classify_all`, and
+prints the time per attribute for each.
+
+Usage::
+
+  PYTHONPATH=. python3 benchmarks/bench_multiplicity.py [number_of_rounds]
+
+No LDAP server is needed.
+"""
+import sys
+import time
+
+from stanford.green.ldap import (
+    ATTRIBUTE_TO_MULTIPLICITY,
+    MULTIPLICITY,
+    GreenUnknownLDAPAttribute,
+    attribute_is_single_valued,
+)
+
+## TYPING
+from typing import Any, Callable
+## END OF TYPING
+
+ATTRIBUTE_NAMES = [
+    'uid', 'suRegID', 'displayName', 'sn', 'givenName', 'cn', 'mail',
+    'suAffiliation', 'suGwAffilCode1', 'suPrivilegeGroup', 'telephoneNumber',
+    'suMailCode', 'suVisibEmail', 'eduPersonAffiliation', 'suDisplayNameLF',
+]
+
+def legacy_attribute_is_single_valued(attribute_name: str) -> bool:
+    """The predicate as it was before the multiplicity index was introduced."""
+    if (attribute_name in ATTRIBUTE_TO_MULTIPLICITY):
+        return (ATTRIBUTE_TO_MULTIPLICITY[attribute_name] == 'single')
+    else:
+        msg = f"'{attribute_name}' is not a recognized attribute"
+        raise GreenUnknownLDAPAttribute(msg)
+
+def per_attribute(predicate: Callable[[str], Any]) -> Callable[[list[str]], Any]:
+    return lambda names: [predicate(name) for name in names]
+
+def nanoseconds_per_attribute(classifier: Callable[[list[str]], Any], rounds: int, repeat: int = 5) -> float:
+    """Return the best-of-``repeat`` time to classify one attribute name."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            classifier(ATTRIBUTE_NAMES)
+        best = min(best, time.perf_counter() - start)
+
+    return best * 1e9 / (rounds * len(ATTRIBUTE_NAMES))
+
+def main() -> None:
+    rounds = int(sys.argv[1]) if (len(sys.argv) > 1) else 100000
+
+    before  = nanoseconds_per_attribute(per_attribute(legacy_attribute_is_single_valued), rounds)
+    wrapper = nanoseconds_per_attribute(per_attribute(attribute_is_single_valued), rounds)
+    index   = nanoseconds_per_attribute(per_attribute(MULTIPLICITY.is_single_valued), rounds)
+    bulk    = nanoseconds_per_attribute(MULTIPLICITY.classify_all, rounds)
+
+    print(f"attributes per round:  {len(ATTRIBUTE_NAMES)}")
+    print(f"rounds:                {rounds}")
+    print(f"before (dict lookup):  {before:8.1f} ns/attribute")
+    print(f"wrapper:               {wrapper:8.1f} ns/attribute  ({before / wrapper:.2f}x)")
+    print(f"index:                 {index:8.1f} ns/attribute  ({before / index:.2f}x)")
+    print(f"bulk (classify_all):   {bulk:8.1f} ns/attribute  ({before / bulk:.2f}x)")
+
+if __name__ == '__main__':
+    main()
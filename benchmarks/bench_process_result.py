@@ -0,0 +1,107 @@
+"""Benchmark LDAP.process_result decoding throughput.
+
+Decodes a batch of synthetic people-tree entries with the original
+attribute-by-attribute decoder and with the current
+:py:meth:`stanford.green.ldap.LDAP.process_result` (memoized decoding
+plan) and prints entries per second for each.
+
+Usage::
+
+  PYTHONPATH=. python3 benchmarks/bench_process_result.py [number_of_entries]
+
+No LDAP server is needed.
+"""
+import logging
+import sys
+import time
+
+from stanford.green.ldap import LDAP, attribute_is_single_valued
+
+## TYPING
+from typing import Any, Callable, Tuple
+## END OF TYPING
+
+logger = logging.getLogger('stanford.green.ldap')
+
+def synthetic_entries(count: int) -> list[Tuple[str, dict[str, list[bytes]]]]:
+    """Return ``count`` raw entries shaped like people-tree search results."""
+    entries = []
+    for i in range(count):
+        sunetid = f"user{i:06d}"
+        attributes = {
+            'objectClass':         [b'top', b'person', b'suPerson'],
+            'uid':                 [sunetid.encode()],
+            'suRegID':             [f"{i:032x}".encode()],
+            'displayName':         [f"User {i}".encode()],
+            'sn':                  [b'Stanford'],
+            'givenName':           [b'Jane'],
+            'cn':                  [f"Jane Stanford {i}".encode(), b'Jane Stanford'],
+            'mail':                [f"{sunetid}@stanford.edu".encode()],
+            'suAffiliation':       [b'stanford:staff', b'stanford:student'],
+            'suGwAffilCode1':      [b'stanford:staff'],
+            'suPrivilegeGroup':    [b'stanford:staff', b'uit:all', b'uit:iedo'],
+            'telephoneNumber':     [b'+1 650 723 2300'],
+            'suMailCode':          [b'4321'],
+            'suVisibEmail':        [b'world'],
+            'eduPersonAffiliation': [b'staff'],
+        }
+        entries.append((f"suRegID={i:032x},cn=people,dc=stanford,dc=edu", attributes))
+
+    return entries
+
+def legacy_process_result(result: Tuple[str, dict[str, list[Any]]]) -> Tuple[str, dict[str, Any]]:
+    """The decoder as it was before decoding plans were introduced."""
+    dn     = result[0]
+    logger.info(f"dn is {dn}")
+
+    values = result[1]
+
+    return_values: dict[str, Any] = {}
+    for attribute in values.keys():
+        if (attribute == 'objectClass'):
+            continue
+
+        if (attribute_is_single_valued(attribute)):
+            single_value = values[attribute][0].decode("utf-8")
+            return_values[attribute] = single_value
+            logger.debug(f"{attribute}: {single_value}")
+        else:
+            multi_values_decoded = []
+            for multi_value in values[attribute]:
+                multi_values_decoded.append(multi_value.decode("utf-8"))
+
+            return_values[attribute] = multi_values_decoded
+            logger.debug(f"{attribute}: {multi_values_decoded}")
+
+    return (dn, return_values)
+
+def entries_per_second(decoder: Callable[[Any], Any], entries: list[Any], repeat: int = 3) -> float:
+    """Return the best-of-``repeat`` decoding rate."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for entry in entries:
+            decoder(entry)
+        best = min(best, time.perf_counter() - start)
+
+    return len(entries) / best
+
+def main() -> None:
+    count   = int(sys.argv[1]) if (len(sys.argv) > 1) else 100000
+    entries = synthetic_entries(count)
+
+    # Logging is configured but INFO/DEBUG are off, as in production.
+    logging.basicConfig(level=logging.WARNING)
+
+    ldap1 = LDAP(connect_on_init=False)
+
+    before = entries_per_second(legacy_process_result, entries)
+    after  = entries_per_second(ldap1.process_result, entries)
+
+    print(f"entries:            {count}")
+    print(f"before (per-attr):  {before:12,.0f} entries/sec")
+    print(f"after (plan):       {after:12,.0f} entries/sec")
+    print(f"speedup:            {after / before:12.2f}x")
+
+if __name__ == '__main__':
+    main()
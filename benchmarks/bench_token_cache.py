@@ -0,0 +1,62 @@
+"""Benchmark ApiAccessTokenEndpoint.get_token() cache hits.
+
+Times :py:meth:`stanford.green.oauth2.ApiAccessTokenEndpoint.get_token`
+when the token is in the in-memory cache, and when only the file cache
+has it (the in-memory cache is cleared before every call, as it was
+before the in-memory cache existed), and prints the time per call for
+each.
+
+Usage::
+
+  PYTHONPATH=. python3 benchmarks/bench_token_cache.py [number_of_calls]
+
+No token endpoint is needed: the token is made up and put straight into
+the cache. The file cache is in a temporary directory.
+"""
+import sys
+import time
+
+from exponential_backoff_ca import ExponentialBackoff
+
+from stanford.green         import utc_datetime_secs_from_now
+from stanford.green.oauth2  import AccessToken, ApiAccessTokenEndpoint
+
+## TYPING
+from typing import Callable
+## END OF TYPING
+
+def nanoseconds_per_call(function: Callable[[], object], calls: int, repeat: int = 5) -> float:
+    """Return the best-of-``repeat`` time of one call to ``function``."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        best = min(best, time.perf_counter() - start)
+
+    return best * 1e9 / calls
+
+def main() -> None:
+    calls = int(sys.argv[1]) if (len(sys.argv) > 1) else 100000
+
+    api_access = ApiAccessTokenEndpoint('oauth2', 'https://token.example.com/token', 'client', 'secret',
+                                        ExponentialBackoff(1.0, 1))
+    token = AccessToken('benchmark-token', utc_datetime_secs_from_now(3600))
+    api_access.cache_set(token, expires_in=token.expires_in())
+
+    def file_cache_hit() -> AccessToken:
+        api_access.memory_cache_clear()
+        return api_access.get_token()
+
+    # The file cache path is far slower, so time fewer calls of it.
+    file_calls = max(1, calls // 100)
+    before = nanoseconds_per_call(file_cache_hit, file_calls)
+    after  = nanoseconds_per_call(api_access.get_token, calls)
+
+    print(f"file cache hit:    {before:10.1f} ns/call  ({file_calls} calls)")
+    print(f"memory cache hit:  {after:10.1f} ns/call  ({calls} calls, {before / after:.0f}x)")
+
+    api_access.cache.clear()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+"""A throwaway local OpenLDAP server loaded with synthetic Stanford-like data.
+
+:py:class:`SlapdFixture` writes a ``slapd.conf`` (using the system's
+``core``, ``cosine``, and ``inetorgperson`` schemas plus the small
+synthetic Stanford schema in :py:data:`STANFORD_SCHEMA`) into a temporary
+directory, loads generated entries with ``slapadd``, and runs ``slapd``
+on a free port of 127.0.0.1 until it is stopped::
+
+  with SlapdFixture(number_of_people=1000) as fixture:
+      ldap1 = SimpleBindLDAP(fixture.host, fixture.rootdn, fixture.rootpw)
+      ldap1.sunetid_info(fixture.sunetid(17))
+
+Needs the OpenLDAP server (``slapd`` and ``slapadd``; e.g., the Debian
+``slapd`` package). No Kerberos credentials are needed: the server is
+reached with a simple bind as its root DN.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+import ldap  # type: ignore
+
+from stanford.green.ldap import LDAP, BASEDN, BASEDN_ACCOUNTS, BASEDN_PEOPLE
+
+## TYPING
+from typing import Any, Iterator, Optional, TextIO
+## END OF TYPING
+
+# A minimal schema for the Stanford attributes the synthetic entries use.
+# The OIDs are under an arc reserved for this test fixture only.
+STANFORD_SCHEMA = """
+attributetype ( 1.3.6.1.4.1.99999.1.1 NAME 'suRegID'
+    EQUALITY caseIgnoreMatch SUBSTR caseIgnoreSubstringsMatch
+    SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 SINGLE-VALUE )
+attributetype ( 1.3.6.1.4.1.99999.1.2 NAME 'suAffiliation'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 )
+attributetype ( 1.3.6.1.4.1.99999.1.3 NAME 'suGwAffilCode1'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 SINGLE-VALUE )
+attributetype ( 1.3.6.1.4.1.99999.1.4 NAME 'suMailCode'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 SINGLE-VALUE )
+attributetype ( 1.3.6.1.4.1.99999.1.5 NAME 'suVisibEmail'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 SINGLE-VALUE )
+attributetype ( 1.3.6.1.4.1.99999.1.6 NAME 'suPrivilegeGroup'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 )
+attributetype ( 1.3.6.1.4.1.99999.1.7 NAME 'suSeasSunetID'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 )
+attributetype ( 1.3.6.1.4.1.99999.1.8 NAME 'suMailDrop'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 )
+attributetype ( 1.3.6.1.4.1.99999.1.9 NAME 'suAccountStatus'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 SINGLE-VALUE )
+attributetype ( 1.3.6.1.4.1.99999.1.10 NAME 'suEmailStatus'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 SINGLE-VALUE )
+attributetype ( 1.3.6.1.4.1.99999.1.11 NAME 'suEntitlementName'
+    EQUALITY caseIgnoreMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 )
+objectclass ( 1.3.6.1.4.1.99999.2.1 NAME 'suPerson' AUXILIARY
+    MAY ( suRegID $ suAffiliation $ suGwAffilCode1 $ suMailCode $ suVisibEmail ) )
+objectclass ( 1.3.6.1.4.1.99999.2.2 NAME 'suAccount' AUXILIARY
+    MAY ( suPrivilegeGroup $ suSeasSunetID $ suMailDrop $ suAccountStatus $
+          suEmailStatus $ suEntitlementName ) )
+"""
+
+SCHEMA_DIRECTORIES = [
+    '/etc/ldap/schema',
+    '/etc/openldap/schema',
+    '/usr/local/etc/openldap/schema',
+    '/opt/homebrew/etc/openldap/schema',
+]
+
+MODULE_DIRECTORIES = [
+    '/usr/lib/ldap',
+    '/usr/lib64/openldap',
+    '/usr/lib/openldap',
+    '/usr/local/libexec/openldap',
+]
+
+SBIN_DIRECTORIES = ['/usr/sbin', '/usr/libexec', '/usr/local/sbin', '/usr/local/libexec']
+
+AFFILIATIONS = ['stanford:staff', 'stanford:student', 'stanford:faculty', 'stanford:affiliate']
+PRIVILEGE_GROUPS = ['stanford:staff', 'stanford:student', 'uit:all', 'uit:iedo', 'med:all', 'gsb:all']
+
+
+class GreenSlapdFixtureException(Exception):
+    """The local slapd server could not be set up or started."""
+    pass
+
+
+def find_program(name: str) -> str:
+    """Return the path of the OpenLDAP program ``name`` (e.g., ``slapd``)."""
+    path = shutil.which(name)
+    if (path is None):
+        for directory in SBIN_DIRECTORIES:
+            candidate = os.path.join(directory, name)
+            if (os.access(candidate, os.X_OK)):
+                path = candidate
+                break
+
+    if (path is None):
+        msg = f"cannot find the OpenLDAP program '{name}' (is the slapd package installed?)"
+        raise GreenSlapdFixtureException(msg)
+
+    return path
+
+def free_port() -> int:
+    """Return a TCP port on 127.0.0.1 that is free right now."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return int(sock.getsockname()[1])
+
+def write_ldif_entry(fh: TextIO, dn: str, attributes: dict[str, list[str]]) -> None:
+    fh.write(f"dn: {dn}\n")
+    for (attribute, values) in attributes.items():
+        for value in values:
+            fh.write(f"{attribute}: {value}\n")
+    fh.write("\n")
+
+def synthetic_people(number_of_people: int) -> Iterator[tuple[str, dict[str, list[str]]]]:
+    """Yield the LDIF entries (base, containers, people, and accounts) to load."""
+    yield (BASEDN, {
+        'objectClass': ['dcObject', 'organization'],
+        'dc':          ['stanford'],
+        'o':           ['Stanford University'],
+    })
+    for container in (BASEDN_ACCOUNTS, BASEDN_PEOPLE):
+        yield (container, {
+            'objectClass': ['organizationalRole'],
+            'cn':          [container.split(',')[0].split('=')[1]],
+        })
+
+    for i in range(number_of_people):
+        sunetid = SlapdFixture.sunetid(i)
+        yield (f"suRegID={i:032x},{BASEDN_PEOPLE}", {
+            'objectClass':     ['inetOrgPerson', 'suPerson'],
+            'suRegID':         [f"{i:032x}"],
+            'uid':             [sunetid],
+            'cn':              [f"Jane Stanford {i}", 'Jane Stanford'],
+            'sn':              ['Stanford'],
+            'givenName':       ['Jane'],
+            'displayName':     [f"Jane Stanford {i}"],
+            'mail':            [f"{sunetid}@stanford.edu"],
+            'telephoneNumber': ['+1 650 723 2300'],
+            'suAffiliation':   [AFFILIATIONS[i % len(AFFILIATIONS)], AFFILIATIONS[(i + 1) % len(AFFILIATIONS)]],
+            'suGwAffilCode1':  [AFFILIATIONS[i % len(AFFILIATIONS)]],
+            'suMailCode':      [f"{i % 10000:04d}"],
+            'suVisibEmail':    ['world'],
+        })
+        yield (f"uid={sunetid},{BASEDN_ACCOUNTS}", {
+            'objectClass':       ['account', 'suAccount'],
+            'uid':               [sunetid],
+            'suSeasSunetID':     [sunetid, f"jane.stanford.{i}"],
+            'suMailDrop':        [f"{sunetid}@mail.stanford.edu"],
+            'suPrivilegeGroup':  [PRIVILEGE_GROUPS[j] for j in range(len(PRIVILEGE_GROUPS)) if ((i + j) % 3 == 0)],
+            'suAccountStatus':   ['active'],
+            'suEmailStatus':     ['active'],
+            'suEntitlementName': ['email', 'kerberos', 'afs'],
+        })
+
+
+class SimpleBindLDAP(LDAP):
+    """An ``LDAP`` object that binds with a DN and password instead of GSSAPI.
+
+    Only meant for the local benchmark server.
+    """
+    def __init__(self, host: str, binddn: str, password: str, **kwargs: Any):
+        self.binddn   = binddn
+        self.password = password
+        super().__init__(host, **kwargs)
+
+    def _bind(self, ldap_conn: Any, host: str) -> None:
+        # Only the bind differs; LDAP.connect still times it and reports
+        # it to the object's listeners.
+        ldap_conn.simple_bind_s(self.binddn, self.password)
+
+    def _credential_expiry(self) -> Optional[float]:
+        # A password does not expire.
+        return None
+
+
+class SlapdFixture():
+    """Run a temporary slapd loaded with ``number_of_people`` people and accounts.
+
+    :param number_of_people: the number of synthetic people (each has a
+      people-tree and an account-tree entry).
+    :type number_of_people: int
+
+    :param startup_timeout: seconds to wait for the server to accept
+      binds; default: 30.
+    :type startup_timeout: float
+
+    """
+    rootdn = f"cn=admin,{BASEDN}"
+    rootpw = 'benchmark'
+
+    def __init__(self, number_of_people: int, startup_timeout: float = 30.0):
+        self.number_of_people = number_of_people
+        self.startup_timeout  = startup_timeout
+
+        self.directory: Optional[str] = None
+        self.process: Optional[subprocess.Popen[bytes]] = None
+        self.port = 0
+
+    @staticmethod
+    def sunetid(i: int) -> str:
+        """Return the sunetid of the ``i``-th synthetic person."""
+        return f"user{i:07d}"
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    def _write_config(self, directory: str) -> str:
+        schema_directory = next((path for path in SCHEMA_DIRECTORIES
+                                 if os.path.exists(os.path.join(path, 'core.schema'))), None)
+        if (schema_directory is None):
+            msg = "cannot find the OpenLDAP core.schema file"
+            raise GreenSlapdFixtureException(msg)
+
+        stanford_schema = os.path.join(directory, 'stanford.schema')
+        with open(stanford_schema, 'w', encoding='utf-8') as fh:
+            fh.write(STANFORD_SCHEMA)
+
+        lines = [f"include {os.path.join(schema_directory, name)}.schema"
+                 for name in ('core', 'cosine', 'inetorgperson')]
+        lines.append(f"include {stanford_schema}")
+        lines.append(f"pidfile {os.path.join(directory, 'slapd.pid')}")
+
+        module_directory = next((path for path in MODULE_DIRECTORIES
+                                 if os.path.exists(os.path.join(path, 'back_mdb.la'))), None)
+        if (module_directory is not None):
+            lines.append(f"modulepath {module_directory}")
+            lines.append("moduleload back_mdb")
+
+        database_directory = os.path.join(directory, 'db')
+        os.mkdir(database_directory)
+        lines += [
+            "sizelimit unlimited",
+            "database mdb",
+            "maxsize 4294967296",
+            f'suffix "{BASEDN}"',
+            f'rootdn "{self.rootdn}"',
+            f"rootpw {self.rootpw}",
+            f"directory {database_directory}",
+            "index objectClass eq",
+            "index uid,suRegID,mail eq",
+        ]
+
+        config = os.path.join(directory, 'slapd.conf')
+        with open(config, 'w', encoding='utf-8') as fh:
+            fh.write('\n'.join(lines) + '\n')
+
+        return config
+
+    def start(self) -> None:
+        """Create, load, and start the server; return once it accepts binds."""
+        self.directory = tempfile.mkdtemp(prefix='green-slapd-')
+        config = self._write_config(self.directory)
+
+        data = os.path.join(self.directory, 'data.ldif')
+        with open(data, 'w', encoding='utf-8') as fh:
+            for (dn, attributes) in synthetic_people(self.number_of_people):
+                write_ldif_entry(fh, dn, attributes)
+
+        subprocess.run([find_program('slapadd'), '-q', '-f', config, '-l', data],
+                       check=True, capture_output=True)
+
+        self.port    = free_port()
+        # "-d 0" keeps slapd in the foreground so it can be stopped.
+        self.process = subprocess.Popen(
+            [find_program('slapd'), '-f', config, '-h', f"ldap://{self.host}/", '-d', '0'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            try:
+                ldap_conn = ldap.initialize(f"ldap://{self.host}")
+                ldap_conn.simple_bind_s(self.rootdn, self.rootpw)
+                ldap_conn.unbind_s()
+                return
+            except ldap.SERVER_DOWN:
+                if ((self.process.poll() is not None) or (time.monotonic() > deadline)):
+                    self.stop()
+                    msg = "slapd did not start"
+                    raise GreenSlapdFixtureException(msg)
+                time.sleep(0.1)
+
+    def stop(self) -> None:
+        """Stop the server and remove its files."""
+        if (self.process is not None):
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+        if (self.directory is not None):
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def __enter__(self) -> 'SlapdFixture':
+        self.start()
+        return self
+
+    def __exit__(self, *_exc_info: Any) -> None:
+        self.stop()
@@ -31,18 +31,108 @@ Simple example::
 
   # Clean up the ticket file:
   kt.cleanup()
+
+To renew the ticket only when it has less than ten minutes left (other
+processes sharing the ticket file that got there first will already have
+renewed it)::
+
+  kt.create_ticket_file(min_lifetime_seconds=600)
+  print(kt.ticket_expiry())  # seconds since the epoch
 """
 
 import os
+import struct
 import time
 from filelock import FileLock
 
 from stanford.green.utility import run_command
 
 ## TYPING
-from typing import Any, Optional
+from typing import Any, Optional, Tuple
 ## END OF TYPING
 
+# The versions of the credential cache (ccache) file format that
+# ccache_expiry can read; see
+# https://web.mit.edu/kerberos/krb5-devel/doc/formats/ccache_file_format.html
+CCACHE_VERSIONS = (0x0503, 0x0504)
+
+def ccache_expiry(path: str) -> Optional[float]:
+    """Return when the ticket-granting ticket in the ccache file ``path`` expires.
+
+    The expiry is in seconds since the epoch. Return ``None`` if the file
+    does not exist, is not a version 3 or 4 ccache file, or holds no
+    ticket-granting ticket for the default principal's realm.
+    """
+    try:
+        with open(path, 'rb') as ccache:
+            data = ccache.read()
+    except OSError:
+        return None
+
+    try:
+        return _ccache_expiry(data)
+    except struct.error:
+        # The file is truncated (e.g., kinit is writing it).
+        return None
+
+def _ccache_expiry(data: bytes) -> Optional[float]:
+    def counted(offset: int) -> Tuple[bytes, int]:
+        (length,) = struct.unpack_from('>I', data, offset)
+        offset += 4
+        if (offset + length > len(data)):
+            raise struct.error("counted octet string runs past the end of the file")
+        return (data[offset:offset + length], offset + length)
+
+    def principal(offset: int) -> Tuple[bytes, list[bytes], int]:
+        (_name_type, count) = struct.unpack_from('>II', data, offset)
+        (realm, offset) = counted(offset + 8)
+        components = []
+        for _ in range(count):
+            (component, offset) = counted(offset)
+            components.append(component)
+        return (realm, components, offset)
+
+    def skip_tagged_list(offset: int) -> int:
+        # A count followed by that many (16-bit tag, counted octet string) pairs.
+        (count,) = struct.unpack_from('>I', data, offset)
+        offset += 4
+        for _ in range(count):
+            (_value, offset) = counted(offset + 2)
+        return offset
+
+    (version,) = struct.unpack_from('>H', data, 0)
+    if (version not in CCACHE_VERSIONS):
+        return None
+
+    offset = 2
+    if (version == 0x0504):
+        (header_length,) = struct.unpack_from('>H', data, offset)
+        offset += 2 + header_length
+
+    (default_realm, _components, offset) = principal(offset)
+
+    expiry: Optional[float] = None
+    while (offset < len(data)):
+        (_client_realm, _client, offset) = principal(offset)
+        (server_realm, server, offset) = principal(offset)
+
+        # The keyblock: the encryption type (twice in version 3) and the key.
+        offset += 4 if (version == 0x0503) else 2
+        (_key, offset) = counted(offset)
+
+        (_authtime, _starttime, endtime, _renew_till) = struct.unpack_from('>IIII', data, offset)
+        offset += 16 + 1 + 4  # the times, is_skey, and the ticket flags
+
+        offset = skip_tagged_list(offset)  # addresses
+        offset = skip_tagged_list(offset)  # authorization data
+        (_ticket, offset) = counted(offset)
+        (_second_ticket, offset) = counted(offset)
+
+        if ((server == [b'krbtgt', default_realm]) and (server_realm == default_realm)):
+            expiry = endtime if (expiry is None) else max(expiry, endtime)
+
+    return expiry
+
 class KerberosTicket():
     """A Kerberos ticket object.
 
@@ -69,7 +159,7 @@ class KerberosTicket():
         self.ticket_file = ticket_file
 
         if (ticket_lock_file is None):
-            self.ticket_lock_file = f"{ticket_lock_file}.lock"
+            self.ticket_lock_file = f"{ticket_file}.lock"
         else:
             self.ticket_lock_file = ticket_lock_file
 
@@ -98,12 +188,21 @@ class KerberosTicket():
         self._verbose = value
     ####################################################################################
 
-    def ticket_file_needs_updating(self) -> bool:
+    def ticket_expiry(self) -> Optional[float]:
+        """Return when the ticket in the ticket file expires (seconds since the epoch).
+
+        Returns ``None`` if that cannot be determined; see :py:func:`ccache_expiry`.
+        """
+        return ccache_expiry(self.ticket_file)
+
+    def ticket_file_needs_updating(self, min_lifetime_seconds: Optional[float] = None) -> bool:
         """Return true if the Kerberos ticket file needs updating, false otherwise.
 
         The Kerberos ticket file needs updating in the following cases:
           * it does not already exist;
           * it *does* exist but is empty;
+          * ``min_lifetime_seconds`` is set and the ticket expires in less
+            than that many seconds (or its expiry cannot be determined);
           * it *does* exist but is too old. The ticket file is too old if
             the current ticket file is more than ``self.age_limit_seconds``
             seconds old.
@@ -116,6 +215,12 @@ class KerberosTicket():
         if (os.stat(self.ticket_file).st_size == 0):
             return True
 
+        if (min_lifetime_seconds is not None):
+            expiry = self.ticket_expiry()
+            if ((expiry is None) or (expiry - time.time() < min_lifetime_seconds)):
+                self.debug(f"ticket expires at {expiry}, too soon")
+                return True
+
         # The ticket file exists. How old is it?
         modify_time_epoch = os.path.getmtime(self.ticket_file)
         age_seconds = time.time() - modify_time_epoch
@@ -126,9 +231,18 @@ class KerberosTicket():
         else:
             return False
 
-    def create_ticket_file(self) -> None:
+    def create_ticket_file(self, force: bool = False, min_lifetime_seconds: Optional[float] = None) -> None:
         """Create/update the Kerberos ticket file (if needed).
 
+        :param force: if ``True`` get a new ticket even if the ticket file
+          does not need updating; default: ``False``.
+        :type force: bool
+
+        :param min_lifetime_seconds: if set, also update the ticket file if
+          its ticket expires in less than this many seconds (see
+          :py:meth:`ticket_file_needs_updating`); default: ``None``.
+        :type min_lifetime_seconds: float
+
         Create/update the Kerberos ticket file, but only if the ticket
         file needs to be renewed. Also set the environment variable
         :envvar:`KRB5CCNAME` to point to the Kerberos ticket file.
@@ -136,21 +250,27 @@ class KerberosTicket():
         The path to the ticket file comes from ``self.keytab_path``.
 
         This method only creates the ticket file if it can acquire the
-        ticket lock file.
+        ticket lock file. Unless ``force`` is set, whether the file needs
+        updating is checked again once the lock is held, so when several
+        processes share a ticket file only the first of them to get the
+        lock runs :command:`kinit`.
         """
         # Does this ticket file need updating at all?
-        if (self.ticket_file_needs_updating()):
+        if (force or self.ticket_file_needs_updating(min_lifetime_seconds)):
             # Yes, it needs updating. So acquire the lock and update.
             # Given that creating a Kerberos ticket file takes less
             # than a second (under normal circumstances), putting a 10-second
             # timeout on acquiring the lock file is more than sufficient.
             with FileLock(self.ticket_lock_file, timeout=10):
                 self.debug("acquired Kerberos ticket lock file")
-                cmd = ['kinit', '-k', '-t', self.keytab_path, '-c', self.ticket_file, self.kprincipal]
-                _, stderr, _ = run_command(cmd)
-
-                if (stderr):
-                    raise Exception(f"error obtaining a Kerberos ticket: {stderr}")
+                if (force or self.ticket_file_needs_updating(min_lifetime_seconds)):
+                    cmd = ['kinit', '-k', '-t', self.keytab_path, '-c', self.ticket_file, self.kprincipal]
+                    _, stderr, _ = run_command(cmd)
+
+                    if (stderr):
+                        raise Exception(f"error obtaining a Kerberos ticket: {stderr}")
+                else:
+                    self.debug("another process updated the Kerberos ticket file")
             self.debug(f"Kerberos lock file should now be released")
         else:
             self.debug("Kerberos ticket file is not old enough to need updating")
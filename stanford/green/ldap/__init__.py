@@ -30,13 +30,69 @@ information (this assumes you have a valid Kerberos context)::
   results = ldap1.sunetid_people_info('jstanford')   # Get people tree LDAP information for user 'jstanford'
   results = ldap1.sunetid_info('jstanford')          # Get BOTH account and people tree LDAP information for user 'jstanford'
 
+Multi-threaded applications can share one ``LDAP`` object backed by a
+pool of already-bound connections so that no request pays for a GSSAPI
+bind (see :py:mod:`stanford.green.ldap.pool`)::
+
+  ldap1 = LDAP(pool_size=8)
+  results = ldap1.sunetid_info('jstanford')  # safe to call from many threads
+  print(ldap1.pool_stats())
+
+Repeated lookups can be answered from a cache (see
+:py:mod:`stanford.green.ldap.cache`)::
+
+  from stanford.green.ldap.cache import LDAPResultCache
+
+  ldap1 = LDAP(cache=LDAPResultCache(ttl=300))
+
+Large result sets can be held in a fraction of the memory with
+:py:meth:`LDAP.search_compact` (see :py:mod:`stanford.green.ldap.compact`)::
+
+  people = ldap1.search_compact(BASEDN_PEOPLE)
+
+A directory browser can ask the server for one sorted page of a large
+listing (see :py:mod:`stanford.green.ldap.listing`)::
+
+  page = ldap1.search_page(BASEDN_PEOPLE, 'displayName', page=11, page_size=50)
+
+Every bind and search can be reported to *hooks*, e.g., to log slow
+searches or to export Prometheus metrics (see
+:py:mod:`stanford.green.ldap.instrument`)::
+
+  ldap1 = LDAP(slow_query_seconds=0.5)
+
 """
+import functools
 import logging
+import os
+import threading
+import time
 import ldap      # type: ignore
 import ldap.sasl # type: ignore
+import ldap.filter # type: ignore
+from ldap.controls import SimplePagedResultsControl  # type: ignore
+from contextlib import contextmanager
+
+from stanford.green.ldap.pool  import LDAPConnectionPool, DEAD_CONNECTION_EXCEPTIONS
+from stanford.green.kerberos import KerberosTicket, ccache_expiry
+from stanford.green.ldap.rebind import CredentialRenewer
+from stanford.green.ldap.replicas import ReplicaSet
+from stanford.green.ldap.cache import LDAPResultCache, NO_RESULTS, SearchKey, copy_result_set, search_key
+from stanford.green.ldap.schema import AttributeRegistry, MultiplicityIndex, decode_lenient
+from stanford.green.ldap.compact import CompactResultSet
+from stanford.green.ldap.instrument import OperationStats, SlowQueryLogger
+from stanford.green.ldap.limits import (
+    GreenLDAPSearchLimitException,
+    GreenLDAPSizeLimitException,
+    GreenLDAPTimeLimitException,
+    SearchLimits,
+    SearchResult,
+)
+from stanford.green.ldap.listing import ListingPage, sort_control, view_control, check_sort_result
+from stanford.green.utility.singleflight import SingleFlight
 
 ## TYPING
-from typing import Optional, Any, Tuple
+from typing import Optional, Any, Callable, Iterator, Tuple, cast
 LDAPResult = dict[str, dict[str, str|list[str]]]
 ## END OF TYPING
 
@@ -362,10 +418,99 @@ PEOPLE_ATTRIBUTE_TO_MULTIPLICITY |= PEOPLE_ATTRIBUTE_TO_MULTIPLICITY_EXTRA
 # Put them together.
 ATTRIBUTE_TO_MULTIPLICITY = ACCOUNT_ATTRIBUTE_TO_MULTIPLICITY | PEOPLE_ATTRIBUTE_TO_MULTIPLICITY
 
+# Frozen, case-insensitive indexes of the tables above; the
+# *_attribute_is_* functions below use these.
+ACCOUNT_MULTIPLICITY = MultiplicityIndex(ACCOUNT_ATTRIBUTE_TO_MULTIPLICITY)
+PEOPLE_MULTIPLICITY  = MultiplicityIndex(PEOPLE_ATTRIBUTE_TO_MULTIPLICITY)
+MULTIPLICITY         = MultiplicityIndex(ATTRIBUTE_TO_MULTIPLICITY)
+
 BASEDN          = "dc=stanford,dc=edu"
 BASEDN_ACCOUNTS = "cn=accounts,dc=stanford,dc=edu"
 BASEDN_PEOPLE   = "cn=people,dc=stanford,dc=edu"
 
+# Defaults for the batch (``*_many``) lookups: the most sunetids combined
+# into one OR-filter, and the longest filter string we will send.
+MANY_CHUNK_SIZE        = 100
+MANY_MAX_FILTER_LENGTH = 8192
+
+# Server errors meaning a batch filter asked for too much at once; on
+# these the batch lookups halve their chunk size and try again.
+CHUNK_TOO_LARGE_EXCEPTIONS = (ldap.SIZELIMIT_EXCEEDED, ldap.ADMINLIMIT_EXCEEDED, ldap.UNWILLING_TO_PERFORM)
+
+# The default number of base-scope searches :py:meth:`LDAP.fetch_dns`
+# keeps outstanding on its connection at once.
+FETCH_WINDOW = 64
+
+# Errors from a single base-scope search meaning its DN is not there to
+# fetch; :py:meth:`LDAP.fetch_dns` reports the DN as missing on these.
+MISSING_DN_EXCEPTIONS = (ldap.NO_SUCH_OBJECT, ldap.INVALID_DN_SYNTAX)
+
+def _unbind_quietly(ldap_conn: Any) -> None:
+    """Unbind ``ldap_conn``, ignoring any errors."""
+    try:
+        ldap_conn.unbind_s()
+    except Exception as excpt:
+        logger.debug(f"error unbinding LDAP connection: {excpt}")
+
+def paged_results_cookie(response_controls: list[Any]) -> Optional[bytes]:
+    """Return the paging cookie from a list of search response controls.
+
+    :param response_controls: the decoded controls returned with a search result
+    :type response_controls: list
+
+    :return: the cookie to send with the request for the next page, or
+      ``None`` if the server did not return a simple paged results control
+      (or returned an empty cookie, meaning there are no more pages).
+    """
+    for control in response_controls:
+        if (control.controlType == SimplePagedResultsControl.controlType):
+            return cast(Optional[bytes], control.cookie or None)
+
+    return None
+
+def uid_filter(sunetids: list[str]) -> str:
+    """Return an LDAP filter matching any of the uids in ``sunetids``.
+
+    :param sunetids: a non-empty list of sunetids
+    :type sunetids: list[str]
+
+    :return: ``(uid=a)`` for a single sunetid, ``(|(uid=a)(uid=b)...)``
+      otherwise. The sunetids are escaped as filter values.
+    :rtype: str
+
+    """
+    clauses = [f"(uid={ldap.filter.escape_filter_chars(sunetid)})" for sunetid in sunetids]
+    if (len(clauses) == 1):
+        return clauses[0]
+    else:
+        return f"(|{''.join(clauses)})"
+
+def uid_filter_chunks(
+        sunetids:          list[str],
+        chunk_size:        int,
+        max_filter_length: int,
+) -> Iterator[list[str]]:
+    """Split ``sunetids`` into chunks suitable for :py:func:`uid_filter`.
+
+    Each chunk has at most ``chunk_size`` sunetids and, unless it holds
+    only one sunetid, produces a filter of at most ``max_filter_length``
+    characters.
+    """
+    chunk: list[str] = []
+    length = 3  # the "(|" and ")" around the clauses
+    for sunetid in sunetids:
+        clause_length = len(uid_filter([sunetid]))
+        if (chunk and ((len(chunk) >= chunk_size) or (length + clause_length > max_filter_length))):
+            yield chunk
+            chunk  = []
+            length = 3
+
+        chunk.append(sunetid)
+        length += clause_length
+
+    if (chunk):
+        yield chunk
+
 def account_attribute_is_single_valued(attribute_name: str) -> bool:
     """Return True if `attribute_name` is a single-valued account-tree attribute, False otherwise.
 
@@ -377,9 +522,16 @@ def account_attribute_is_single_valued(attribute_name: str) -> bool:
     :raises GreenUnknownLDAPAttribute: if `attribute_name` is not a valid
       account-tree attribute name.
 
+    Attribute names are matched case-insensitively, as LDAP does.
     """
-    if (attribute_name in ACCOUNT_ATTRIBUTE_TO_MULTIPLICITY):
-        return (ACCOUNT_ATTRIBUTE_TO_MULTIPLICITY[attribute_name] == 'single')
+    if (attribute_name in ACCOUNT_MULTIPLICITY.single):
+        return True
+    elif (attribute_name in ACCOUNT_MULTIPLICITY.multi):
+        return False
+
+    single_valued = ACCOUNT_MULTIPLICITY.is_single_valued(attribute_name)
+    if (single_valued is not None):
+        return single_valued
     else:
         msg = f"'{attribute_name}' is not an account-tree attribute"
         raise GreenUnknownLDAPAttribute(msg)
@@ -407,9 +559,17 @@ def people_attribute_is_single_valued(attribute_name: str) -> bool:
 
     :raises GreenUnknownLDAPAttribute: if `attribute_name` is not a valid
       people-tree attribute name.
+
+    Attribute names are matched case-insensitively, as LDAP does.
     """
-    if (attribute_name in PEOPLE_ATTRIBUTE_TO_MULTIPLICITY):
-        return (PEOPLE_ATTRIBUTE_TO_MULTIPLICITY[attribute_name] == 'single')
+    if (attribute_name in PEOPLE_MULTIPLICITY.single):
+        return True
+    elif (attribute_name in PEOPLE_MULTIPLICITY.multi):
+        return False
+
+    single_valued = PEOPLE_MULTIPLICITY.is_single_valued(attribute_name)
+    if (single_valued is not None):
+        return single_valued
     else:
         msg = f"'{attribute_name}' is not a people-tree attribute"
         raise GreenUnknownLDAPAttribute(msg)
@@ -435,10 +595,17 @@ def attribute_is_single_valued(attribute_name: str) -> bool:
 
     :raises GreenUnknownLDAPAttribute: if `attribute_name` is not a valid
       attribute name.
-    """
 
-    if (attribute_name in ATTRIBUTE_TO_MULTIPLICITY):
-        return (ATTRIBUTE_TO_MULTIPLICITY[attribute_name] == 'single')
+    Attribute names are matched case-insensitively, as LDAP does.
+    """
+    if (attribute_name in MULTIPLICITY.single):
+        return True
+    elif (attribute_name in MULTIPLICITY.multi):
+        return False
+
+    single_valued = MULTIPLICITY.is_single_valued(attribute_name)
+    if (single_valued is not None):
+        return single_valued
     else:
         msg = f"'{attribute_name}' is not a recognized attribute"
         raise GreenUnknownLDAPAttribute(msg)
@@ -458,36 +625,543 @@ def attribute_is_multi_valued(attribute_name: str) -> bool:
 class LDAP():
     """The LDAP class.
 
-    :param host: the LDAP host name, defaults to ``ldap.stanford.edu``
-    :type prefix: str
+    :param host: the LDAP host name, or a list of the host names of
+      replicas to spread operations over (see
+      :py:mod:`stanford.green.ldap.replicas`); defaults to ``ldap.stanford.edu``
+    :type host: str|list[str]
 
     :param connect_on_init: set to ``True`` to connect ``host`` on object
-      creation, ``False`` otherwise, defaults to ``True``.
-    :type prefix: bool
+      creation, ``False`` otherwise, defaults to ``True``. In pooled mode
+      this controls whether the pool is filled with bound connections
+      on object creation.
+    :type connect_on_init: bool
+
+    :param pool_size: if set, use a pool of at most this many bound
+      connections (see :py:class:`~stanford.green.ldap.pool.LDAPConnectionPool`)
+      instead of a single connection, making the object safe to share
+      between threads; defaults to ``None`` (no pool).
+    :type pool_size: int
+
+    :param pool_max_lifetime: (pooled mode only) seconds after which a
+      pooled connection is closed and replaced; default: 3600.
+    :type pool_max_lifetime: float
+
+    :param pool_idle_check: (pooled mode only) pooled connections idle
+      for longer than this many seconds are health-checked before use;
+      default: 60.
+    :type pool_idle_check: float
+
+    :param pool_timeout: (pooled mode only) seconds to wait for a free
+      pooled connection; default: 10.
+    :type pool_timeout: float
+
+    :param cache: if set, cache the results of :py:meth:`search` (and so
+      of the ``sunetid_*_info`` methods) in this
+      :py:class:`~stanford.green.ldap.cache.LDAPResultCache`; defaults to
+      ``None`` (no caching).
+    :type cache: LDAPResultCache
+
+    :param registry: the :py:class:`~stanford.green.ldap.schema.AttributeRegistry`
+      used to decode entries; defaults to a new registry built from
+      :py:data:`ATTRIBUTE_TO_MULTIPLICITY`.
+    :type registry: AttributeRegistry
+
+    :param schema_cache_file: if set (and ``connect_on_init`` is ``True``)
+      call :py:meth:`load_schema` with this cache file on object creation;
+      defaults to ``None``.
+    :type schema_cache_file: str
+
+    :param hooks: callables each passed an
+      :py:class:`~stanford.green.ldap.instrument.OperationStats` when a
+      bind or search finishes; defaults to ``None`` (no hooks).
+    :type hooks: list
+
+    :param slow_query_seconds: if set, add a
+      :py:class:`~stanford.green.ldap.instrument.SlowQueryLogger` hook
+      logging every operation taking at least this many seconds;
+      defaults to ``None``.
+    :type slow_query_seconds: float
+
+    :param coalesce: if ``True``, a :py:meth:`search` made while an
+      identical one (same normalized base DN, filter, attribute list,
+      and scope) is in flight in another thread waits for that search's
+      result (or exception) instead of sending its own; default: ``True``.
+    :type coalesce: bool
+
+    :param replica_probe_interval: (replicas only) seconds between the
+      round-trip time probes of each replica; default: 30.
+    :type replica_probe_interval: float
+
+    :param kerberos_ticket: if set, the
+      :py:class:`~stanford.green.kerberos.KerberosTicket` to bind with;
+      the ticket is renewed and every connection rebound in a background
+      thread before the ticket expires (see
+      :py:mod:`stanford.green.ldap.rebind`); defaults to ``None`` (bind
+      with whatever ticket :envvar:`KRB5CCNAME` points to).
+    :type kerberos_ticket: KerberosTicket
+
+    :param rebind_margin: (with ``kerberos_ticket``) renew and rebind at
+      least this many seconds before the ticket expires; default: 600.
+    :type rebind_margin: float
+
+    :param rebind_jitter: (with ``kerberos_ticket``) renew up to
+      ``rebind_jitter * rebind_margin`` seconds earlier still, at random,
+      so that workers sharing a ticket do not all rebind at once;
+      default: 0.5.
+    :type rebind_jitter: float
+
+    With several replica hosts each operation goes to the fastest
+    healthy replica. Connections to a replica (or, in pooled mode, a pool
+    of ``pool_size`` connections per replica) are made when first
+    needed, and the background probing of the replicas starts on object
+    creation if ``connect_on_init`` is ``True`` (otherwise call
+    ``self.replicas.start()``).
+
+    Likewise the background renewal of ``kerberos_ticket`` starts on
+    object creation if ``connect_on_init`` is ``True`` (otherwise call
+    ``self.renewer.start()``). The expiry of the ticket the latest
+    connection was bound with is kept in ``self.credential_expiry``.
 
     """
 
     def __init__(self,
-                 host: str = 'ldap.stanford.edu',
-                 connect_on_init: bool = True):
-        self.host = host
-
-        if (connect_on_init):
+                 host:              str|list[str] = 'ldap.stanford.edu',
+                 connect_on_init:   bool = True,
+                 pool_size:         Optional[int] = None,
+                 pool_max_lifetime: float = 3600.0,
+                 pool_idle_check:   float = 60.0,
+                 pool_timeout:      float = 10.0,
+                 cache:             Optional[LDAPResultCache] = None,
+                 registry:          Optional[AttributeRegistry] = None,
+                 schema_cache_file: Optional[str] = None,
+                 hooks:             Optional[list[Callable[[OperationStats], None]]] = None,
+                 slow_query_seconds: Optional[float] = None,
+                 coalesce:          bool = True,
+                 replica_probe_interval: float = 30.0,
+                 kerberos_ticket:   Optional[KerberosTicket] = None,
+                 rebind_margin:     float = 600.0,
+                 rebind_jitter:     float = 0.5):
+        hosts = [host] if isinstance(host, str) else list(host)
+        if (not hosts):
+            msg = "at least one LDAP host is needed"
+            raise ValueError(msg)
+
+        self.host  = hosts[0]
+        self.cache = cache
+
+        self.replicas: Optional[ReplicaSet] = None
+        if (len(hosts) > 1):
+            self.replicas = ReplicaSet(hosts, probe_interval=replica_probe_interval)
+
+        self.single_flight: Optional[SingleFlight] = SingleFlight() if coalesce else None
+
+        self.hooks: list[Callable[[OperationStats], None]] = list(hooks) if (hooks is not None) else []
+        if (slow_query_seconds is not None):
+            self.hooks.append(SlowQueryLogger(slow_query_seconds))
+
+        if (registry is None):
+            self.registry = AttributeRegistry(ATTRIBUTE_TO_MULTIPLICITY)
+        else:
+            self.registry = registry
+
+        self.kerberos_ticket = kerberos_ticket
+        self.credential_expiry: Optional[float] = None
+        self.renewer: Optional[CredentialRenewer] = None
+        if (kerberos_ticket is not None):
+            self.renewer = CredentialRenewer(self.renew_credentials, margin=rebind_margin, jitter=rebind_jitter)
+
+        # Connections bound ahead of time by rebind(), keyed by host, to
+        # be swapped in at the start of the next operation.
+        self._rebind_lock = threading.Lock()
+        self._fresh_connections: dict[str, Any] = {}
+
+        self.pool: Optional[LDAPConnectionPool] = None
+        self.replica_pools: dict[str, LDAPConnectionPool] = {}
+        self._replica_connections: dict[str, Any] = {}
+        if (self.replicas is not None):
+            if (pool_size is not None):
+                for replica_host in hosts:
+                    self.replica_pools[replica_host] = LDAPConnectionPool(
+                        functools.partial(self.connect, replica_host),
+                        size=pool_size,
+                        max_lifetime=pool_max_lifetime,
+                        idle_check_seconds=pool_idle_check,
+                        checkout_timeout=pool_timeout,
+                        prefill=False,
+                    )
+            if (connect_on_init):
+                self.replicas.start()
+        elif (pool_size is not None):
+            self.pool = LDAPConnectionPool(
+                self.connect,
+                size=pool_size,
+                max_lifetime=pool_max_lifetime,
+                idle_check_seconds=pool_idle_check,
+                checkout_timeout=pool_timeout,
+                prefill=connect_on_init,
+            )
+        elif (connect_on_init):
             self.ldap = self.connect()
 
-    def connect(self) -> Any:
+        if (self.renewer is not None):
+            self.renewer.schedule(self._credential_expiry())
+            if (connect_on_init):
+                self.renewer.start()
+
+        if ((schema_cache_file is not None) and connect_on_init):
+            self.load_schema(schema_cache_file)
+
+    def connect(self, host: Optional[str] = None) -> Any:
         """Create a connected ldap object.
 
+        :param host: the host to connect to; defaults to ``self.host``.
+        :type host: str
+
         Currently, the only connection method is using GSSAPI. That is, there
-        must be a valid Kerberos context.
+        must be a valid Kerberos context. If the object has a
+        ``kerberos_ticket`` and no unexpired ticket is known, the ticket
+        file is created (see
+        :py:meth:`~stanford.green.kerberos.KerberosTicket.create_ticket_file`)
+        before binding.
+        """
+        if (host is None):
+            host = self.host
+
+        if ((self.kerberos_ticket is not None)
+                and ((self.credential_expiry is None) or (self.credential_expiry <= time.time()))):
+            self.kerberos_ticket.create_ticket_file()
+
+        stats = self._new_stats('bind')
+        start = time.perf_counter()
+        try:
+            ldap_conn = ldap.initialize(
+                f"ldap://{host}"
+            )
+            self._bind(ldap_conn, host)
+        except Exception as excpt:
+            if (stats is not None):
+                stats.error = type(excpt).__name__
+            raise
+        finally:
+            if (stats is not None):
+                stats.bind_seconds  = time.perf_counter() - start
+                stats.total_seconds = stats.bind_seconds
+                self._report(stats)
+
+        self.credential_expiry = self._credential_expiry()
+        return ldap_conn
+
+    def _bind(self, ldap_conn: Any, host: str) -> None:
+        """Bind a new connection to ``host`` for :py:meth:`connect`.
+
+        This is a GSSAPI bind. A subclass binding some other way overrides
+        this method (and :py:meth:`_credential_expiry`), so that its binds
+        are still timed and its credential expiry is still tracked.
         """
-        ldap_conn = ldap.initialize(
-            f"ldap://{self.host}"
-        )
         ldap_conn.sasl_non_interactive_bind_s('GSSAPI')
-        logger.debug(f"making LDAP SASL bind to {self.host}")
+        logger.debug(f"making LDAP SASL bind to {host}")
 
-        return ldap_conn
+    ## Kerberos renewal
+
+    def _credential_expiry(self) -> Optional[float]:
+        """Return when the ticket we bind with expires (seconds since the epoch), if known."""
+        if (self.kerberos_ticket is not None):
+            return self.kerberos_ticket.ticket_expiry()
+
+        ccache = os.environ.get('KRB5CCNAME', '')
+        if (ccache.startswith('FILE:')):
+            ccache = ccache[len('FILE:'):]
+        elif ((not ccache) or (':' in ccache)):
+            # The default cache, or a cache type we cannot read.
+            return None
+
+        return ccache_expiry(ccache)
+
+    def renew_credentials(self) -> Optional[float]:
+        """Renew the Kerberos ticket if it is close to expiring, then :py:meth:`rebind`.
+
+        Return the new expiry of the ticket (seconds since the epoch), if
+        known. This is what the background renewal thread calls.
+
+        :raises ValueError: if the object has no ``kerberos_ticket``.
+        """
+        if ((self.kerberos_ticket is None) or (self.renewer is None)):
+            msg = "there is no kerberos_ticket to renew"
+            raise ValueError(msg)
+
+        # Any worker renewing has less than this left on the ticket,
+        # while a ticket another worker has just renewed has far more, so
+        # only the first worker sharing the ticket file runs kinit.
+        min_lifetime = 2 * self.renewer.margin * (1 + self.renewer.jitter)
+        self.kerberos_ticket.create_ticket_file(min_lifetime_seconds=min_lifetime)
+
+        self.rebind()
+        return self.credential_expiry
+
+    def rebind(self) -> None:
+        """Replace the connections with ones bound with the current Kerberos ticket.
+
+        In pooled mode every pooled connection is recycled (see
+        :py:meth:`~stanford.green.ldap.pool.LDAPConnectionPool.recycle_all`)
+        and the pool is refilled. Otherwise a new connection is bound now
+        and swapped in at the start of the next operation, so the
+        operation does not wait for the bind and no operation in progress
+        loses its connection. With replicas, only the pool of the replica
+        operations currently go to is refilled.
+        """
+        if (self.replicas is not None):
+            if (self.replica_pools):
+                for pool in self.replica_pools.values():
+                    pool.recycle_all()
+                self.replica_pools[self.replicas.choose()].fill()
+            else:
+                for host in list(self._replica_connections):
+                    self._stage_connection(host, self.connect(host))
+        elif (self.pool is not None):
+            self.pool.recycle_all()
+            self.pool.fill()
+        elif (hasattr(self, 'ldap')):
+            self._stage_connection(self.host, self.connect())
+
+        self.credential_expiry = self._credential_expiry()
+        logger.info(f"rebound LDAP connections; credentials expire at {self.credential_expiry}")
+
+    def _stage_connection(self, host: str, ldap_conn: Any) -> None:
+        with self._rebind_lock:
+            stale = self._fresh_connections.get(host)
+            self._fresh_connections[host] = ldap_conn
+        if (stale is not None):
+            _unbind_quietly(stale)
+
+    def _take_fresh_connection(self, host: str) -> Optional[Any]:
+        if (not self._fresh_connections):
+            return None
+        with self._rebind_lock:
+            return self._fresh_connections.pop(host, None)
+
+    def rebind_stats(self) -> Optional[dict[str, Any]]:
+        """Return the renewal counters and times, or ``None`` if there is no ``kerberos_ticket``.
+
+        See :py:meth:`~stanford.green.ldap.rebind.CredentialRenewer.stats`.
+        """
+        if (self.renewer is None):
+            return None
+        else:
+            return self.renewer.stats()
+
+    ## Instrumentation
+
+    def add_hook(self, hook: Callable[[OperationStats], None]) -> None:
+        """Call ``hook`` with the statistics of every later bind and search.
+
+        See :py:mod:`stanford.green.ldap.instrument`.
+        """
+        self.hooks.append(hook)
+
+    def _new_stats(
+            self,
+            operation: str,
+            basedn:    str='',
+            filterstr: str='',
+            attrlist:  Optional[list[str]]=None,
+            scope:     str='',
+    ) -> Optional[OperationStats]:
+        """Return a new ``OperationStats``, or ``None`` if there are no hooks to report to."""
+        if (not self.hooks):
+            return None
+        else:
+            return OperationStats(operation, basedn, filterstr, attrlist, scope)
+
+    def _report(self, stats: OperationStats) -> None:
+        for hook in self.hooks:
+            try:
+                hook(stats)
+            except Exception:
+                # A broken hook must not break the search it reports on.
+                logger.exception(f"LDAP instrumentation hook {hook!r} failed")
+
+    def _process_result_timed(
+            self,
+            result: Tuple[str, dict[str, list[Any]]],
+            stats:  Optional[OperationStats],
+    ) -> Tuple[str, LDAPResult]:
+        """Call :py:meth:`~process_result`, adding the time it takes to ``stats``."""
+        if (stats is None):
+            return self.process_result(result)
+
+        decode_start = time.perf_counter()
+        try:
+            return self.process_result(result)
+        finally:
+            stats.decode_seconds += time.perf_counter() - decode_start
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """Context manager yielding a bound ldap object to use for one operation.
+
+        In pooled mode the connection is checked out of the pool and
+        checked back in when the block exits; otherwise this is the
+        connection made on object creation. With replicas the connection
+        is to the replica :py:meth:`ReplicaSet.choose
+        <stanford.green.ldap.replicas.ReplicaSet.choose>` picks, and a
+        dead connection counts as a failure of that replica.
+        """
+        if (self.replicas is not None):
+            with self._replica_connection(self.replicas) as ldap_conn:
+                yield ldap_conn
+        elif (self.pool is None):
+            fresh = self._take_fresh_connection(self.host)
+            if (fresh is not None):
+                stale     = getattr(self, 'ldap', None)
+                self.ldap = fresh
+                if (stale is not None):
+                    _unbind_quietly(stale)
+            yield self.ldap
+        else:
+            with self.pool.connection() as ldap_conn:
+                yield ldap_conn
+
+    @contextmanager
+    def _replica_connection(self, replicas: ReplicaSet) -> Iterator[Any]:
+        host = replicas.choose()
+        try:
+            if (self.replica_pools):
+                with self.replica_pools[host].connection() as ldap_conn:
+                    yield ldap_conn
+            else:
+                fresh = self._take_fresh_connection(host)
+                if (fresh is not None):
+                    stale = self._replica_connections.get(host)
+                    self._replica_connections[host] = fresh
+                    if (stale is not None):
+                        _unbind_quietly(stale)
+
+                ldap_conn = self._replica_connections.get(host)
+                if (ldap_conn is None):
+                    ldap_conn = self.connect(host)
+                    self._replica_connections[host] = ldap_conn
+                yield ldap_conn
+        except DEAD_CONNECTION_EXCEPTIONS:
+            replicas.record_failure(host)
+            self._replica_connections.pop(host, None)
+            raise
+        except Exception:
+            # The replica answered, if only with an error for this operation.
+            replicas.record_success(host)
+            raise
+        else:
+            # So that only failures in a row take a replica out of rotation.
+            replicas.record_success(host)
+
+    def _attempts(self) -> int:
+        """Return how many times to try a search whose connection turns out to be dead.
+
+        A pooled connection that has died since its last health check is
+        discarded by the pool, and a replica that failed is tried after
+        the others, so in those cases one retry is worthwhile.
+        """
+        return 1 if ((self.pool is None) and (self.replicas is None)) else 2
+
+    def pool_stats(self) -> Optional[dict[str, int]]:
+        """Return the connection pool counters, or ``None`` if not pooled.
+
+        See :py:meth:`~stanford.green.ldap.pool.LDAPConnectionPool.stats`.
+        With replicas the counters of the per-replica pools are added up.
+        """
+        if (self.replica_pools):
+            stats: dict[str, int] = {}
+            for pool in self.replica_pools.values():
+                for (name, value) in pool.stats().items():
+                    stats[name] = stats.get(name, 0) + value
+            return stats
+        elif (self.pool is None):
+            return None
+        else:
+            return self.pool.stats()
+
+    def replica_stats(self) -> Optional[dict[str, dict[str, Any]]]:
+        """Return what is known about each replica, or ``None`` if there is only one host.
+
+        See :py:meth:`~stanford.green.ldap.replicas.ReplicaSet.stats`.
+        """
+        if (self.replicas is None):
+            return None
+        else:
+            return self.replicas.stats()
+
+    def coalesce_stats(self) -> Optional[dict[str, int]]:
+        """Return the search coalescing counters, or ``None`` if not coalescing.
+
+        ``calls`` is the number of searches sent to the server and
+        ``coalesced`` the number that waited for an identical search
+        already in flight instead (see
+        :py:class:`~stanford.green.utility.singleflight.SingleFlight`).
+        """
+        if (self.single_flight is None):
+            return None
+        else:
+            return self.single_flight.stats()
+
+    def close(self) -> None:
+        """Unbind the connection (or close every pooled connection)."""
+        if (self.renewer is not None):
+            self.renewer.stop()
+        with self._rebind_lock:
+            fresh = list(self._fresh_connections.values())
+            self._fresh_connections = {}
+        for ldap_conn in fresh:
+            _unbind_quietly(ldap_conn)
+
+        if (self.replicas is not None):
+            self.replicas.stop()
+            for pool in self.replica_pools.values():
+                pool.close()
+            for ldap_conn in self._replica_connections.values():
+                _unbind_quietly(ldap_conn)
+            self._replica_connections = {}
+        elif (self.pool is not None):
+            self.pool.close()
+        elif (hasattr(self, 'ldap')):
+            self.ldap.unbind_s()
+            del self.ldap
+
+    def load_schema(self, cache_file: Optional[str] = None, max_age: float = 86400.0) -> None:
+        """Update ``self.registry`` with the attribute definitions in the server schema.
+
+        :param cache_file: a JSON file in which to keep a copy of the
+          schema; if it exists and is less than ``max_age`` seconds old it
+          is loaded instead of reading the schema from the server.
+        :type cache_file: str
+
+        :param max_age: the age in seconds after which ``cache_file`` is
+          refreshed from the server; default: 86400 (one day).
+        :type max_age: float
+
+        If the schema cannot be read from the server a stale
+        ``cache_file`` is used if there is one; otherwise the registry
+        keeps using the static tables. Either way a warning is logged
+        rather than an exception raised.
+        """
+        have_cache_file = (cache_file is not None) and os.path.isfile(cache_file)
+
+        if (have_cache_file and (time.time() - os.path.getmtime(cast(str, cache_file)) < max_age)):
+            self.registry.load(cast(str, cache_file))
+            logger.debug(f"loaded LDAP schema from {cache_file}")
+            return
+
+        try:
+            with self.connection() as ldap_conn:
+                self.registry.load_server_schema(ldap_conn)
+        except (ldap.LDAPError, RuntimeError) as excpt:
+            if (have_cache_file):
+                logger.warning(f"could not read LDAP schema ({excpt}); using stale {cache_file}")
+                self.registry.load(cast(str, cache_file))
+            else:
+                logger.warning(f"could not read LDAP schema ({excpt}); using static attribute tables")
+            return
+
+        if (cache_file is not None):
+            self.registry.save(cache_file)
 
     def scope_normalize(self, scope: str) -> Any:
         scopes = {
@@ -504,39 +1178,58 @@ class LDAP():
 
 
     def process_result(self, result: Tuple[str, dict[str, list[Any]]]) -> Tuple[str, LDAPResult]:
-        dn     = result[0]
-        logger.info(f"dn is {dn}")
-
-        values = result[1]
-
-        return_values = {}
-        for attribute in values.keys():
-            # Skip objectClass
-            if (attribute == 'objectClass'):
-                continue
-
-            if (attribute_is_single_valued(attribute)):
-                single_value = values[attribute][0].decode("utf-8")
-                return_values[attribute] = single_value
-                logger.debug(f"{attribute}: {single_value}")
-            else:
-                multi_values = values[attribute]
-                multi_values_decoded = []
-                for multi_value in multi_values:
-                    multi_values_decoded.append(multi_value.decode("utf-8"))
+        """Decode one raw search entry.
+
+        :param result: a ``(dn, attributes)`` pair as returned by python-ldap
+          where each attribute maps to a list of byte-strings.
+        :type result: tuple
+
+        :return: the pair ``(dn, attributes)`` where single-valued
+          attributes map to a string and multi-valued attributes map to a
+          list of strings. The ``objectClass`` attribute is dropped.
+        :rtype: tuple
+
+        The decoding plan for the entry's set of attribute names is
+        compiled once by ``self.registry`` (see
+        :py:meth:`~stanford.green.ldap.schema.AttributeRegistry.decoding_plan`)
+        and reused for every other entry with the same attributes.
+        Attributes the registry does not recognize are returned as
+        multi-valued, with any value that is not valid UTF-8 left as a
+        byte-string; attributes with a binary syntax (or the ``;binary``
+        option) are returned undecoded (as byte-strings).
+        """
+        (dn, values) = result
+        if (logger.isEnabledFor(logging.INFO)):
+            logger.info(f"dn is {dn}")
+
+        plan = self.registry.decoding_plan(tuple(values))
+        return_values: dict[str, Any] = {
+            attribute: (values[attribute][0].decode("utf-8") if single_valued
+                        else [value.decode("utf-8") for value in values[attribute]])
+            for (attribute, single_valued) in plan.text
+        }
+        for (attribute, single_valued) in plan.binary:
+            return_values[attribute] = values[attribute][0] if single_valued else list(values[attribute])
+        for (attribute, _single_valued) in plan.unknown:
+            return_values[attribute] = [decode_lenient(value) for value in values[attribute]]
 
-                return_values[attribute] = multi_values_decoded
-                logger.debug(f"{attribute}: {multi_values_decoded}")
+        if (logger.isEnabledFor(logging.DEBUG)):
+            for (attribute, value) in return_values.items():
+                logger.debug(f"{attribute}: {value}")
 
         return (dn, return_values)
 
-
     def search(
             self,
             basedn:    str,
             filterstr: str='(objectClass=*)',
             attrlist:  Optional[list[str]]=None,
-            scope:     str='sub'
+            scope:     str='sub',
+            page_size: Optional[int]=None,
+            sort_by:   Optional[str|list[str]]=None,
+            offset:    Optional[int]=None,
+            count:     Optional[int]=None,
+            limits:    Optional[SearchLimits]=None,
     ) -> dict[str, LDAPResult]:
         """Perform an LDAP search.
 
@@ -552,7 +1245,38 @@ class LDAP():
         :param scope: the search scope; must be one "sub", "base", or "one".
         :type scope: str
 
-        This method is a thin wrapper around the ldap package's search method. The
+        :param page_size: if set, retrieve the results in pages of this
+          size using the simple paged results control (see
+          :py:meth:`~search_iter`); defaults to ``None`` (no paging).
+        :type page_size: int
+
+        :param sort_by: if set, have the server sort the results by this
+          sort key or list of sort keys (see
+          :py:mod:`stanford.green.ldap.listing`); defaults to ``None``
+          (the server's order).
+        :type sort_by: str|list[str]
+
+        :param offset: with ``count``, return only ``count`` entries of
+          the sorted result starting at ``offset`` (counting from 0) using
+          the virtual list view control (see :py:meth:`~search_window`);
+          needs ``sort_by``; defaults to ``None``.
+        :type offset: int
+
+        :param count: the number of entries to return starting at
+          ``offset`` (0 if ``offset`` is not set); defaults to ``None``
+          (all of them).
+        :type count: int
+
+        :param limits: if set, bound how long the search may take and how
+          many entries it may return (see
+          :py:mod:`stanford.green.ldap.limits`); cannot be combined with
+          ``offset`` and ``count``; defaults to ``None`` (no limits).
+        :type limits: SearchLimits
+
+        :raises GreenLDAPSearchLimitException: if the search runs over one
+          of ``limits`` and ``limits.partial`` is ``False``.
+
+        This method is a thin wrapper around :py:meth:`~search_iter`. The
         difference is in how it behaves when there are no results and the format
         of the returned value.
 
@@ -582,55 +1306,625 @@ class LDAP():
         If no results are returned this method raises the
         `GreenLDAPNoResultsException` exception.
 
+        If the object has a cache the result (or the fact that there were
+        no results) is served from and stored in the cache. Sorted
+        searches are not cached.
+
+        Unless the object was created with ``coalesce=False``, a search
+        identical to one already in flight in another thread is not sent
+        to the server; it returns a copy of the result (or raises the
+        exception) of the search in flight. As with results served from
+        the cache, every caller gets a dict of its own.
+
+        A search with ``limits`` returns a
+        :py:class:`~stanford.green.ldap.limits.SearchResult` (a dict with
+        a ``truncated`` attribute). If it runs over a limit and
+        ``limits.partial`` is ``True`` the entries received so far are
+        returned with ``truncated`` set, even if there are none, and are
+        not cached. A cached result is held to ``limits.size_limit`` in
+        the same way. Searches with limits are not coalesced, so that no
+        caller waits on a search with looser limits than its own.
+
         """
-        search_scope  = self.scope_normalize(scope)
+        if ((offset is not None) or (count is not None)):
+            if (limits is not None):
+                raise ValueError("a search with an offset or count cannot have limits")
+            if (sort_by is None):
+                raise ValueError("a search with an offset or count needs sort_by")
+            if (count is None):
+                raise ValueError("a search with an offset needs a count")
+
+            page = self.search_window(basedn, sort_by, offset=(offset or 0), count=count,
+                                      filterstr=filterstr, attrlist=attrlist, scope=scope)
+            if (len(page) == 0):
+                msg = "no LDAP results"
+                raise GreenLDAPNoResultsException(msg)
+            return page.entries
+
+        key   = search_key(basedn, filterstr, attrlist, scope)
+        cache = self.cache if (sort_by is None) else None
+        if (cache is not None):
+            cached = cache.get(key)
+            if (cached is NO_RESULTS):
+                msg = "no LDAP results (cached)"
+                raise GreenLDAPNoResultsException(msg)
+            elif (cached is not None):
+                logger.debug("LDAP cache hit")
+                if (limits is not None):
+                    # The cached result may be from a search with a looser
+                    # size limit (or none), so enforce this one's.
+                    return limits.limit_result(cast(dict[str, LDAPResult], cached))
+                return cast(dict[str, LDAPResult], cached)
+
+        # The key does not include the sort order or the limits, so those
+        # searches are not coalesced.
+        if ((self.single_flight is None) or (sort_by is not None) or (limits is not None)):
+            return self._search_server(key, basedn, filterstr, attrlist, scope, page_size, sort_by, cache,
+                                       limits)
+
+        return self.single_flight.do(
+            key,
+            lambda: self._search_server(key, basedn, filterstr, attrlist, scope, page_size, sort_by, cache),
+            copy=copy_result_set,
+        )
 
-        logger.debug(f"basedn:         {basedn}")
-        logger.debug(f"search scope:   {search_scope}")
-        logger.debug(f"search filter:  {filterstr}")
-        logger.debug(f"attribute list: {attrlist}")
+    def _search_server(
+            self,
+            key:       SearchKey,
+            basedn:    str,
+            filterstr: str,
+            attrlist:  Optional[list[str]],
+            scope:     str,
+            page_size: Optional[int],
+            sort_by:   Optional[str|list[str]],
+            cache:     Optional[LDAPResultCache],
+            limits:    Optional[SearchLimits] = None,
+    ) -> dict[str, LDAPResult]:
+        """Send the search for :py:meth:`~search` and cache its outcome under ``key``."""
+        # A dead connection is discarded (see _attempts); in that case
+        # retry once on a fresh one.
+        attempts = self._attempts()
+        for attempt in range(1, attempts + 1):
+            result_set: dict[str, LDAPResult] = {} if (limits is None) else SearchResult()
+            try:
+                for (dn, attribute_values) in self.search_iter(basedn, filterstr=filterstr, attrlist=attrlist,
+                                                               scope=scope, page_size=page_size,
+                                                               sort_by=sort_by, limits=limits):
+                    result_set[dn] = attribute_values
+            except GreenLDAPSearchLimitException as excpt:
+                if ((limits is None) or (not limits.partial)):
+                    raise
+                logger.warning(f"returning {len(result_set)} results of a truncated search: {excpt}")
+                partial = cast(SearchResult, result_set)
+                partial.truncated = True
+                partial.reason    = str(excpt)
+                return partial
+            except ldap.SERVER_DOWN:
+                if (attempt == attempts):
+                    raise
+                logger.warning("LDAP connection is down; retrying search")
+            else:
+                break
 
-        ldap_result_id = self.ldap.search(
-            basedn,
-            search_scope,
-            filterstr=filterstr,
-            attrlist=attrlist
-        )
+        logger.info(f"found {len(result_set)} results")
+
+        if (len(result_set) == 0):
+            if (cache is not None):
+                cache.set_no_results(key)
+            msg = "no LDAP results"
+            raise GreenLDAPNoResultsException(msg)
+
+        if (cache is not None):
+            cache.set(key, result_set)
+
+        return result_set
+
+    def search_iter(
+            self,
+            basedn:    str,
+            filterstr: str='(objectClass=*)',
+            attrlist:  Optional[list[str]]=None,
+            scope:     str='sub',
+            page_size: Optional[int]=500,
+            sort_by:   Optional[str|list[str]]=None,
+            limits:    Optional[SearchLimits]=None,
+    ) -> Iterator[Tuple[str, LDAPResult]]:
+        """Perform an LDAP search, yielding ``(dn, attributes)`` pairs as they arrive.
+
+        :param basedn: base DN on which to search
+        :type basedn: str
+
+        :param filterstr: a valid LDAP filter clause (e.g., ``(uid=jstanford)``)
+        :type filterstr: str
+
+        :param attrlist: a list of attributes to return
+        :type attrlist: list[str]
+
+        :param scope: the search scope; must be one "sub", "base", or "one".
+        :type scope: str
+
+        :param page_size: the number of entries the server should send per
+          page using the RFC 2696 simple paged results control; set to
+          ``None`` (or 0) to send no paging control; default: 500.
+        :type page_size: int
+
+        :param sort_by: if set, have the server sort the results by this
+          sort key or list of sort keys (see
+          :py:mod:`stanford.green.ldap.listing`); default: ``None``.
+        :type sort_by: str|list[str]
+
+        :param limits: if set, bound how long the search may take and how
+          many entries it may return (see
+          :py:mod:`stanford.green.ldap.limits`); default: ``None``.
+        :type limits: SearchLimits
+
+        :raises GreenLDAPSearchLimitException: after yielding the entries
+          received so far, if the search runs over one of ``limits``
+          (whatever ``limits.partial`` is).
+
+        Each entry is decoded with :py:meth:`~process_result` as soon as
+        it is received and then yielded, so memory use does not depend on
+        the size of the result. Paging also keeps large searches under
+        the server's size limit. For example, to walk the whole people tree::
+
+          for (dn, attributes) in ldap1.search_iter(BASEDN_PEOPLE, attrlist=['uid', 'displayName']):
+              print(dn, attributes)
+
+        Unlike :py:meth:`~search` this method does *not* raise
+        :py:exc:`~GreenLDAPNoResultsException`; a search with no results
+        simply yields nothing.
+
+        """
+        search_scope = self.scope_normalize(scope)
+        stats        = self._new_stats('search', basedn, filterstr, attrlist, scope)
+
+        extra_controls  = None if (sort_by is None) else [sort_control(sort_by)]
+        result_controls: list[Any] = []
+        for result in self._search_raw(basedn, search_scope, filterstr, attrlist,
+                                       page_size=page_size, stats=stats,
+                                       extra_controls=extra_controls, result_controls=result_controls,
+                                       limits=limits):
+            yield self._process_result_timed(result, stats)
+
+        check_sort_result(result_controls)
+
+    def search_window(
+            self,
+            basedn:     str,
+            sort_by:    str|list[str],
+            offset:     int=0,
+            count:      int=50,
+            filterstr:  str='(objectClass=*)',
+            attrlist:   Optional[list[str]]=None,
+            scope:      str='sub',
+            context_id: Optional[str]=None,
+    ) -> ListingPage:
+        """Return ``count`` entries of a sorted search starting at ``offset``.
+
+        :param basedn: base DN on which to search
+        :type basedn: str
 
-        logger.debug(f"ldap_result_id is {ldap_result_id}")
+        :param sort_by: the sort key or list of sort keys (see
+          :py:mod:`stanford.green.ldap.listing`), e.g., ``displayName``.
+        :type sort_by: str|list[str]
 
-        results = []
-        end_of_results = False
-        while not end_of_results:
+        :param offset: the position in the sorted result of the first
+          entry to return, counting from 0; default: 0.
+        :type offset: int
+
+        :param count: the number of entries to return; default: 50.
+        :type count: int
+
+        :param context_id: the ``context_id`` of the previous page of the
+          same listing, if any; default: ``None``.
+        :type context_id: str
+
+        The other parameters are the same as for :py:meth:`~search_iter`.
+
+        :return: the entries, decoded by :py:meth:`~process_result`, and
+          their position in the whole listing.
+        :rtype: ListingPage
+
+        :raises GreenLDAPListingException: if the server could not sort
+          or window the result.
+
+        The server sorts the result and sends only the entries asked for
+        using the server-side sort and virtual list view controls, so the
+        cost does not depend on the size of the listing. Unlike
+        :py:meth:`~search` this does not raise
+        :py:exc:`~GreenLDAPNoResultsException`; the page is just empty.
+        Results are never cached.
+        """
+        search_scope = self.scope_normalize(scope)
+        controls     = [sort_control(sort_by), view_control(offset, count, context_id)]
+
+        attempts = self._attempts()
+        for attempt in range(1, attempts + 1):
+            entries: dict[str, LDAPResult] = {}
+            result_controls: list[Any] = []
+            stats = self._new_stats('search_window', basedn, filterstr, attrlist, scope)
             try:
-                result_type, result_data = self.ldap.result(ldap_result_id, 0)
-            except ldap.NO_SUCH_OBJECT as _:
-                # No dn found, so nothing to add.
-                logger.error("no such object")
-                pass
+                for result in self._search_raw(basedn, search_scope, filterstr, attrlist, stats=stats,
+                                               extra_controls=controls, result_controls=result_controls):
+                    (dn, values) = self._process_result_timed(result, stats)
+                    entries[dn] = values
+            except ldap.SERVER_DOWN:
+                if (attempt == attempts):
+                    raise
+                logger.warning("LDAP connection is down; retrying search")
             else:
-                if result_type == ldap.RES_SEARCH_ENTRY:
-                    logger.debug("found an LDAP entry")
-                    results.append(result_data)
-                else:
-                    logger.debug("no more LDAP data")
-                    end_of_results = True
+                break
+
+        return ListingPage.from_response(entries, result_controls)
+
+    def search_page(
+            self,
+            basedn:    str,
+            sort_by:   str|list[str],
+            page:      int=1,
+            page_size: int=50,
+            filterstr: str='(objectClass=*)',
+            attrlist:  Optional[list[str]]=None,
+            scope:     str='sub',
+    ) -> ListingPage:
+        """Return page number ``page`` (counting from 1) of a sorted search.
+
+        This is :py:meth:`~search_window` with an ``offset`` of
+        ``(page - 1) * page_size`` and a ``count`` of ``page_size``.
+
+        :raises ValueError: if ``page`` is less than 1.
+        """
+        if (page < 1):
+            raise ValueError(f"page must be at least 1, not {page}")
 
-        logger.info(f"found {len(results)} results")
+        return self.search_window(basedn, sort_by, offset=(page - 1) * page_size, count=page_size,
+                                  filterstr=filterstr, attrlist=attrlist, scope=scope)
 
-        if (len(results) == 0):
+    def search_compact(
+            self,
+            basedn:    str,
+            filterstr: str='(objectClass=*)',
+            attrlist:  Optional[list[str]]=None,
+            scope:     str='sub',
+            page_size: Optional[int]=500,
+    ) -> CompactResultSet:
+        """Perform an LDAP search returning a memory-efficient result set.
+
+        The parameters are the same as for :py:meth:`~search_iter`.
+
+        :return: a read-only mapping from DN to entry with the same
+          content :py:meth:`~search` would return, but with repeated
+          attribute names and values stored once and values decoded only
+          when read (see :py:mod:`stanford.green.ldap.compact`).
+        :rtype: CompactResultSet
+
+        :raises GreenLDAPNoResultsException: if there are no results.
+
+        Use this for large (e.g., full-tree) searches whose results are
+        kept in memory. Results are never cached.
+        """
+        search_scope = self.scope_normalize(scope)
+
+        attempts = self._attempts()
+        for attempt in range(1, attempts + 1):
+            result_set = CompactResultSet(self.registry)
+            stats      = self._new_stats('search_compact', basedn, filterstr, attrlist, scope)
+            try:
+                for (dn, values) in self._search_raw(basedn, search_scope, filterstr, attrlist,
+                                                     page_size=page_size, stats=stats):
+                    if (stats is None):
+                        result_set.add(dn, values)
+                    else:
+                        decode_start = time.perf_counter()
+                        result_set.add(dn, values)
+                        stats.decode_seconds += time.perf_counter() - decode_start
+                result_set.finish()
+            except ldap.SERVER_DOWN:
+                if (attempt == attempts):
+                    raise
+                logger.warning("LDAP connection is down; retrying search")
+            else:
+                break
+
+        logger.info(f"found {len(result_set)} results")
+
+        if (len(result_set) == 0):
             msg = "no LDAP results"
             raise GreenLDAPNoResultsException(msg)
 
-        # Process the results
-        result_set = {}
-        for result in results:
-            # The result will be of the form [(dn, {attributes})]
-            (dn, attribute_values) = self.process_result(result[0])
-            result_set[dn] = attribute_values
+        return result_set
+
+    def search_multi(
+            self,
+            basedns:   list[str],
+            filterstr: str='(objectClass=*)',
+            attrlist:  Optional[list[str]]=None,
+            scope:     str='sub',
+    ) -> dict[str, LDAPResult]:
+        """Run the same search under several base DNs at once and merge the results.
+
+        :param basedns: the base DNs to search (e.g., ``[BASEDN_ACCOUNTS, BASEDN_PEOPLE]``)
+        :type basedns: list[str]
+
+        The other parameters are as for :py:meth:`~search`.
+
+        All the searches are sent before any result is read, so they are
+        in progress on the server at the same time and the whole call
+        takes about as long as the slowest of them. This is faster than
+        one search at a common ancestor (e.g., ``BASEDN``), which makes
+        the server walk subtrees that cannot hold any matches.
+
+        :raises GreenLDAPNoResultsException: if none of the searches has
+          any results.
+
+        If the object has a cache each base DN is cached separately,
+        under the same key :py:meth:`~search` would use, and only the
+        base DNs not found in the cache are searched. Identical
+        searches in flight at the same time are coalesced as in
+        :py:meth:`~search`, every caller getting its own copy of the
+        result.
+        """
+        result_set: dict[str, LDAPResult] = {}
+        uncached = list(basedns)
+
+        if (self.cache is not None):
+            uncached = []
+            for basedn in basedns:
+                cached = self.cache.get(search_key(basedn, filterstr, attrlist, scope))
+                if (cached is None):
+                    uncached.append(basedn)
+                elif (cached is not NO_RESULTS):
+                    result_set.update(cached)
+
+        if (uncached):
+            if (self.single_flight is None):
+                results_by_base = self._search_multi_server(uncached, filterstr, attrlist, scope)
+            else:
+                key = tuple(search_key(basedn, filterstr, attrlist, scope) for basedn in uncached)
+                results_by_base = self.single_flight.do(
+                    key,
+                    lambda: self._search_multi_server(uncached, filterstr, attrlist, scope),
+                    copy=lambda results: [copy_result_set(result) for result in results],
+                )
+
+            for base_result_set in results_by_base:
+                result_set.update(base_result_set)
+
+        logger.info(f"found {len(result_set)} results")
+
+        if (len(result_set) == 0):
+            msg = "no LDAP results"
+            raise GreenLDAPNoResultsException(msg)
 
         return result_set
 
+    def _search_multi_server(
+            self,
+            basedns:   list[str],
+            filterstr: str,
+            attrlist:  Optional[list[str]],
+            scope:     str,
+    ) -> list[dict[str, LDAPResult]]:
+        """Send the searches for :py:meth:`~search_multi`, caching each base DN's outcome.
+
+        :return: the results under each of ``basedns``, in order.
+        """
+        search_scope = self.scope_normalize(scope)
+
+        attempts = self._attempts()
+        for attempt in range(1, attempts + 1):
+            results_by_base: list[dict[str, LDAPResult]] = [{} for _ in basedns]
+            stats = self._new_stats('search_multi', ';'.join(basedns), filterstr, attrlist, scope)
+            try:
+                for (index, entry) in self._search_raw_multi(basedns, search_scope, filterstr, attrlist,
+                                                             stats=stats):
+                    (dn, attribute_values) = self._process_result_timed(entry, stats)
+                    results_by_base[index][dn] = attribute_values
+            except ldap.SERVER_DOWN:
+                if (attempt == attempts):
+                    raise
+                logger.warning("LDAP connection is down; retrying search")
+            else:
+                break
+
+        if (self.cache is not None):
+            for (basedn, base_result_set) in zip(basedns, results_by_base):
+                cache_key = search_key(basedn, filterstr, attrlist, scope)
+                if (len(base_result_set) == 0):
+                    self.cache.set_no_results(cache_key)
+                else:
+                    self.cache.set(cache_key, base_result_set)
+
+        return results_by_base
+
+    def _search_raw_multi(
+            self,
+            basedns:      list[str],
+            search_scope: Any,
+            filterstr:    str,
+            attrlist:     Optional[list[str]],
+            stats:        Optional[OperationStats] = None,
+    ) -> Iterator[Tuple[int, Tuple[str, dict[str, list[bytes]]]]]:
+        """Run one search per base DN concurrently on a single connection.
+
+        Yields ``(index, entry)`` pairs where ``index`` is the position in
+        ``basedns`` of the search that returned the (raw) entry. Every
+        search is sent before any result is read; the results of the
+        searches still running are buffered by the client library while
+        an earlier one is being read. ``stats`` is as for :py:meth:`~_search_raw`.
+        """
+        logger.debug(f"basedns:        {basedns}")
+        logger.debug(f"search scope:   {search_scope}")
+        logger.debug(f"search filter:  {filterstr}")
+        logger.debug(f"attribute list: {attrlist}")
+
+        start = time.perf_counter()
+        try:
+            with self.connection() as ldap_conn:
+                if (stats is not None):
+                    stats.bind_seconds = time.perf_counter() - start
+
+                outstanding: list[Tuple[int, int]] = []
+                try:
+                    for (index, basedn) in enumerate(basedns):
+                        msgid = ldap_conn.search_ext(basedn, search_scope, filterstr=filterstr, attrlist=attrlist)
+                        outstanding.append((index, msgid))
+
+                    while (outstanding):
+                        (index, msgid) = outstanding[0]
+                        try:
+                            (result_type, result_data, _msgid, _controls) = ldap_conn.result3(msgid, 0)
+                        except ldap.NO_SUCH_OBJECT:
+                            logger.error(f"no such object: {basedns[index]}")
+                            outstanding.pop(0)
+                            continue
+
+                        if (result_type == ldap.RES_SEARCH_ENTRY):
+                            if (stats is not None):
+                                stats.add_entries(result_data, start)
+                            for entry in result_data:
+                                yield (index, entry)
+                        elif (result_type == ldap.RES_SEARCH_REFERENCE):
+                            logger.debug("skipping search continuation reference")
+                        else:
+                            outstanding.pop(0)
+                finally:
+                    # Abandon any searches the caller did not read to the end.
+                    for (_index, msgid) in outstanding:
+                        ldap_conn.abandon(msgid)
+        except Exception as excpt:
+            if (stats is not None):
+                stats.error = type(excpt).__name__
+            raise
+        finally:
+            if (stats is not None):
+                stats.total_seconds = time.perf_counter() - start
+                self._report(stats)
+
+    def _search_raw(
+            self,
+            basedn:       str,
+            search_scope: Any,
+            filterstr:    str,
+            attrlist:     Optional[list[str]],
+            page_size:    Optional[int] = None,
+            stats:        Optional[OperationStats] = None,
+            extra_controls:  Optional[list[Any]] = None,
+            result_controls: Optional[list[Any]] = None,
+            limits:          Optional[SearchLimits] = None,
+    ) -> Iterator[Tuple[str, dict[str, list[bytes]]]]:
+        """Run a search on a single connection yielding the raw (undecoded) entries.
+
+        If ``stats`` is given it is filled in and passed to the hooks
+        when the search ends. ``extra_controls`` are sent with the search
+        (and with each page), and if ``result_controls`` is given it is
+        filled with the response controls of the last search result. If
+        the search runs over one of ``limits`` it is abandoned and a
+        :py:exc:`~stanford.green.ldap.limits.GreenLDAPSearchLimitException`
+        is raised.
+        """
+        logger.debug(f"basedn:         {basedn}")
+        logger.debug(f"search scope:   {search_scope}")
+        logger.debug(f"search filter:  {filterstr}")
+        logger.debug(f"attribute list: {attrlist}")
+
+        page_control = None
+        serverctrls  = list(extra_controls) if extra_controls else None
+        if (page_size):
+            page_control = SimplePagedResultsControl(True, size=page_size, cookie='')
+            serverctrls  = (serverctrls or []) + [page_control]
+
+        search_arguments = {} if (limits is None) else limits.search_arguments()
+        size_limit       = None if (limits is None) else limits.size_limit
+        entries          = 0
+
+        start    = time.perf_counter()
+        deadline = None if (limits is None) else limits.deadline(start)
+        try:
+            with self.connection() as ldap_conn:
+                if (stats is not None):
+                    stats.bind_seconds = time.perf_counter() - start
+
+                ldap_result_id = None
+                try:
+                    while True:
+                        ldap_result_id = ldap_conn.search_ext(
+                            basedn,
+                            search_scope,
+                            filterstr=filterstr,
+                            attrlist=attrlist,
+                            serverctrls=serverctrls,
+                            **search_arguments,
+                        )
+                        logger.debug(f"ldap_result_id is {ldap_result_id}")
+
+                        response_controls = []
+                        end_of_page = False
+                        while not end_of_page:
+                            timeout = None if (limits is None) else limits.result_timeout(deadline)
+                            try:
+                                (result_type, result_data,
+                                 _msgid, response_controls) = ldap_conn.result3(ldap_result_id, 0, timeout=timeout)
+                            except ldap.NO_SUCH_OBJECT as _:
+                                # No dn found, so nothing to add.
+                                logger.error("no such object")
+                                ldap_result_id = None
+                                return
+                            except ldap.TIMEOUT:
+                                if (limits is None):
+                                    raise
+                                msg = f"no result from the server within {timeout:.3g} seconds"
+                                raise GreenLDAPTimeLimitException(msg)
+                            except (ldap.SIZELIMIT_EXCEEDED, ldap.TIMELIMIT_EXCEEDED) as excpt:
+                                if (limits is None):
+                                    raise
+                                # The server has ended the search itself.
+                                ldap_result_id = None
+                                if (isinstance(excpt, ldap.SIZELIMIT_EXCEEDED)):
+                                    raise GreenLDAPSizeLimitException("the server stopped the search at its size limit")
+                                raise GreenLDAPTimeLimitException("the server stopped the search at its time limit")
+
+                            if (result_type == ldap.RES_SEARCH_ENTRY):
+                                logger.debug("found an LDAP entry")
+                                if (stats is not None):
+                                    stats.add_entries(result_data, start)
+                                for entry in result_data:
+                                    if ((size_limit is not None) and (entries >= size_limit)):
+                                        msg = f"search has more than {size_limit} entries"
+                                        raise GreenLDAPSizeLimitException(msg)
+                                    entries += 1
+                                    yield entry
+                            elif (result_type == ldap.RES_SEARCH_REFERENCE):
+                                logger.debug("skipping search continuation reference")
+                            else:
+                                end_of_page = True
+
+                        # The search is complete unless the server handed back
+                        # a cookie for the next page.
+                        ldap_result_id = None
+                        if (result_controls is not None):
+                            result_controls[:] = response_controls
+                        cookie = paged_results_cookie(response_controls)
+                        if ((page_control is None) or (not cookie)):
+                            logger.debug("no more LDAP data")
+                            return
+
+                        logger.debug("requesting next page of LDAP data")
+                        page_control.cookie = cookie
+                finally:
+                    # If the caller stopped iterating early tell the server to
+                    # stop sending entries we will never read.
+                    if (ldap_result_id is not None):
+                        ldap_conn.abandon(ldap_result_id)
+        except Exception as excpt:
+            if (stats is not None):
+                stats.error = type(excpt).__name__
+            raise
+        finally:
+            if (stats is not None):
+                stats.total_seconds = time.perf_counter() - start
+                self._report(stats)
+
     def sunetid_account_info(self, sunetid: str, attrlist:  Optional[list[str]]=None) -> dict[str, LDAPResult]:
         """Return the account tree information for user with uid equal to ``sunetid``.
 
@@ -724,8 +2018,293 @@ class LDAP():
         returned, so be sure to trap that error if your code is OK with
         getting no results.
 
+        The account and people trees are searched concurrently (see
+        :py:meth:`~search_multi`).
+
         """
-        basedn    = BASEDN
         filterstr = f"uid={sunetid}"
-        return self.search(basedn, filterstr=filterstr, attrlist=attrlist)
+        return self.search_multi([BASEDN_ACCOUNTS, BASEDN_PEOPLE], filterstr=filterstr, attrlist=attrlist)
+
+    def sunetid_account_info_many(
+            self,
+            sunetids:          list[str],
+            attrlist:          Optional[list[str]]=None,
+            chunk_size:        int=MANY_CHUNK_SIZE,
+            max_filter_length: int=MANY_MAX_FILTER_LENGTH,
+    ) -> Tuple[dict[str, dict[str, LDAPResult]], list[str]]:
+        """Return the account tree information for many users at once.
+
+        The batch version of :py:meth:`~sunetid_account_info`; see
+        :py:meth:`~sunetid_info_many` for the parameters and return value.
+        """
+        return self._sunetid_search_many([BASEDN_ACCOUNTS], sunetids, attrlist,
+                                         chunk_size, max_filter_length)
+
+    def sunetid_people_info_many(
+            self,
+            sunetids:          list[str],
+            attrlist:          Optional[list[str]]=None,
+            chunk_size:        int=MANY_CHUNK_SIZE,
+            max_filter_length: int=MANY_MAX_FILTER_LENGTH,
+    ) -> Tuple[dict[str, dict[str, LDAPResult]], list[str]]:
+        """Return the people tree information for many users at once.
+
+        The batch version of :py:meth:`~sunetid_people_info`; see
+        :py:meth:`~sunetid_info_many` for the parameters and return value.
+        """
+        return self._sunetid_search_many([BASEDN_PEOPLE], sunetids, attrlist,
+                                         chunk_size, max_filter_length)
+
+    def sunetid_info_many(
+            self,
+            sunetids:          list[str],
+            attrlist:          Optional[list[str]]=None,
+            chunk_size:        int=MANY_CHUNK_SIZE,
+            max_filter_length: int=MANY_MAX_FILTER_LENGTH,
+    ) -> Tuple[dict[str, dict[str, LDAPResult]], list[str]]:
+        """Return the people and accounts tree information for many users at once.
+
+        :param sunetids: sunetids of the users whose information you seek
+        :type sunetids: list[str]
+
+        :param attrlist: a list of attributes to return
+        :type attrlist: list[str]
+
+        :param chunk_size: the most sunetids to combine into one search
+          filter; default: ``MANY_CHUNK_SIZE``.
+        :type chunk_size: int
+
+        :param max_filter_length: the longest search filter (in characters)
+          to send; default: ``MANY_MAX_FILTER_LENGTH``.
+        :type max_filter_length: int
+
+        :return: a pair ``(results, missing)``. ``results`` maps each
+          sunetid that was found to the same dict :py:meth:`~sunetid_info`
+          would have returned for it; ``missing`` lists the sunetids for
+          which there were no results.
+        :rtype: tuple[dict, list[str]]
+
+        Rather than one search per sunetid, the sunetids are combined into
+        ``(|(uid=a)(uid=b)...)`` filters of at most ``chunk_size`` sunetids
+        each. If the server refuses a chunk because it exceeds a size or
+        administrative limit the chunk size is halved (for that and all
+        later chunks) and the chunk is tried again.
+
+        Unlike :py:meth:`~sunetid_info` this method does *not* raise
+        :py:exc:`~GreenLDAPNoResultsException`; sunetids with no results
+        are returned in ``missing`` instead::
+
+          (results, missing) = ldap1.sunetid_info_many(['jstanford', 'lstanford', 'nosuchuser'])
+          #
+          # results['jstanford'] == ldap1.sunetid_info('jstanford')
+          # missing == ['nosuchuser']
+
+        """
+        return self._sunetid_search_many([BASEDN_ACCOUNTS, BASEDN_PEOPLE], sunetids, attrlist,
+                                         chunk_size, max_filter_length)
+
+    def _sunetid_search_many(
+            self,
+            basedns:           list[str],
+            sunetids:          list[str],
+            attrlist:          Optional[list[str]],
+            chunk_size:        int,
+            max_filter_length: int,
+    ) -> Tuple[dict[str, dict[str, LDAPResult]], list[str]]:
+        # We need the uid of each entry to know which sunetid it belongs
+        # to, so ask for it even if the caller did not.
+        strip_uid = (attrlist is not None) and ('uid' not in attrlist)
+        if (attrlist is not None) and strip_uid:
+            search_attrlist: Optional[list[str]] = attrlist + ['uid']
+        else:
+            search_attrlist = attrlist
+
+        # Remove duplicates but keep the caller's order. LDAP matches uids
+        # case-insensitively so we match on the lower-cased value.
+        requested = {sunetid.lower(): sunetid for sunetid in sunetids}
+
+        found: dict[str, dict[str, LDAPResult]] = {}
+        pending = list(requested.values())
+        while (pending):
+            chunk = next(uid_filter_chunks(pending, chunk_size, max_filter_length))
+            filterstr = uid_filter(chunk)
+            stats     = self._new_stats('sunetid_search_many', ';'.join(basedns), filterstr, search_attrlist, 'sub')
+            try:
+                chunk_results = [self._process_result_timed(entry, stats) for (_index, entry) in
+                                 self._search_raw_multi(basedns, self.scope_normalize('sub'), filterstr,
+                                                        search_attrlist, stats=stats)]
+            except CHUNK_TOO_LARGE_EXCEPTIONS as excpt:
+                if (len(chunk) == 1):
+                    raise
+                chunk_size = max(1, len(chunk) // 2)
+                logger.info(f"server refused batch of {len(chunk)} sunetids ({excpt}); "
+                            f"reducing chunk size to {chunk_size}")
+                continue
+
+            pending = pending[len(chunk):]
+            for (dn, attribute_values) in chunk_results:
+                uid: Any = attribute_values.get('uid')
+                if (isinstance(uid, list)):
+                    uid = uid[0] if uid else None
+                if (uid is None) or (uid.lower() not in requested):
+                    logger.warning(f"cannot match entry {dn} to a requested sunetid")
+                    continue
+
+                if (strip_uid):
+                    del attribute_values['uid']
+
+                sunetid = requested[uid.lower()]
+                found.setdefault(sunetid, {})[dn] = attribute_values
+
+        results = {sunetid: found[sunetid] for sunetid in requested.values() if sunetid in found}
+        missing = [sunetid for sunetid in requested.values() if sunetid not in found]
+        logger.info(f"found {len(results)} of {len(requested)} sunetids")
+
+        return (results, missing)
+
+    def fetch_dns(
+            self,
+            dns:       list[str],
+            attrlist:  Optional[list[str]]=None,
+            window:    int=FETCH_WINDOW,
+            filterstr: str='(objectClass=*)',
+    ) -> Tuple[dict[str, LDAPResult], list[str]]:
+        """Return the entries with the given DNs, fetching many at a time.
+
+        :param dns: the DNs of the entries to fetch
+        :type dns: list[str]
+
+        :param attrlist: a list of attributes to return
+        :type attrlist: list[str]
+
+        :param window: the most searches to have outstanding at once;
+          default: ``FETCH_WINDOW``.
+        :type window: int
+
+        :param filterstr: a filter each entry must match to be returned
+          (e.g., ``(objectClass=suPerson)``); default: every entry.
+        :type filterstr: str
+
+        :return: a pair ``(results, missing)``. ``results`` maps each DN
+          that was found (spelled as in ``dns``) to its decoded attributes;
+          ``missing`` lists, in order, the DNs that do not exist, are not
+          valid DNs, or whose entries do not match ``filterstr``.
+        :rtype: tuple[dict, list[str]]
+
+        :raises ValueError: if ``window`` is less than 1.
+
+        Each DN is read with its own base-scope search, but rather than
+        waiting for each search to finish before sending the next, up to
+        ``window`` searches are kept in progress on one connection and
+        their results are taken in whatever order the server finishes
+        them. Resolving the DNs in a group's ``member`` attribute this
+        way costs about one round trip per ``window`` DNs rather than one
+        per DN.
+
+        Like the ``*_many`` methods this does not raise
+        :py:exc:`~GreenLDAPNoResultsException`::
+
+          (results, missing) = ldap1.fetch_dns(member_dns, attrlist=['uid', 'displayName'])
+
+        """
+        if (window < 1):
+            msg = f"window must be at least 1, not {window}"
+            raise ValueError(msg)
+
+        # Remove duplicates but keep the caller's order.
+        dns = list(dict.fromkeys(dns))
+
+        attempts = self._attempts()
+        for attempt in range(1, attempts + 1):
+            found: dict[str, LDAPResult] = {}
+            stats = self._new_stats('fetch_dns', f"{len(dns)} DNs", filterstr, attrlist, 'base')
+            try:
+                for (index, entry) in self._fetch_dns_raw(dns, filterstr, attrlist, window, stats=stats):
+                    (_dn, attribute_values) = self._process_result_timed(entry, stats)
+                    found[dns[index]] = attribute_values
+            except ldap.SERVER_DOWN:
+                if (attempt == attempts):
+                    raise
+                logger.warning("LDAP connection is down; retrying search")
+            else:
+                break
+
+        results = {dn: found[dn] for dn in dns if dn in found}
+        missing = [dn for dn in dns if dn not in found]
+        logger.info(f"found {len(results)} of {len(dns)} DNs")
+
+        return (results, missing)
+
+    def _fetch_dns_raw(
+            self,
+            dns:       list[str],
+            filterstr: str,
+            attrlist:  Optional[list[str]],
+            window:    int,
+            stats:     Optional[OperationStats] = None,
+    ) -> Iterator[Tuple[int, Tuple[str, dict[str, list[bytes]]]]]:
+        """Run a base-scope search for each of ``dns`` keeping ``window`` of them outstanding.
+
+        Yields ``(index, entry)`` pairs where ``index`` is the position in
+        ``dns`` of the search that returned the (raw) entry, in the order
+        the results arrive. A search that fails with one of
+        ``MISSING_DN_EXCEPTIONS`` yields nothing. ``stats`` is as for
+        :py:meth:`~_search_raw`.
+        """
+        logger.debug(f"number of DNs:  {len(dns)}")
+        logger.debug(f"window:         {window}")
+        logger.debug(f"search filter:  {filterstr}")
+        logger.debug(f"attribute list: {attrlist}")
 
+        start = time.perf_counter()
+        try:
+            with self.connection() as ldap_conn:
+                if (stats is not None):
+                    stats.bind_seconds = time.perf_counter() - start
+
+                # msgid -> index into dns of the searches not yet finished.
+                outstanding: dict[int, int] = {}
+                next_index = 0
+                try:
+                    while ((next_index < len(dns)) or outstanding):
+                        while ((next_index < len(dns)) and (len(outstanding) < window)):
+                            msgid = ldap_conn.search_ext(dns[next_index], ldap.SCOPE_BASE,
+                                                         filterstr=filterstr, attrlist=attrlist)
+                            outstanding[msgid] = next_index
+                            next_index += 1
+
+                        try:
+                            (result_type, result_data, msgid, _controls) = ldap_conn.result3(ldap.RES_ANY, 0)
+                        except MISSING_DN_EXCEPTIONS as excpt:
+                            # The error belongs to one search; find which
+                            # from the msgid python-ldap attaches to it.
+                            info  = excpt.args[0] if (excpt.args and isinstance(excpt.args[0], dict)) else {}
+                            index = outstanding.pop(info.get('msgid', -1), None)
+                            if (index is None):
+                                raise
+                            logger.debug(f"no such object: {dns[index]}")
+                            continue
+
+                        if (msgid not in outstanding):
+                            logger.debug(f"ignoring result for unknown message id {msgid}")
+                        elif (result_type == ldap.RES_SEARCH_ENTRY):
+                            if (stats is not None):
+                                stats.add_entries(result_data, start)
+                            for entry in result_data:
+                                yield (outstanding[msgid], entry)
+                        elif (result_type == ldap.RES_SEARCH_REFERENCE):
+                            logger.debug("skipping search continuation reference")
+                        else:
+                            del outstanding[msgid]
+                finally:
+                    # Abandon any searches the caller did not read to the end.
+                    for msgid in outstanding:
+                        ldap_conn.abandon(msgid)
+        except Exception as excpt:
+            if (stats is not None):
+                stats.error = type(excpt).__name__
+            raise
+        finally:
+            if (stats is not None):
+                stats.total_seconds = time.perf_counter() - start
+                self._report(stats)
@@ -0,0 +1,327 @@
+"""An asyncio LDAP client.
+
+--------
+Overview
+--------
+
+:py:class:`AsyncLDAP` offers the search methods of
+:py:class:`stanford.green.ldap.LDAP` as coroutines. All searches share one
+connection: each search is sent with python-ldap's asynchronous
+``search_ext`` call and its results are collected by message id, so many
+searches can be in flight at once without a thread per search.
+
+The connection's file descriptor is watched by the event loop; when it
+becomes readable every result that has arrived is read (without blocking)
+and handed to the search waiting for it. Because the SASL layer may have
+already read data off the socket, the connection is also polled every
+``poll_interval`` seconds while searches are outstanding. Neither is done
+while no search is outstanding.
+
+If the connection breaks, every outstanding search raises the error and
+the connection is no longer watched.
+
+Only the bind (done once by :py:meth:`AsyncLDAP.open`) runs in a thread.
+
+--------
+Examples
+--------
+
+Look up several users concurrently::
+
+  import asyncio
+  from stanford.green.ldap     import BASEDN_PEOPLE
+  from stanford.green.ldap.aio import AsyncLDAP
+
+  async def main():
+      async with AsyncLDAP() as ldap1:
+          results = await asyncio.gather(
+              ldap1.sunetid_info('jstanford'),
+              ldap1.sunetid_info('lstanford'),
+          )
+
+          async for (dn, attributes) in ldap1.search_iter(BASEDN_PEOPLE, filterstr='(sn=Stanford)'):
+              print(dn)
+
+  asyncio.run(main())
+
+"""
+import asyncio
+import logging
+
+import ldap      # type: ignore
+from ldap.controls import SimplePagedResultsControl  # type: ignore
+
+from stanford.green.ldap import LDAP, LDAPResult, GreenLDAPNoResultsException
+from stanford.green.ldap import BASEDN_ACCOUNTS, BASEDN_PEOPLE
+from stanford.green.ldap import paged_results_cookie
+
+## TYPING
+from types import TracebackType
+from typing import Any, AsyncIterator, Optional, Tuple, Type
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+class AsyncLDAP():
+    """An asyncio LDAP client sharing one connection between many searches.
+
+    :param host: the LDAP host name, defaults to ``ldap.stanford.edu``
+    :type host: str
+
+    :param max_outstanding: the most searches allowed in flight on the
+      connection at once; further searches wait their turn; default: 256.
+    :type max_outstanding: int
+
+    :param poll_interval: while searches are outstanding, also poll the
+      connection every this many seconds; default: 0.05.
+    :type poll_interval: float
+
+    The connection is made by :py:meth:`open` (or by entering the object
+    as an asynchronous context manager), not on object creation.
+
+    """
+
+    def __init__(self,
+                 host:            str = 'ldap.stanford.edu',
+                 max_outstanding: int = 256,
+                 poll_interval:   float = 0.05):
+        self.host            = host
+        self.max_outstanding = max_outstanding
+        self.poll_interval   = poll_interval
+
+        # We borrow connect(), scope_normalize(), and process_result()
+        # from a (never connected) synchronous LDAP object.
+        self.sync = LDAP(host=host, connect_on_init=False)
+
+        self.ldap: Any = None
+        self._queues: dict[int, asyncio.Queue[Any]] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._poller: Optional[asyncio.Task[None]] = None
+        self._reading = False
+        self._fd      = -1
+
+    async def open(self) -> None:
+        """Connect and bind (the bind runs in the default executor)."""
+        self._loop      = asyncio.get_running_loop()
+        self.ldap       = await self._loop.run_in_executor(None, self.sync.connect)
+        self._semaphore = asyncio.Semaphore(self.max_outstanding)
+
+    async def close(self) -> None:
+        """Stop watching the connection and unbind."""
+        self._stop_reading()
+
+        if ((self.ldap is not None) and (self._loop is not None)):
+            await self._loop.run_in_executor(None, self.ldap.unbind_s)
+            self.ldap = None
+
+    async def __aenter__(self) -> 'AsyncLDAP':
+        await self.open()
+        return self
+
+    async def __aexit__(self,
+                        exc_type: Optional[Type[BaseException]],
+                        exc:      Optional[BaseException],
+                        tb:       Optional[TracebackType]) -> None:
+        await self.close()
+
+    ## Dispatching results to the waiting searches
+
+    def _start_reading(self) -> None:
+        if ((not self._reading) and (self._loop is not None)):
+            self._fd = self.ldap.fileno()
+            self._loop.add_reader(self._fd, self._drain)
+            self._reading = True
+            self._poller  = self._loop.create_task(self._poll())
+
+    def _stop_reading(self) -> None:
+        # We only watch the descriptor while searches are outstanding: a
+        # closed connection is always readable and would spin the loop.
+        if (self._reading and (self._loop is not None)):
+            self._loop.remove_reader(self._fd)
+            self._reading = False
+
+        if (self._poller is not None):
+            self._poller.cancel()
+            self._poller = None
+
+    def _register(self, msgid: int) -> asyncio.Queue[Any]:
+        queue: asyncio.Queue[Any] = asyncio.Queue()
+        self._queues[msgid] = queue
+        self._start_reading()
+        return queue
+
+    def _unregister(self, msgid: int, abandon: bool) -> None:
+        # The queue is gone already if the connection broke (see _drain),
+        # in which case there is nothing to abandon.
+        if ((self._queues.pop(msgid, None) is not None) and abandon):
+            self.ldap.abandon(msgid)
+
+        if (not self._queues):
+            self._stop_reading()
+
+    def _drain(self) -> None:
+        """Read every result that has already arrived, without blocking."""
+        while (self._queues):
+            try:
+                (result_type, result_data,
+                 msgid, response_controls) = self.ldap.result3(ldap.RES_ANY, 0, 0)
+            except ldap.LDAPError as excpt:
+                # Errors for a single search carry its message id.
+                info  = excpt.args[0] if (excpt.args and isinstance(excpt.args[0], dict)) else {}
+                msgid = info.get('msgid')
+                if (msgid in self._queues):
+                    self._queues[msgid].put_nowait(excpt)
+                    continue
+
+                # Otherwise the whole connection is broken: fail every
+                # search and stop watching it.
+                logger.error(f"LDAP connection error: {excpt}")
+                for queue in self._queues.values():
+                    queue.put_nowait(excpt)
+                self._queues.clear()
+                self._stop_reading()
+                return
+
+            if (result_type is None):
+                # Nothing more has arrived.
+                return
+
+            if (msgid in self._queues):
+                self._queues[msgid].put_nowait((result_type, result_data, response_controls))
+            else:
+                logger.debug(f"dropping result for unknown message id {msgid}")
+
+    async def _poll(self) -> None:
+        # Runs only while searches are outstanding (see _start_reading).
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self._drain()
+
+    ## Searching
+
+    async def search_iter(
+            self,
+            basedn:    str,
+            filterstr: str='(objectClass=*)',
+            attrlist:  Optional[list[str]]=None,
+            scope:     str='sub',
+            page_size: Optional[int]=500,
+    ) -> AsyncIterator[Tuple[str, LDAPResult]]:
+        """Asynchronous version of :py:meth:`stanford.green.ldap.LDAP.search_iter`.
+
+        Use with ``async for``; yields ``(dn, attributes)`` pairs as they
+        arrive and yields nothing if there are no results.
+        """
+        if ((self.ldap is None) or (self._semaphore is None)):
+            msg = "AsyncLDAP object is not open"
+            raise RuntimeError(msg)
+
+        search_scope = self.sync.scope_normalize(scope)
+
+        page_control = None
+        serverctrls  = None
+        if (page_size):
+            page_control = SimplePagedResultsControl(True, size=page_size, cookie='')
+            serverctrls  = [page_control]
+
+        async with self._semaphore:
+            while True:
+                msgid = self.ldap.search_ext(
+                    basedn,
+                    search_scope,
+                    filterstr=filterstr,
+                    attrlist=attrlist,
+                    serverctrls=serverctrls,
+                )
+                queue = self._register(msgid)
+
+                # Data may have arrived before we started watching.
+                self._drain()
+
+                response_controls: list[Any] = []
+                finished = False
+                try:
+                    while not finished:
+                        item = await queue.get()
+                        if (isinstance(item, ldap.NO_SUCH_OBJECT)):
+                            logger.error("no such object")
+                            finished = True
+                            return
+                        elif (isinstance(item, Exception)):
+                            finished = True
+                            raise item
+
+                        (result_type, result_data, response_controls) = item
+                        if (result_type == ldap.RES_SEARCH_ENTRY):
+                            for entry in result_data:
+                                yield self.sync.process_result(entry)
+                        elif (result_type == ldap.RES_SEARCH_REFERENCE):
+                            logger.debug("skipping search continuation reference")
+                        else:
+                            finished = True
+                finally:
+                    self._unregister(msgid, abandon=(not finished))
+
+                cookie = paged_results_cookie(response_controls)
+                if ((page_control is None) or (not cookie)):
+                    return
+
+                page_control.cookie = cookie
+
+    async def search(
+            self,
+            basedn:    str,
+            filterstr: str='(objectClass=*)',
+            attrlist:  Optional[list[str]]=None,
+            scope:     str='sub',
+            page_size: Optional[int]=None,
+    ) -> dict[str, LDAPResult]:
+        """Asynchronous version of :py:meth:`stanford.green.ldap.LDAP.search`.
+
+        :raises GreenLDAPNoResultsException: if there are no results.
+        """
+        result_set = {}
+        async for (dn, attribute_values) in self.search_iter(basedn, filterstr=filterstr, attrlist=attrlist,
+                                                             scope=scope, page_size=page_size):
+            result_set[dn] = attribute_values
+
+        logger.info(f"found {len(result_set)} results")
+
+        if (len(result_set) == 0):
+            msg = "no LDAP results"
+            raise GreenLDAPNoResultsException(msg)
+
+        return result_set
+
+    async def sunetid_account_info(self, sunetid: str, attrlist: Optional[list[str]]=None) -> dict[str, LDAPResult]:
+        """Asynchronous version of :py:meth:`stanford.green.ldap.LDAP.sunetid_account_info`."""
+        return await self.search(BASEDN_ACCOUNTS, filterstr=f"uid={sunetid}", attrlist=attrlist)
+
+    async def sunetid_people_info(self, sunetid: str, attrlist: Optional[list[str]]=None) -> dict[str, LDAPResult]:
+        """Asynchronous version of :py:meth:`stanford.green.ldap.LDAP.sunetid_people_info`."""
+        return await self.search(BASEDN_PEOPLE, filterstr=f"uid={sunetid}", attrlist=attrlist)
+
+    async def sunetid_info(self, sunetid: str, attrlist: Optional[list[str]]=None) -> dict[str, LDAPResult]:
+        """Asynchronous version of :py:meth:`stanford.green.ldap.LDAP.sunetid_info`.
+
+        The account and people trees are searched concurrently.
+        """
+        filterstr = f"uid={sunetid}"
+
+        async def collect(basedn: str) -> dict[str, LDAPResult]:
+            return {dn: attribute_values async for (dn, attribute_values)
+                    in self.search_iter(basedn, filterstr=filterstr, attrlist=attrlist)}
+
+        result_set = {}
+        for base_result_set in await asyncio.gather(collect(BASEDN_ACCOUNTS), collect(BASEDN_PEOPLE)):
+            result_set.update(base_result_set)
+
+        logger.info(f"found {len(result_set)} results")
+
+        if (len(result_set) == 0):
+            msg = "no LDAP results"
+            raise GreenLDAPNoResultsException(msg)
+
+        return result_set
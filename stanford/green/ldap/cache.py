@@ -0,0 +1,289 @@
+"""A tiered, TTL-based cache for LDAP search results.
+
+.. _diskcache: https://pypi.org/project/diskcache/
+
+--------
+Overview
+--------
+
+:py:class:`LDAPResultCache` caches the results of
+:py:meth:`stanford.green.ldap.LDAP.search` (and so of the
+``sunetid_*_info`` methods built on it). There are two tiers:
+
+1. an in-process LRU cache where each entry expires ``ttl`` seconds
+   after it was stored, and
+
+2. (optionally) a `diskcache <diskcache_>`_ cache in ``directory`` which
+   can be shared by every worker process on a host.
+
+Searches that found nothing are cached too (for ``negative_ttl``
+seconds), so a repeated lookup of a non-existent sunetid raises
+:py:exc:`~stanford.green.ldap.GreenLDAPNoResultsException` without
+going to the server.
+
+Cache keys are built by :py:func:`search_key` which normalizes the base
+DN, filter, attribute list, and scope so that equivalent searches share
+an entry.
+
+--------
+Examples
+--------
+
+Cache lookups for five minutes in-process and in a directory shared
+by all workers::
+
+  from stanford.green.ldap       import LDAP
+  from stanford.green.ldap.cache import LDAPResultCache
+
+  cache = LDAPResultCache(maxsize=10000, ttl=300, directory='/var/cache/myapp/ldap')
+  ldap1 = LDAP(cache=cache)
+
+  ldap1.sunetid_info('jstanford')  # goes to the server
+  ldap1.sunetid_info('jstanford')  # served from the cache
+
+  print(cache.stats())
+
+"""
+import collections
+import logging
+import threading
+import time
+
+# diskcache does not have type hint support, so tell the type checker to
+# ignore it.
+from diskcache import Cache   # type: ignore
+
+## TYPING
+from typing import Any, Optional, Tuple
+SearchKey = Tuple[str, str, Tuple[str, ...], str]
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+# Returned by LDAPResultCache.get() for a cached "no results" search.
+NO_RESULTS = object()
+
+# What we store in the disk tier for a cached "no results" search (it
+# has to survive pickling, so it cannot be NO_RESULTS itself).
+_DISK_NO_RESULTS = '__stanford_green_ldap_no_results__'
+
+_SCOPE_ALIASES = {
+    'subtree':  'sub',
+    'onelevel': 'one',
+}
+
+def search_key(
+        basedn:    str,
+        filterstr: str,
+        attrlist:  Optional[list[str]],
+        scope:     str,
+) -> SearchKey:
+    """Return a normalized, hashable key for a search.
+
+    :param basedn: base DN of the search
+    :type basedn: str
+
+    :param filterstr: the LDAP filter
+    :type filterstr: str
+
+    :param attrlist: the list of attributes requested (``None`` means all)
+    :type attrlist: list[str]
+
+    :param scope: the search scope ("sub", "base", "one", or an alias)
+    :type scope: str
+
+    :return: a tuple that is the same for searches that differ only in
+      the case and spacing of the base DN, the order, case, or
+      duplication of the attributes, a missing pair of parentheses
+      around the filter, or the choice of scope alias.
+
+    """
+    basedn = ','.join(rdn.strip() for rdn in basedn.split(',')).lower()
+
+    filterstr = filterstr.strip()
+    if (not filterstr.startswith('(')):
+        filterstr = f"({filterstr})"
+
+    if (attrlist is None):
+        attributes: Tuple[str, ...] = ('*',)
+    else:
+        attributes = tuple(sorted({attribute.lower() for attribute in attrlist}))
+
+    scope = _SCOPE_ALIASES.get(scope, scope)
+
+    return (basedn, filterstr, attributes, scope)
+
+def copy_result_set(result_set: dict[str, Any]) -> dict[str, Any]:
+    """Return a copy of a search result that shares no mutable parts with it."""
+    return {
+        dn: {attribute: (list(value) if isinstance(value, list) else value)
+             for (attribute, value) in attribute_values.items()}
+        for (dn, attribute_values) in result_set.items()
+    }
+
+
+class LDAPResultCache():
+    """A two-tier (in-process LRU plus optional diskcache) cache of search results.
+
+    :param maxsize: the most entries held in the in-process tier; the
+      least-recently used entry is evicted to make room; default: 1024.
+    :type maxsize: int
+
+    :param ttl: seconds a result stays cached; default: 300.
+    :type ttl: float
+
+    :param negative_ttl: seconds a search that found nothing stays
+      cached; set to 0 to not cache such searches; default: 60.
+    :type negative_ttl: float
+
+    :param directory: if set, also cache results in a diskcache
+      ``Cache`` in this directory (shared by all processes using the
+      same directory); default: ``None`` (in-process tier only).
+    :type directory: str
+
+    The cache is thread-safe. The counters returned by :py:meth:`stats`
+    are ``hits`` (of which ``disk_hits`` came from the disk tier and
+    ``negative_hits`` were cached "no results"), ``misses``,
+    ``evictions`` (entries pushed out of the in-process tier), and
+    ``expirations`` (entries dropped because their TTL passed).
+
+    """
+    def __init__(self,
+                 maxsize:      int   = 1024,
+                 ttl:          float = 300.0,
+                 negative_ttl: float = 60.0,
+                 directory:    Optional[str] = None):
+        self.maxsize      = maxsize
+        self.ttl          = ttl
+        self.negative_ttl = negative_ttl
+
+        self._lock = threading.Lock()
+        self._entries: collections.OrderedDict[SearchKey, Tuple[float, Any]] = collections.OrderedDict()
+
+        self.disk_cache: Optional[Cache] = None
+        if (directory is not None):
+            self.disk_cache = Cache(directory)
+
+        self._stats = {
+            'hits':          0,
+            'disk_hits':     0,
+            'negative_hits': 0,
+            'misses':        0,
+            'evictions':     0,
+            'expirations':   0,
+        }
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _memory_set(self, key: SearchKey, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while (len(self._entries) > self.maxsize):
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def _memory_get(self, key: SearchKey) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None):
+                return None
+
+            (expires_at, value) = entry
+            if (expires_at <= time.monotonic()):
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def _disk_get(self, key: SearchKey) -> Any:
+        if (self.disk_cache is None):
+            return None
+
+        missing = object()
+        (value, expire_time) = self.disk_cache.get(key, default=missing, expire_time=True)
+        if (value is missing):
+            return None
+
+        if (value == _DISK_NO_RESULTS):
+            value = NO_RESULTS
+            ttl   = self.negative_ttl
+        else:
+            ttl   = self.ttl
+
+        # Promote to the in-process tier, but no longer than the disk entry
+        # itself has left to live.
+        if (expire_time is not None):
+            ttl = min(ttl, expire_time - time.time())
+        if (ttl > 0):
+            self._memory_set(key, value, ttl)
+
+        self._count('disk_hits')
+        return value
+
+    def get(self, key: SearchKey) -> Any:
+        """Return the cached result for ``key``.
+
+        :return: a copy of the cached result set, :py:data:`NO_RESULTS` if
+          it is cached that the search found nothing, or ``None`` if there
+          is no (unexpired) cache entry.
+        """
+        value = self._memory_get(key)
+        if (value is None):
+            value = self._disk_get(key)
+
+        if (value is None):
+            self._count('misses')
+            return None
+
+        self._count('hits')
+        if (value is NO_RESULTS):
+            self._count('negative_hits')
+            return NO_RESULTS
+        else:
+            return copy_result_set(value)
+
+    def set(self, key: SearchKey, result_set: dict[str, Any]) -> None:
+        """Cache ``result_set`` (a copy of it) as the result of the search ``key``."""
+        value = copy_result_set(result_set)
+        self._memory_set(key, value, self.ttl)
+        if (self.disk_cache is not None):
+            self.disk_cache.set(key, value, expire=self.ttl)
+
+    def set_no_results(self, key: SearchKey) -> None:
+        """Record that the search ``key`` found nothing."""
+        if (self.negative_ttl <= 0):
+            return
+
+        self._memory_set(key, NO_RESULTS, self.negative_ttl)
+        if (self.disk_cache is not None):
+            self.disk_cache.set(key, _DISK_NO_RESULTS, expire=self.negative_ttl)
+
+    def invalidate(self, key: SearchKey) -> None:
+        """Remove the search ``key`` from both tiers."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+        if (self.disk_cache is not None):
+            self.disk_cache.delete(key)
+
+    def clear(self) -> None:
+        """Remove every entry from both tiers."""
+        with self._lock:
+            self._entries.clear()
+
+        if (self.disk_cache is not None):
+            self.disk_cache.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Return a snapshot of the cache counters plus the current ``size``."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+
+        return stats
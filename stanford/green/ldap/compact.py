@@ -0,0 +1,202 @@
+"""Compact, lazily-decoded LDAP search results.
+
+--------
+Overview
+--------
+
+:py:meth:`stanford.green.ldap.LDAP.search` returns one dict per entry,
+each holding freshly decoded strings. For full-tree searches most of that
+memory is repetition: every entry has the same attribute names, and values
+like ``suAffiliation`` or ``suPrivilegeGroup`` are shared by thousands of
+people.
+
+:py:class:`CompactResultSet` (returned by
+:py:meth:`stanford.green.ldap.LDAP.search_compact`) stores instead
+
+* one :py:class:`EntryShape` per distinct set of attribute names, shared
+  by every entry with those attributes,
+
+* per entry, a :py:class:`CompactEntry` with ``__slots__`` holding only
+  its shape and a tuple of raw values (a byte-string for a single-valued
+  attribute, a tuple of byte-strings for a multi-valued one), and
+
+* each distinct raw value (and each distinct tuple of values) once.
+
+Values stay as byte-strings until an attribute is read; they are then
+decoded exactly as :py:meth:`~stanford.green.ldap.LDAP.process_result`
+would (a string for single-valued attributes, a list of strings for
+multi-valued ones).
+
+Both classes are read-only mappings, so code written for the dict
+results keeps working::
+
+  results = ldap1.search_compact(BASEDN_PEOPLE, attrlist=['uid', 'suAffiliation'])
+  for (dn, entry) in results.items():
+      print(dn, entry['uid'], entry.get('suAffiliation', []))
+
+  plain = results.to_dict()   # the same value search() would have returned
+
+"""
+from collections.abc import Mapping
+
+from stanford.green.ldap.schema import AttributeRegistry, decode_lenient
+
+## TYPING
+from typing import Any, Iterator, Optional, Tuple
+## END OF TYPING
+
+class EntryShape():
+    """The attribute layout shared by every entry with the same attribute names.
+
+    :ivar names: the attribute names, in the order their raw values are stored.
+    :ivar positions: maps each attribute name to its index in ``names``.
+    :ivar single_valued: for each attribute, whether it is single-valued.
+    :ivar binary: for each attribute, whether its values stay undecoded.
+    :ivar lenient: for each attribute, whether values that are not valid
+      UTF-8 stay undecoded (as for attributes the registry does not know).
+    """
+    __slots__ = ('names', 'positions', 'single_valued', 'binary', 'lenient')
+
+    def __init__(self,
+                 names:         Tuple[str, ...],
+                 single_valued: Tuple[bool, ...],
+                 binary:        Tuple[bool, ...],
+                 lenient:       Optional[Tuple[bool, ...]] = None):
+        self.names         = names
+        self.positions     = {name: position for (position, name) in enumerate(names)}
+        self.single_valued = single_valued
+        self.binary        = binary
+        self.lenient       = lenient if (lenient is not None) else (False,) * len(names)
+
+    def decode(self, position: int, raw: Any) -> Any:
+        """Decode the raw value(s) of the attribute at ``position``.
+
+        For single-valued attributes ``raw`` is a byte-string, for
+        multi-valued attributes a tuple of byte-strings.
+        """
+        if (self.binary[position]):
+            return raw if self.single_valued[position] else list(raw)
+        elif (self.lenient[position]):
+            return [decode_lenient(value) for value in raw]
+        elif (self.single_valued[position]):
+            return raw.decode("utf-8")
+        else:
+            return [value.decode("utf-8") for value in raw]
+
+
+class CompactEntry(Mapping[str, Any]):
+    """A read-only, lazily-decoded view of one entry's attributes."""
+    __slots__ = ('_shape', '_raw')
+
+    def __init__(self, shape: EntryShape, raw: Tuple[Any, ...]):
+        self._shape = shape
+        self._raw   = raw
+
+    def __getitem__(self, attribute: str) -> Any:
+        position = self._shape.positions[attribute]
+        return self._shape.decode(position, self._raw[position])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._shape.names)
+
+    def __len__(self) -> int:
+        return len(self._shape.names)
+
+    def __repr__(self) -> str:
+        return f"CompactEntry({self.to_dict()!r})"
+
+    def raw(self, attribute: str) -> Any:
+        """Return the undecoded value (or tuple of values) of ``attribute``."""
+        return self._raw[self._shape.positions[attribute]]
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return the entry decoded into a plain dict."""
+        shape = self._shape
+        return {name: shape.decode(position, raw)
+                for (position, (name, raw)) in enumerate(zip(shape.names, self._raw))}
+
+
+class CompactResultSet(Mapping[str, CompactEntry]):
+    """A read-only mapping from DN to :py:class:`CompactEntry`.
+
+    :param registry: the registry used to decide how each attribute is
+      decoded (normally the searching ``LDAP`` object's registry).
+    :type registry: AttributeRegistry
+
+    """
+    def __init__(self, registry: AttributeRegistry):
+        self.registry = registry
+
+        self._entries: dict[str, CompactEntry] = {}
+        self._shapes:  dict[Tuple[str, ...], EntryShape] = {}
+
+        # The intern pools: while the result set is being built every
+        # distinct raw value and every distinct tuple of raw values is
+        # stored once. finish() drops the pools themselves.
+        self._values: dict[bytes, bytes] = {}
+        self._value_tuples: dict[Tuple[bytes, ...], Tuple[bytes, ...]] = {}
+        self._distinct_values = 0
+
+    def _shape(self, attribute_names: Tuple[str, ...]) -> EntryShape:
+        shape = self._shapes.get(attribute_names)
+        if (shape is None):
+            plan  = self.registry.decoding_plan(attribute_names)
+            pairs = plan.text + plan.binary + plan.unknown
+            shape = EntryShape(
+                tuple(name for (name, _) in pairs),
+                tuple(single_valued for (_, single_valued) in pairs),
+                tuple([False] * len(plan.text) + [True] * len(plan.binary) + [False] * len(plan.unknown)),
+                tuple([False] * (len(plan.text) + len(plan.binary)) + [True] * len(plan.unknown)),
+            )
+            self._shapes[attribute_names] = shape
+
+        return shape
+
+    def add(self, dn: str, values: dict[str, list[bytes]]) -> None:
+        """Add the raw entry ``(dn, values)`` as returned by python-ldap."""
+        shape = self._shape(tuple(values))
+
+        intern_value = self._values.setdefault
+        intern_tuple = self._value_tuples.setdefault
+
+        raw: list[Any] = []
+        for (name, single_valued) in zip(shape.names, shape.single_valued):
+            if (single_valued):
+                value = values[name][0]
+                raw.append(intern_value(value, value))
+            else:
+                value_tuple = tuple(intern_value(value, value) for value in values[name])
+                raw.append(intern_tuple(value_tuple, value_tuple))
+
+        self._entries[dn] = CompactEntry(shape, tuple(raw))
+
+    def __getitem__(self, dn: str) -> CompactEntry:
+        return self._entries[dn]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def finish(self) -> None:
+        """Release the intern pools once all entries have been added.
+
+        Entries added after this are still correct but no longer share
+        values with the entries added before.
+        """
+        self._distinct_values = len(self._values)
+        self._values       = {}
+        self._value_tuples = {}
+
+    def to_dict(self) -> dict[str, dict[str, Any]]:
+        """Return the whole result set decoded into plain dicts."""
+        return {dn: entry.to_dict() for (dn, entry) in self._entries.items()}
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of ``entries``, distinct ``shapes``, and distinct ``values``."""
+        return {
+            'entries': len(self._entries),
+            'shapes':  len(self._shapes),
+            'values':  max(self._distinct_values, len(self._values)),
+        }
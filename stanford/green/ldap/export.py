@@ -0,0 +1,390 @@
+"""Stream LDAP search results to JSON Lines, CSV, or Parquet files.
+
+.. _pyarrow: https://pypi.org/project/pyarrow/
+
+--------
+Overview
+--------
+
+:py:func:`export_search` runs a search with
+:py:meth:`stanford.green.ldap.LDAP.search_iter` and hands each decoded
+entry to a *writer* as soon as it arrives, so memory use is bounded by
+the writer's batch size rather than by the size of the tree. Three
+writers are provided:
+
+* :py:class:`JSONLinesWriter`: one JSON object per line, with the
+  entry's DN in the ``dn`` key and the attributes exactly as
+  :py:meth:`~stanford.green.ldap.LDAP.search` returns them.
+
+* :py:class:`CSVWriter`: one row per entry with a ``dn`` column followed
+  by one column per attribute; the values of multi-valued attributes are
+  joined with a separator.
+
+* :py:class:`ParquetWriter`: a Parquet file with a ``dn`` column and one
+  column per attribute (a list of strings for multi-valued attributes),
+  written a batch at a time. This writer needs the
+  `pyarrow <pyarrow_>`_ package (``pip install stanford_green[parquet]``).
+
+Columns are matched to attributes ignoring case, as LDAP attribute names
+are, so an ``attrlist`` of ``['displayname']`` still finds the
+``displayName`` values the server sends. Values of binary attributes are
+written base64-encoded. JSON Lines and
+CSV output can be compressed with ``gzip``, ``bz2``, or
+``xz``; Parquet output with any codec Parquet supports.
+
+--------
+Examples
+--------
+
+Dump the people tree::
+
+  from stanford.green.ldap        import LDAP, BASEDN_PEOPLE
+  from stanford.green.ldap.export import export
+
+  ldap1 = LDAP()
+  attrlist = ['uid', 'displayName', 'suAffiliation']
+
+  export(ldap1, 'people.jsonl.gz', BASEDN_PEOPLE, attrlist=attrlist, compression='gzip')
+  export(ldap1, 'people.csv', BASEDN_PEOPLE, attrlist=attrlist)
+  export(ldap1, 'people.parquet', BASEDN_PEOPLE, attrlist=attrlist,
+         batch_size=10000, compression='zstd')
+
+"""
+import base64
+import bz2
+import csv
+import gzip
+import json
+import logging
+import lzma
+
+from stanford.green.ldap import LDAP, LDAPResult
+
+## TYPING
+from typing import Any, IO, Optional, cast
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+TEXT_COMPRESSION_OPENERS = {
+    None:    open,
+    'gzip':  gzip.open,
+    'bz2':   bz2.open,
+    'xz':    lzma.open,
+}
+
+# The compression named by the extension of an output file.
+SUFFIX_COMPRESSION = {
+    '.gz':  'gzip',
+    '.bz2': 'bz2',
+    '.xz':  'xz',
+}
+
+def open_text(path: str, compression: Optional[str] = None) -> IO[str]:
+    """Open ``path`` for writing text, compressed with ``compression`` if set.
+
+    :raises ValueError: if ``compression`` is not one of ``None``,
+      ``'gzip'``, ``'bz2'``, or ``'xz'``.
+    """
+    if (compression not in TEXT_COMPRESSION_OPENERS):
+        msg = f"unsupported compression '{compression}'"
+        raise ValueError(msg)
+
+    opener: Any = TEXT_COMPRESSION_OPENERS[compression]
+    return cast(IO[str], opener(path, 'wt', encoding='utf-8', newline=''))
+
+
+def text_value(value: Any) -> Any:
+    """Return ``value`` with byte-strings (binary attributes) base64-encoded."""
+    if (isinstance(value, bytes)):
+        return base64.b64encode(value).decode('ascii')
+    elif (isinstance(value, list)):
+        return [text_value(item) for item in value]
+    else:
+        return value
+
+
+def column_values(attribute_values: LDAPResult, columns: list[str]) -> list[Any]:
+    """Return the values in an entry of each of ``columns`` (``None`` if missing).
+
+    Column names are matched to attribute names ignoring case.
+    """
+    by_name = {name.lower(): value for (name, value) in attribute_values.items()}
+    return [by_name.get(column.lower()) for column in columns]
+
+
+class JSONLinesWriter():
+    """Write entries as JSON Lines.
+
+    :param path: the output file.
+    :type path: str
+
+    :param compression: ``None``, ``'gzip'``, ``'bz2'``, or ``'xz'``.
+    :type compression: str
+
+    """
+    def __init__(self, path: str, compression: Optional[str] = None):
+        self.fh = open_text(path, compression)
+
+    def write(self, dn: str, attribute_values: LDAPResult) -> None:
+        record: dict[str, Any] = {'dn': dn}
+        record.update(attribute_values)
+        self.fh.write(json.dumps(record, ensure_ascii=False, default=text_value))
+        self.fh.write('\n')
+
+    def close(self) -> None:
+        self.fh.close()
+
+
+class CSVWriter():
+    """Write entries as CSV rows.
+
+    :param path: the output file.
+    :type path: str
+
+    :param columns: the attributes to write, one column each, after the
+      ``dn`` column.
+    :type columns: list[str]
+
+    :param compression: ``None``, ``'gzip'``, ``'bz2'``, or ``'xz'``.
+    :type compression: str
+
+    :param separator: joins the values of multi-valued attributes; default: ``|``.
+    :type separator: str
+
+    """
+    def __init__(self,
+                 path:        str,
+                 columns:     list[str],
+                 compression: Optional[str] = None,
+                 separator:   str = '|'):
+        self.columns   = columns
+        self.separator = separator
+
+        self.fh     = open_text(path, compression)
+        self.writer = csv.writer(self.fh)
+        self.writer.writerow(['dn'] + columns)
+
+    def write(self, dn: str, attribute_values: LDAPResult) -> None:
+        row = [dn]
+        for value in column_values(attribute_values, self.columns):
+            value = text_value(value) if (value is not None) else ''
+            if (isinstance(value, list)):
+                value = self.separator.join(value)
+            row.append(value)
+
+        self.writer.writerow(row)
+
+    def close(self) -> None:
+        self.fh.close()
+
+
+class ParquetWriter():
+    """Write entries to a Parquet file a batch at a time.
+
+    :param path: the output file.
+    :type path: str
+
+    :param columns: the attributes to write, one column each, after the
+      ``dn`` column.
+    :type columns: list[str]
+
+    :param multi_valued: the names in ``columns`` whose values are lists.
+    :type multi_valued: set[str]
+
+    :param batch_size: the number of entries buffered in memory before
+      they are written out; default: 10000.
+    :type batch_size: int
+
+    :param row_group_size: the most rows in each Parquet row group;
+      defaults to ``batch_size``.
+    :type row_group_size: int
+
+    :param compression: the Parquet compression codec; default: ``'snappy'``.
+    :type compression: str
+
+    """
+    def __init__(self,
+                 path:           str,
+                 columns:        list[str],
+                 multi_valued:   set[str],
+                 batch_size:     int = 10000,
+                 row_group_size: Optional[int] = None,
+                 compression:    str = 'snappy'):
+        try:
+            import pyarrow                  # type: ignore
+            import pyarrow.parquet          # type: ignore
+        except ImportError as excpt:
+            msg = "Parquet export requires the pyarrow package (pip install pyarrow)"
+            raise ImportError(msg) from excpt
+
+        self.pyarrow        = pyarrow
+        self.columns        = columns
+        self.multi_valued   = multi_valued
+        self.batch_size     = batch_size
+        self.row_group_size = row_group_size if (row_group_size is not None) else batch_size
+
+        fields = [pyarrow.field('dn', pyarrow.string())]
+        for column in columns:
+            if (column in multi_valued):
+                fields.append(pyarrow.field(column, pyarrow.list_(pyarrow.string())))
+            else:
+                fields.append(pyarrow.field(column, pyarrow.string()))
+        self.schema = pyarrow.schema(fields)
+
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=compression)
+        self._reset_batch()
+
+    def _reset_batch(self) -> None:
+        self.batch: dict[str, list[Any]] = {name: [] for name in ['dn'] + self.columns}
+        self.batch_count = 0
+
+    def _flush(self) -> None:
+        if (self.batch_count == 0):
+            return
+
+        table = self.pyarrow.Table.from_pydict(self.batch, schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self._reset_batch()
+
+    def write(self, dn: str, attribute_values: LDAPResult) -> None:
+        self.batch['dn'].append(dn)
+        for (column, value) in zip(self.columns, column_values(attribute_values, self.columns)):
+            value = text_value(value)
+            if ((value is not None) and (column in self.multi_valued) and (not isinstance(value, list))):
+                value = [value]
+            self.batch[column].append(value)
+
+        self.batch_count += 1
+        if (self.batch_count >= self.batch_size):
+            self._flush()
+
+    def close(self) -> None:
+        self._flush()
+        self.writer.close()
+
+
+def export_search(
+        ldap1:     LDAP,
+        writer:    Any,
+        basedn:    str,
+        filterstr: str='(objectClass=*)',
+        attrlist:  Optional[list[str]]=None,
+        scope:     str='sub',
+        page_size: int=500,
+) -> int:
+    """Search and pass every entry to ``writer`` as it arrives.
+
+    :param ldap1: the (connected) ``LDAP`` object to search with.
+    :type ldap1: LDAP
+
+    :param writer: an object with ``write(dn, attribute_values)`` and
+      ``close()`` methods, e.g., a :py:class:`JSONLinesWriter`.
+    :type writer: Any
+
+    The remaining parameters are passed to
+    :py:meth:`~stanford.green.ldap.LDAP.search_iter`.
+
+    :return: the number of entries written.
+    :rtype: int
+
+    The writer is closed when the search finishes (or fails).
+    """
+    count = 0
+    try:
+        for (dn, attribute_values) in ldap1.search_iter(basedn, filterstr=filterstr, attrlist=attrlist,
+                                                        scope=scope, page_size=page_size):
+            writer.write(dn, attribute_values)
+            count += 1
+    finally:
+        writer.close()
+
+    logger.info(f"exported {count} entries from {basedn}")
+    return count
+
+def export(
+        ldap1:          LDAP,
+        path:           str,
+        basedn:         str,
+        filterstr:      str='(objectClass=*)',
+        attrlist:       Optional[list[str]]=None,
+        scope:          str='sub',
+        output_format:  Optional[str]=None,
+        compression:    Optional[str]=None,
+        page_size:      int=500,
+        batch_size:     int=10000,
+        row_group_size: Optional[int]=None,
+        separator:      str='|',
+) -> int:
+    """Export the results of a search to ``path``.
+
+    :param output_format: ``'jsonl'``, ``'csv'``, or ``'parquet'``;
+      defaults to the format named by the extension of ``path`` (ignoring
+      a trailing ``.gz``, ``.bz2``, or ``.xz``).
+    :type output_format: str
+
+    :param compression: for JSON Lines and CSV one of ``'gzip'``,
+      ``'bz2'``, or ``'xz'``, by default the one named by a ``.gz``,
+      ``.bz2``, or ``.xz`` extension of ``path``; for Parquet a Parquet
+      codec (default ``'snappy'``).
+    :type compression: str
+
+    :param attrlist: the attributes to export; required for CSV and
+      Parquet output since they need a fixed set of columns.
+    :type attrlist: list[str]
+
+    ``page_size`` is passed to the search; ``batch_size`` and
+    ``row_group_size`` apply to Parquet output and ``separator`` to CSV
+    output. See :py:func:`export_search` for the other parameters.
+
+    :return: the number of entries written.
+    :rtype: int
+
+    :raises ValueError: if ``compression`` is not the one named by the
+      extension of ``path``, or if a Parquet file has such an extension
+      (Parquet files are compressed internally).
+    """
+    name = path
+    suffix_compression = None
+    for (suffix, codec) in SUFFIX_COMPRESSION.items():
+        if (name.endswith(suffix)):
+            name = name.removesuffix(suffix)
+            suffix_compression = codec
+            break
+
+    if (output_format is None):
+        output_format = name.rsplit('.', 1)[-1].lower()
+
+    if (suffix_compression is not None):
+        if (output_format == 'parquet'):
+            msg = f"Parquet files are compressed internally; '{path}' should not end in a compression extension"
+            raise ValueError(msg)
+        if (compression is None):
+            compression = suffix_compression
+        elif (compression != suffix_compression):
+            msg = f"compression '{compression}' does not match the extension of '{path}'"
+            raise ValueError(msg)
+
+    writer: Any
+    if (output_format in ('jsonl', 'json')):
+        writer = JSONLinesWriter(path, compression=compression)
+    elif (output_format in ('csv', 'parquet')):
+        if (attrlist is None):
+            msg = f"exporting to {output_format} requires an attrlist"
+            raise ValueError(msg)
+
+        if (output_format == 'csv'):
+            writer = CSVWriter(path, attrlist, compression=compression, separator=separator)
+        else:
+            multi_valued = {attribute for attribute in attrlist
+                            if (not ldap1.registry.is_single_valued(attribute))}
+            writer = ParquetWriter(path, attrlist, multi_valued, batch_size=batch_size,
+                                   row_group_size=row_group_size,
+                                   compression=compression or 'snappy')
+    else:
+        msg = f"unsupported export format '{output_format}'"
+        raise ValueError(msg)
+
+    return export_search(ldap1, writer, basedn, filterstr=filterstr, attrlist=attrlist,
+                         scope=scope, page_size=page_size)
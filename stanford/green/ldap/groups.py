@@ -0,0 +1,604 @@
+"""An in-memory bitmap index of ``suPrivilegeGroup`` membership.
+
+--------
+Overview
+--------
+
+Authorization checks ask "is this user in workgroup X?" on every
+request, and reports ask "who is in workgroup X?". Both can be answered
+without going to the server from a :py:class:`PrivilegeGroupIndex`
+built from account-tree data.
+
+Each user is given an *ordinal* (a small integer) and each group is a
+:py:class:`GroupBitmap` of the ordinals of its members. A bitmap is split
+into chunks of :py:data:`CHUNK_BITS` bits and only the chunks holding at
+least one member are stored, so a small group costs a few hundred bytes
+however many users there are. Membership tests are a dict lookup and a
+bit test; intersections and unions work a chunk at a time.
+
+The index is filled by
+
+* :py:meth:`PrivilegeGroupIndex.load_search`: read every account with a
+  ``suPrivilegeGroup`` from the server,
+
+* :py:meth:`PrivilegeGroupIndex.load_entries`: load
+  ``(dn, attributes)`` pairs (e.g., from a
+  :py:class:`~stanford.green.ldap.mirror.DirectoryMirror` or an export), and
+
+* :py:meth:`PrivilegeGroupIndex.set_user`,
+  :py:meth:`PrivilegeGroupIndex.remove_user`, and
+  :py:meth:`PrivilegeGroupIndex.apply_events` (the changes found by
+  :py:class:`stanford.green.ldap.sync.DirectorySync`) for incremental updates.
+
+:py:meth:`PrivilegeGroupIndex.save` writes the index to a file which
+:py:meth:`PrivilegeGroupIndex.load` memory-maps: a group's bitmap is
+only read from the file the first time the group is used, so a process
+can start answering membership checks without reading the whole index.
+
+--------
+Examples
+--------
+
+Build the index (e.g., from a nightly job) and save it::
+
+  from stanford.green.ldap        import LDAP
+  from stanford.green.ldap.groups import PrivilegeGroupIndex
+
+  index = PrivilegeGroupIndex()
+  index.load_search(LDAP())
+  index.save('/var/lib/myapp/groups.idx')
+
+and then, in each worker::
+
+  index = PrivilegeGroupIndex()
+  index.load('/var/lib/myapp/groups.idx')
+
+  index.is_member('jstanford', 'uit:staff')                  # True or False
+  index.members('uit:staff')                                 # ['jstanford', ...]
+  index.members_of_all(['uit:staff', 'stanford:faculty'])    # in both groups
+
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from stanford.green.ldap import LDAP, BASEDN_ACCOUNTS
+
+## TYPING
+from typing import Any, Iterable, Iterator, Optional, Tuple
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+# The number of ordinals in each bitmap chunk (a power of two).
+CHUNK_BITS  = 4096
+CHUNK_SHIFT = CHUNK_BITS.bit_length() - 1
+CHUNK_MASK  = CHUNK_BITS - 1
+CHUNK_BYTES = CHUNK_BITS // 8
+
+# The index file starts with this, followed by the length of the JSON
+# header as an unsigned 64-bit little-endian integer, the header, and
+# the bitmap chunks.
+FILE_MAGIC   = b'GRNPGIX\x01'
+FILE_VERSION = 1
+
+class GreenGroupIndexFileException(Exception):
+    """Used when an index file cannot be read"""
+    pass
+
+
+class GroupBitmap():
+    """A set of non-negative integers stored as a chunked bitmap.
+
+    :param ordinals: the initial members; default: none.
+    :type ordinals: Iterable[int]
+
+    :ivar chunks: maps a chunk number to the (non-zero) ``int`` holding
+      the bits of that chunk.
+    """
+    __slots__ = ('chunks',)
+
+    def __init__(self, ordinals: Iterable[int] = ()):
+        self.chunks: dict[int, int] = {}
+        for ordinal in ordinals:
+            self.add(ordinal)
+
+    def add(self, ordinal: int) -> None:
+        key = ordinal >> CHUNK_SHIFT
+        self.chunks[key] = self.chunks.get(key, 0) | (1 << (ordinal & CHUNK_MASK))
+
+    def discard(self, ordinal: int) -> None:
+        key   = ordinal >> CHUNK_SHIFT
+        chunk = self.chunks.get(key)
+        if (chunk is None):
+            return
+
+        chunk &= ~(1 << (ordinal & CHUNK_MASK))
+        if (chunk):
+            self.chunks[key] = chunk
+        else:
+            del self.chunks[key]
+
+    def __contains__(self, ordinal: int) -> bool:
+        chunk = self.chunks.get(ordinal >> CHUNK_SHIFT)
+        return (chunk is not None) and bool((chunk >> (ordinal & CHUNK_MASK)) & 1)
+
+    def __len__(self) -> int:
+        return sum(chunk.bit_count() for chunk in self.chunks.values())
+
+    def __bool__(self) -> bool:
+        return bool(self.chunks)
+
+    def __iter__(self) -> Iterator[int]:
+        """Yield the members in ascending order."""
+        for key in sorted(self.chunks):
+            chunk = self.chunks[key]
+            base  = key << CHUNK_SHIFT
+            while (chunk):
+                lowest = chunk & -chunk
+                yield base + lowest.bit_length() - 1
+                chunk ^= lowest
+
+    def __eq__(self, other: object) -> bool:
+        if (not isinstance(other, GroupBitmap)):
+            return NotImplemented
+        return (self.chunks == other.chunks)
+
+    def __and__(self, other: 'GroupBitmap') -> 'GroupBitmap':
+        (smaller, larger) = (self, other) if (len(self.chunks) <= len(other.chunks)) else (other, self)
+        result = GroupBitmap()
+        for (key, chunk) in smaller.chunks.items():
+            both = chunk & larger.chunks.get(key, 0)
+            if (both):
+                result.chunks[key] = both
+        return result
+
+    def __or__(self, other: 'GroupBitmap') -> 'GroupBitmap':
+        result = self.copy()
+        for (key, chunk) in other.chunks.items():
+            result.chunks[key] = result.chunks.get(key, 0) | chunk
+        return result
+
+    def __sub__(self, other: 'GroupBitmap') -> 'GroupBitmap':
+        result = GroupBitmap()
+        for (key, chunk) in self.chunks.items():
+            difference = chunk & ~other.chunks.get(key, 0)
+            if (difference):
+                result.chunks[key] = difference
+        return result
+
+    def copy(self) -> 'GroupBitmap':
+        result = GroupBitmap()
+        result.chunks = dict(self.chunks)
+        return result
+
+    def to_bytes(self) -> Tuple[list[int], bytes]:
+        """Return the chunk numbers (ascending) and the chunks, :py:data:`CHUNK_BYTES` each."""
+        keys = sorted(self.chunks)
+        return (keys, b''.join(self.chunks[key].to_bytes(CHUNK_BYTES, 'little') for key in keys))
+
+    @classmethod
+    def from_buffer(cls, buffer: Any, offset: int, keys: list[int]) -> 'GroupBitmap':
+        """Read a bitmap written by :py:meth:`to_bytes` from ``buffer`` at ``offset``."""
+        result = cls()
+        for (position, key) in enumerate(keys):
+            start = offset + position * CHUNK_BYTES
+            result.chunks[key] = int.from_bytes(buffer[start:start + CHUNK_BYTES], 'little')
+        return result
+
+    def __repr__(self) -> str:
+        return f"GroupBitmap({len(self)} members in {len(self.chunks)} chunks)"
+
+
+def sunetid_of(dn: str, attributes: Optional[dict[str, Any]] = None) -> Optional[str]:
+    """Return the sunetid of an account-tree entry.
+
+    This is the entry's ``uid`` attribute if ``attributes`` has one, and
+    otherwise the value of the DN's first RDN if that is a ``uid``.
+    """
+    if (attributes is not None):
+        uid = attributes.get('uid')
+        if (isinstance(uid, list)):
+            uid = uid[0] if uid else None
+        if (uid):
+            return str(uid)
+
+    (attribute, _, value) = dn.split(',', 1)[0].partition('=')
+    if ((attribute.strip().lower() == 'uid') and value.strip()):
+        return value.strip()
+    else:
+        return None
+
+
+class PrivilegeGroupIndex():
+    """Group membership of users as bitmaps of user ordinals.
+
+    :param attribute: the (multi-valued) attribute holding the groups;
+      default: ``suPrivilegeGroup``.
+    :type attribute: str
+
+    Updates are serialized by a lock. Lookups do not take the lock, so a
+    lookup made during an update of the same user may see either the
+    user's old or new groups.
+
+    The ordinal of a removed user is not reused; rebuild the index from
+    scratch now and then if many users come and go.
+    """
+    def __init__(self, attribute: str = 'suPrivilegeGroup'):
+        self.attribute = attribute
+
+        self._lock = threading.RLock()
+
+        self._ordinals: dict[str, int] = {}
+        self._sunetids: list[Optional[str]] = []
+
+        self._group_ids: dict[str, int] = {}
+        self._group_names: list[str] = []
+        self._bitmaps: list[Optional[GroupBitmap]] = []
+
+        # For a loaded index, the (offset, chunk numbers) in the file of
+        # each bitmap not read yet.
+        self._mapped: list[Optional[Tuple[int, list[int]]]] = []
+        self._buffer: Any = None
+
+        # The group ids of each user; built on first use after a load.
+        self._user_groups: Optional[list[Tuple[int, ...]]] = []
+
+    def __len__(self) -> int:
+        """Return the number of users."""
+        return len(self._ordinals)
+
+    def __contains__(self, sunetid: str) -> bool:
+        return sunetid in self._ordinals
+
+    ## Internals
+
+    def _bitmap(self, group_id: int) -> GroupBitmap:
+        bitmap = self._bitmaps[group_id]
+        if (bitmap is not None):
+            return bitmap
+
+        with self._lock:
+            bitmap = self._bitmaps[group_id]
+            if (bitmap is None):
+                location = self._mapped[group_id]
+                assert location is not None
+                (offset, keys) = location
+                bitmap = GroupBitmap.from_buffer(self._buffer, offset, keys)
+                self._bitmaps[group_id] = bitmap
+                self._mapped[group_id]  = None
+            return bitmap
+
+    def _group_id(self, group: str) -> int:
+        group_id = self._group_ids.get(group)
+        if (group_id is None):
+            group_id = len(self._group_names)
+            self._group_ids[group] = group_id
+            self._group_names.append(group)
+            self._bitmaps.append(GroupBitmap())
+            self._mapped.append(None)
+        return group_id
+
+    def _users_groups(self) -> list[Tuple[int, ...]]:
+        """Return the group ids of each user, working them out from the bitmaps if needed."""
+        with self._lock:
+            if (self._user_groups is None):
+                user_groups: list[list[int]] = [[] for _ in self._sunetids]
+                for group_id in range(len(self._group_names)):
+                    for ordinal in self._bitmap(group_id):
+                        user_groups[ordinal].append(group_id)
+                self._user_groups = [tuple(group_ids) for group_ids in user_groups]
+            return self._user_groups
+
+    def _to_sunetids(self, bitmap: GroupBitmap) -> list[str]:
+        sunetids = self._sunetids
+        return [sunetid for sunetid in (sunetids[ordinal] for ordinal in bitmap) if (sunetid is not None)]
+
+    ## Updates
+
+    def set_user(self, sunetid: str, groups: Iterable[str]) -> None:
+        """Make ``groups`` the groups of ``sunetid`` (adding the user if new)."""
+        with self._lock:
+            user_groups = self._users_groups()
+
+            ordinal = self._ordinals.get(sunetid)
+            if (ordinal is None):
+                ordinal = len(self._sunetids)
+                self._sunetids.append(sunetid)
+                user_groups.append(())
+                self._ordinals[sunetid] = ordinal
+
+            new_ids = {self._group_id(group) for group in groups}
+            old_ids = set(user_groups[ordinal])
+            for group_id in (old_ids - new_ids):
+                self._bitmap(group_id).discard(ordinal)
+            for group_id in (new_ids - old_ids):
+                self._bitmap(group_id).add(ordinal)
+
+            user_groups[ordinal] = tuple(sorted(new_ids))
+
+    def remove_user(self, sunetid: str) -> bool:
+        """Remove ``sunetid`` from the index; return ``True`` if it was there."""
+        with self._lock:
+            ordinal = self._ordinals.get(sunetid)
+            if (ordinal is None):
+                return False
+
+            user_groups = self._users_groups()
+            for group_id in user_groups[ordinal]:
+                self._bitmap(group_id).discard(ordinal)
+
+            user_groups[ordinal]    = ()
+            self._sunetids[ordinal] = None
+            del self._ordinals[sunetid]
+            return True
+
+    def groups_from_attributes(self, attributes: dict[str, Any]) -> list[str]:
+        """Return the groups listed in an entry's (decoded) attributes."""
+        groups = attributes.get(self.attribute, [])
+        return [groups] if isinstance(groups, str) else list(groups)
+
+    def load_entries(self, entries: Iterable[Tuple[str, Any]], replace: bool = False) -> int:
+        """Set the groups of the users in ``(dn, attributes)`` pairs.
+
+        :param entries: account-tree entries, e.g., from
+          :py:meth:`~stanford.green.ldap.LDAP.search_iter`.
+        :type entries: Iterable
+
+        :param replace: if ``True``, remove every user not in ``entries``
+          once they are all loaded; default: ``False``.
+        :type replace: bool
+
+        :return: the number of users loaded.
+        :rtype: int
+
+        Entries without a sunetid are skipped.
+        """
+        seen: set[str] = set()
+        for (dn, attributes) in entries:
+            sunetid = sunetid_of(dn, attributes)
+            if (sunetid is None):
+                logger.debug(f"skipping {dn}: no sunetid")
+                continue
+
+            self.set_user(sunetid, self.groups_from_attributes(attributes))
+            seen.add(sunetid)
+
+        if (replace):
+            for sunetid in [sunetid for sunetid in self._ordinals if (sunetid not in seen)]:
+                self.remove_user(sunetid)
+
+        logger.info(f"loaded the groups of {len(seen)} users")
+        return len(seen)
+
+    def load_search(
+            self,
+            ldap1:     LDAP,
+            basedn:    str=BASEDN_ACCOUNTS,
+            filterstr: Optional[str]=None,
+            replace:   bool=True,
+            page_size: int=500,
+    ) -> int:
+        """Load every account with a group from the server.
+
+        The default filter selects the entries having the index's
+        attribute. By default users not found are removed from the index
+        (see :py:meth:`load_entries`).
+
+        :return: the number of users loaded.
+        :rtype: int
+        """
+        if (filterstr is None):
+            filterstr = f"({self.attribute}=*)"
+
+        entries = ldap1.search_iter(basedn, filterstr=filterstr, attrlist=['uid', self.attribute],
+                                    page_size=page_size)
+        return self.load_entries(entries, replace=replace)
+
+    def apply_events(self, events: Iterable[Any]) -> dict[str, int]:
+        """Apply :py:class:`~stanford.green.ldap.sync.SyncEvent` changes.
+
+        :return: the number of events of each kind applied.
+        :rtype: dict[str, int]
+        """
+        counts = {'add': 0, 'modify': 0, 'delete': 0}
+        for event in events:
+            sunetid = sunetid_of(event.dn, event.attributes)
+            if (sunetid is None):
+                continue
+
+            if (event.action == 'delete'):
+                self.remove_user(sunetid)
+            else:
+                self.set_user(sunetid, self.groups_from_attributes(event.attributes))
+            counts[event.action] += 1
+
+        return counts
+
+    ## Lookups
+
+    def is_member(self, sunetid: str, group: str) -> bool:
+        """Return ``True`` if ``sunetid`` is in ``group``."""
+        ordinal  = self._ordinals.get(sunetid)
+        group_id = self._group_ids.get(group)
+        if ((ordinal is None) or (group_id is None)):
+            return False
+
+        return ordinal in self._bitmap(group_id)
+
+    def groups_of(self, sunetid: str) -> list[str]:
+        """Return the groups of ``sunetid`` (none if the user is not in the index)."""
+        ordinal = self._ordinals.get(sunetid)
+        if (ordinal is None):
+            return []
+
+        return [self._group_names[group_id] for group_id in self._users_groups()[ordinal]]
+
+    def groups(self) -> list[str]:
+        """Return the names of the groups having at least one member."""
+        return [name for (group_id, name) in enumerate(self._group_names) if self._bitmap(group_id)]
+
+    def bitmap(self, group: str) -> GroupBitmap:
+        """Return (a copy of) the bitmap of ``group``; empty if there is no such group."""
+        group_id = self._group_ids.get(group)
+        if (group_id is None):
+            return GroupBitmap()
+
+        return self._bitmap(group_id).copy()
+
+    def count(self, group: str) -> int:
+        """Return the number of members of ``group``."""
+        group_id = self._group_ids.get(group)
+        return 0 if (group_id is None) else len(self._bitmap(group_id))
+
+    def members(self, group: str) -> list[str]:
+        """Return the sunetids of the members of ``group``."""
+        group_id = self._group_ids.get(group)
+        return [] if (group_id is None) else self._to_sunetids(self._bitmap(group_id))
+
+    def members_of_all(self, groups: Iterable[str]) -> list[str]:
+        """Return the sunetids of the users in every one of ``groups``."""
+        bitmaps = []
+        for group in groups:
+            group_id = self._group_ids.get(group)
+            if (group_id is None):
+                return []
+            bitmaps.append(self._bitmap(group_id))
+
+        if (not bitmaps):
+            return []
+
+        # Start with the smallest so the intermediate results stay small.
+        bitmaps.sort(key=lambda bitmap: len(bitmap.chunks))
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            result = result & bitmap
+            if (not result):
+                break
+
+        return self._to_sunetids(result)
+
+    def members_of_any(self, groups: Iterable[str]) -> list[str]:
+        """Return the sunetids of the users in at least one of ``groups``."""
+        result = GroupBitmap()
+        for group in groups:
+            group_id = self._group_ids.get(group)
+            if (group_id is not None):
+                result = result | self._bitmap(group_id)
+
+        return self._to_sunetids(result)
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of users, groups, and stored bitmap chunks."""
+        loaded = [bitmap for bitmap in self._bitmaps if (bitmap is not None)]
+        return {
+            'users':          len(self._ordinals),
+            'groups':         len(self._group_names),
+            'loaded_groups':  len(loaded),
+            'chunks':         sum(len(bitmap.chunks) for bitmap in loaded),
+        }
+
+    ## Files
+
+    def save(self, path: str) -> None:
+        """Write the index to ``path`` (atomically) for :py:meth:`load`."""
+        with self._lock:
+            groups = []
+            data   = []
+            offset = 0
+            for (group_id, name) in enumerate(self._group_names):
+                (keys, chunks) = self._bitmap(group_id).to_bytes()
+                if (not keys):
+                    continue
+                groups.append([name, offset, keys])
+                data.append(chunks)
+                offset += len(chunks)
+
+            header = json.dumps({
+                'version':    FILE_VERSION,
+                'chunk_bits': CHUNK_BITS,
+                'attribute':  self.attribute,
+                'sunetids':   self._sunetids,
+                'groups':     groups,
+            }).encode('utf-8')
+
+            tmp_path = f"{path}.tmp.{os.getpid()}"
+            with open(tmp_path, 'wb') as fh:
+                fh.write(FILE_MAGIC)
+                fh.write(struct.pack('<Q', len(header)))
+                fh.write(header)
+                for chunks in data:
+                    fh.write(chunks)
+            os.replace(tmp_path, path)
+
+        logger.info(f"saved {len(groups)} groups of {len(self._ordinals)} users to {path}")
+
+    def load(self, path: str, use_mmap: bool = True) -> None:
+        """Replace the index with the one saved in ``path``.
+
+        :param use_mmap: if ``True``, memory-map the file and read each
+          group's bitmap from it the first time the group is used;
+          otherwise read every bitmap now; default: ``True``.
+        :type use_mmap: bool
+
+        :raises GreenGroupIndexFileException: if ``path`` is not an index
+          file this version can read.
+        """
+        with open(path, 'rb') as fh:
+            buffer: Any
+            if (use_mmap):
+                buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buffer = fh.read()
+
+        prefix_length = len(FILE_MAGIC) + 8
+        if (buffer[:len(FILE_MAGIC)] != FILE_MAGIC):
+            msg = f"{path} is not a group index file"
+            raise GreenGroupIndexFileException(msg)
+
+        (header_length,) = struct.unpack('<Q', buffer[len(FILE_MAGIC):prefix_length])
+        header = json.loads(bytes(buffer[prefix_length:prefix_length + header_length]))
+        if ((header.get('version') != FILE_VERSION) or (header.get('chunk_bits') != CHUNK_BITS)):
+            msg = f"{path} has an unsupported version or chunk size"
+            raise GreenGroupIndexFileException(msg)
+
+        data_offset = prefix_length + header_length
+
+        with self._lock:
+            if (isinstance(self._buffer, mmap.mmap)):
+                self._buffer.close()
+
+            self.attribute = header['attribute']
+            self._sunetids = header['sunetids']
+            self._ordinals = {sunetid: ordinal for (ordinal, sunetid) in enumerate(self._sunetids)
+                              if (sunetid is not None)}
+
+            self._group_names = [name for (name, _, _) in header['groups']]
+            self._group_ids   = {name: group_id for (group_id, name) in enumerate(self._group_names)}
+            self._bitmaps     = [None] * len(self._group_names)
+            self._mapped      = [(data_offset + offset, keys) for (_, offset, keys) in header['groups']]
+            self._buffer      = buffer
+            self._user_groups = None
+
+            if (not use_mmap):
+                for group_id in range(len(self._group_names)):
+                    self._bitmap(group_id)
+                self._buffer = None
+
+        logger.info(f"loaded {len(self._group_names)} groups of {len(self._ordinals)} users from {path}")
+
+    def close(self) -> None:
+        """Release the memory-mapped file (reading any bitmaps not read yet)."""
+        with self._lock:
+            if (self._buffer is None):
+                return
+
+            for group_id in range(len(self._bitmaps)):
+                self._bitmap(group_id)
+            if (isinstance(self._buffer, mmap.mmap)):
+                self._buffer.close()
+            self._buffer = None
@@ -0,0 +1,283 @@
+"""Per-operation instrumentation for the LDAP class.
+
+--------
+Overview
+--------
+
+An :py:class:`stanford.green.ldap.LDAP` object calls each of its *hooks*
+once every operation (a bind or a search) finishes, passing an
+:py:class:`OperationStats` describing it: the time spent getting a bound
+connection, the time to the first entry, the total time, the number of
+entries and (approximate) bytes received, the time spent decoding, and
+the base DN, filter, and attribute list of the search.
+
+A hook is any callable taking an :py:class:`OperationStats`. Two are
+provided:
+
+* :py:class:`SlowQueryLogger`: writes a structured (JSON) log record for
+  every operation slower than a threshold.
+
+* :py:class:`PrometheusAggregator`: keeps counters and latency histograms
+  and renders them in the Prometheus text exposition format.
+
+Instrumentation costs nothing when an object has no hooks.
+
+--------
+Examples
+--------
+
+::
+
+  from stanford.green.ldap            import LDAP
+  from stanford.green.ldap.instrument import PrometheusAggregator, SlowQueryLogger
+
+  metrics = PrometheusAggregator()
+  ldap1   = LDAP(hooks=[metrics, SlowQueryLogger(threshold_seconds=0.5)])
+
+  ldap1.sunetid_info('jstanford')
+
+  print(metrics.render())   # e.g., serve this at /metrics
+
+"""
+import bisect
+import json
+import logging
+import threading
+import time
+
+## TYPING
+from typing import Any, Optional, Tuple
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+# The upper bounds (in seconds) of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class OperationStats():
+    """What happened during one LDAP operation.
+
+    :ivar operation: ``'bind'``, ``'search'``, ``'search_compact'``,
+      ``'search_window'``, ``'search_multi'``, ``'sunetid_search_many'``, or
+      ``'fetch_dns'``.
+    :ivar basedn: the base DN (base DNs separated by ``;`` for an
+      operation that searches several, and e.g. ``'120 DNs'`` for
+      ``'fetch_dns'``).
+    :ivar filterstr: the search filter.
+    :ivar attrlist: the attributes asked for (``None`` means all).
+    :ivar scope: the search scope.
+    :ivar bind_seconds: the time spent getting a bound connection
+      (including making a new one if needed).
+    :ivar first_entry_seconds: the time from the start of the operation
+      until the first entry arrived (``None`` if there were no entries).
+    :ivar total_seconds: the time from the start of the operation until
+      its last result arrived.
+    :ivar entries: the number of entries received.
+    :ivar bytes: the approximate size of the entries received (the
+      lengths of the DNs, attribute names, and values).
+    :ivar decode_seconds: the time spent decoding the entries.
+    :ivar error: the name of the exception that ended the operation, if any.
+    """
+    __slots__ = ('operation', 'basedn', 'filterstr', 'attrlist', 'scope',
+                 'bind_seconds', 'first_entry_seconds', 'total_seconds',
+                 'entries', 'bytes', 'decode_seconds', 'error')
+
+    def __init__(self,
+                 operation: str,
+                 basedn:    str = '',
+                 filterstr: str = '',
+                 attrlist:  Optional[list[str]] = None,
+                 scope:     str = ''):
+        self.operation = operation
+        self.basedn    = basedn
+        self.filterstr = filterstr
+        self.attrlist  = attrlist
+        self.scope     = scope
+
+        self.bind_seconds                       = 0.0
+        self.first_entry_seconds: Optional[float] = None
+        self.total_seconds                      = 0.0
+        self.entries                            = 0
+        self.bytes                              = 0
+        self.decode_seconds                     = 0.0
+        self.error: Optional[str]               = None
+
+    def add_entries(self, entries: list[Tuple[str, dict[str, list[bytes]]]], start: float) -> None:
+        """Count raw ``entries`` received by an operation that began at ``start``.
+
+        ``start`` is a :py:func:`time.perf_counter` value.
+        """
+        if (self.first_entry_seconds is None):
+            self.first_entry_seconds = time.perf_counter() - start
+
+        self.entries += len(entries)
+        for entry in entries:
+            self.bytes += entry_size(entry)
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the statistics as a (JSON-serializable) dict."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"OperationStats({self.as_dict()!r})"
+
+
+def entry_size(entry: Tuple[str, dict[str, list[bytes]]]) -> int:
+    """Return the approximate size in bytes of a raw search entry."""
+    (dn, values) = entry
+    size = len(dn)
+    for (attribute, attribute_values) in values.items():
+        size += len(attribute)
+        for value in attribute_values:
+            size += len(value)
+
+    return size
+
+
+class SlowQueryLogger():
+    """A hook logging every operation that takes at least ``threshold_seconds``.
+
+    :param threshold_seconds: the total time at or above which an
+      operation is logged; default: 1.0.
+    :type threshold_seconds: float
+
+    :param level: the logging level of the records; default: ``logging.WARNING``.
+    :type level: int
+
+    Each record's message is ``slow LDAP operation:`` followed by the
+    operation's statistics as JSON; the statistics are also attached to
+    the record as the ``ldap_stats`` attribute for structured log handlers.
+    """
+    def __init__(self, threshold_seconds: float = 1.0, level: int = logging.WARNING):
+        self.threshold_seconds = threshold_seconds
+        self.level             = level
+
+    def __call__(self, stats: OperationStats) -> None:
+        if (stats.total_seconds < self.threshold_seconds):
+            return
+
+        record = stats.as_dict()
+        logger.log(self.level, f"slow LDAP operation: {json.dumps(record)}", extra={'ldap_stats': record})
+
+
+class _Histogram():
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.counts = [0] * (len(buckets) + 1)   # the last one is +Inf
+        self.total  = 0.0
+        self.count  = 0
+
+    def observe(self, buckets: Tuple[float, ...], value: float) -> None:
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def _labels(**labels: str) -> str:
+    escaped = {name: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for (name, value) in labels.items()}
+    return ','.join(f'{name}="{value}"' for (name, value) in escaped.items())
+
+def _sample(value: float) -> str:
+    # Integers in full and floats by repr(), never in the rounded form of
+    # :g (which renders 3703701 as 3.7037e+06).
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class PrometheusAggregator():
+    """A hook aggregating operation statistics into Prometheus metrics.
+
+    :param prefix: the prefix of every metric name; default: ``green_ldap``.
+    :type prefix: str
+
+    :param buckets: the upper bounds of the latency histogram buckets;
+      default: :py:data:`DEFAULT_BUCKETS`.
+    :type buckets: tuple[float]
+
+    All metrics are labelled with the ``operation``. The counters are
+    ``<prefix>_operations_total`` (also labelled with the ``outcome``,
+    ``ok`` or ``error``), ``<prefix>_entries_total``,
+    ``<prefix>_bytes_total``, ``<prefix>_decode_seconds_total``, and
+    ``<prefix>_unbounded_attrlist_total`` (searches that asked for all
+    attributes). The histograms are ``<prefix>_operation_seconds``,
+    ``<prefix>_first_entry_seconds``, and ``<prefix>_bind_seconds``.
+    """
+    COUNTERS = {
+        'operations_total':          'Number of LDAP operations.',
+        'entries_total':             'Number of entries received.',
+        'bytes_total':               'Approximate number of bytes received.',
+        'decode_seconds_total':      'Time spent decoding entries.',
+        'unbounded_attrlist_total':  'Number of searches that asked for all attributes.',
+    }
+    HISTOGRAMS = {
+        'operation_seconds':    'Total time of LDAP operations.',
+        'first_entry_seconds':  'Time until the first entry of a search arrived.',
+        'bind_seconds':         'Time spent getting a bound connection.',
+    }
+
+    def __init__(self, prefix: str = 'green_ldap', buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.prefix  = prefix
+        self.buckets = tuple(sorted(buckets))
+
+        self._lock = threading.Lock()
+        # Each maps a label string to a value.
+        self._counters: dict[str, dict[str, float]] = {name: {} for name in self.COUNTERS}
+        self._histograms: dict[str, dict[str, _Histogram]] = {name: {} for name in self.HISTOGRAMS}
+
+    def _count(self, name: str, labels: str, amount: float = 1) -> None:
+        counter = self._counters[name]
+        counter[labels] = counter.get(labels, 0) + amount
+
+    def _observe(self, name: str, labels: str, value: float) -> None:
+        histogram = self._histograms[name].get(labels)
+        if (histogram is None):
+            histogram = _Histogram(self.buckets)
+            self._histograms[name][labels] = histogram
+        histogram.observe(self.buckets, value)
+
+    def __call__(self, stats: OperationStats) -> None:
+        operation = _labels(operation=stats.operation)
+        outcome   = _labels(operation=stats.operation, outcome=('ok' if (stats.error is None) else 'error'))
+
+        with self._lock:
+            self._count('operations_total', outcome)
+            self._observe('operation_seconds', operation, stats.total_seconds)
+            if (stats.operation == 'bind'):
+                return
+
+            self._count('entries_total', operation, stats.entries)
+            self._count('bytes_total', operation, stats.bytes)
+            self._count('decode_seconds_total', operation, stats.decode_seconds)
+            if (stats.attrlist is None):
+                self._count('unbounded_attrlist_total', operation)
+
+            self._observe('bind_seconds', operation, stats.bind_seconds)
+            if (stats.first_entry_seconds is not None):
+                self._observe('first_entry_seconds', operation, stats.first_entry_seconds)
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for (name, help_text) in self.COUNTERS.items():
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} counter")
+                for (labels, value) in sorted(self._counters[name].items()):
+                    lines.append(f"{metric}{{{labels}}} {_sample(value)}")
+
+            for (name, help_text) in self.HISTOGRAMS.items():
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for (labels, histogram) in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    bounds = [f"{bound:g}" for bound in self.buckets] + ['+Inf']
+                    for (bound, count) in zip(bounds, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f"{metric}_sum{{{labels}}} {_sample(histogram.total)}")
+                    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+
+        return '\n'.join(lines) + '\n'
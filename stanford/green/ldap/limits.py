@@ -0,0 +1,172 @@
+"""Bounds on how long a search may take and how many entries it may return.
+
+--------
+Overview
+--------
+
+Without limits, :py:meth:`stanford.green.ldap.LDAP.search` waits for as
+long as the server keeps sending entries, so a badly scoped filter can
+hold a request thread for minutes. Passing a :py:class:`SearchLimits`
+puts a bound on that:
+
+* ``time_limit``: the most seconds (measured by the client) the whole
+  search may take;
+
+* ``server_time_limit`` and ``size_limit``: the time limit (in whole
+  seconds) and size limit sent to the server with the search;
+
+* ``poll_timeout``: the most seconds to wait for the next result before
+  giving up on a server that has stalled.
+
+A search that runs over a limit is abandoned on the server. Then,
+depending on ``partial``, either
+:py:exc:`GreenLDAPTimeLimitException` or
+:py:exc:`GreenLDAPSizeLimitException` is raised, or the entries received
+so far are returned in a :py:class:`SearchResult` whose ``truncated``
+attribute is ``True``.
+
+--------
+Examples
+--------
+
+::
+
+  from stanford.green.ldap import LDAP, BASEDN_PEOPLE
+  from stanford.green.ldap.limits import SearchLimits
+
+  ldap1  = LDAP()
+  limits = SearchLimits(time_limit=2.0, size_limit=200, partial=True)
+
+  results = ldap1.search(BASEDN_PEOPLE, filterstr='(sn=Sm*)', limits=limits)
+  if (results.truncated):
+      print(f"only the first {len(results)} matches ({results.reason})")
+
+"""
+import itertools
+import time
+
+## TYPING
+from typing import Any, Optional
+## END OF TYPING
+
+class GreenLDAPSearchLimitException(Exception):
+    """Used when a search is stopped by one of its limits"""
+    pass
+
+class GreenLDAPTimeLimitException(GreenLDAPSearchLimitException):
+    """Used when a search takes longer than its time limit or poll timeout"""
+    pass
+
+class GreenLDAPSizeLimitException(GreenLDAPSearchLimitException):
+    """Used when a search has more entries than its size limit"""
+    pass
+
+
+class SearchLimits():
+    """The limits on one search.
+
+    :param time_limit: the most seconds the search may take, measured by
+      the client from when it starts getting a connection; default:
+      ``None`` (no limit).
+    :type time_limit: float
+
+    :param server_time_limit: the time limit in seconds sent to the
+      server; default: ``None`` (the server's own limit).
+    :type server_time_limit: int
+
+    :param size_limit: the most entries the search may return, sent to
+      the server and also enforced by the client; default: ``None`` (the
+      server's own limit).
+    :type size_limit: int
+
+    :param poll_timeout: the most seconds to wait for any one result;
+      default: ``None`` (as long as ``time_limit`` allows).
+    :type poll_timeout: float
+
+    :param partial: if ``True``, return the entries received before a
+      limit was hit (marked as truncated) rather than raising an
+      exception; default: ``False``.
+    :type partial: bool
+
+    :raises ValueError: if a limit is not positive.
+    """
+    __slots__ = ('time_limit', 'server_time_limit', 'size_limit', 'poll_timeout', 'partial')
+
+    def __init__(self,
+                 time_limit:        Optional[float] = None,
+                 server_time_limit: Optional[int]   = None,
+                 size_limit:        Optional[int]   = None,
+                 poll_timeout:      Optional[float] = None,
+                 partial:           bool            = False):
+        for (name, value) in (('time_limit', time_limit), ('server_time_limit', server_time_limit),
+                              ('size_limit', size_limit), ('poll_timeout', poll_timeout)):
+            if ((value is not None) and (value <= 0)):
+                msg = f"{name} must be positive, not {value}"
+                raise ValueError(msg)
+
+        self.time_limit        = time_limit
+        self.server_time_limit = server_time_limit
+        self.size_limit        = size_limit
+        self.poll_timeout      = poll_timeout
+        self.partial           = partial
+
+    def search_arguments(self) -> dict[str, Any]:
+        """Return the keyword arguments that pass the server-side limits to ``search_ext``."""
+        # python-ldap sends the search_ext timeout to the server as the
+        # search's time limit; -1 and 0 mean "no limit".
+        return {
+            'timeout':   self.server_time_limit if (self.server_time_limit is not None) else -1,
+            'sizelimit': self.size_limit if (self.size_limit is not None) else 0,
+        }
+
+    def deadline(self, start: float) -> Optional[float]:
+        """Return the :py:func:`time.perf_counter` value by which a search begun at ``start`` must end."""
+        return None if (self.time_limit is None) else (start + self.time_limit)
+
+    def result_timeout(self, deadline: Optional[float]) -> Optional[float]:
+        """Return how long to wait for the next result (``None`` means no limit).
+
+        :raises GreenLDAPTimeLimitException: if ``deadline`` has passed.
+        """
+        timeout = self.poll_timeout
+        if (deadline is not None):
+            remaining = deadline - time.perf_counter()
+            if (remaining <= 0):
+                msg = f"search took longer than its time limit of {self.time_limit} seconds"
+                raise GreenLDAPTimeLimitException(msg)
+            timeout = remaining if (timeout is None) else min(timeout, remaining)
+
+        return timeout
+
+    def limit_result(self, result_set: dict[str, Any]) -> 'SearchResult':
+        """Apply the size limit to a result that did not come from the server (e.g., a cached one).
+
+        :raises GreenLDAPSizeLimitException: if ``result_set`` has more
+          entries than ``size_limit`` and ``partial`` is ``False``.
+        """
+        if ((self.size_limit is None) or (len(result_set) <= self.size_limit)):
+            return result_set if isinstance(result_set, SearchResult) else SearchResult(result_set)
+
+        msg = f"search has more than {self.size_limit} entries"
+        if (not self.partial):
+            raise GreenLDAPSizeLimitException(msg)
+
+        partial = SearchResult(itertools.islice(result_set.items(), self.size_limit))
+        partial.truncated = True
+        partial.reason    = msg
+        return partial
+
+    def __repr__(self) -> str:
+        return (f"SearchLimits(time_limit={self.time_limit}, server_time_limit={self.server_time_limit}, "
+                f"size_limit={self.size_limit}, poll_timeout={self.poll_timeout}, partial={self.partial})")
+
+
+class SearchResult(dict[str, Any]):
+    """The result of a search given limits: a dict from DN to attributes.
+
+    :ivar truncated: ``True`` if a limit stopped the search before the
+      server sent every entry.
+    :ivar reason: why the search was truncated (``None`` if it was not).
+    """
+    truncated: bool          = False
+    reason:    Optional[str] = None
@@ -0,0 +1,171 @@
+"""Sorted, windowed listings using server-side sorting and virtual list views.
+
+--------
+Overview
+--------
+
+Browsing a large tree a page at a time does not need the whole result
+set. Two LDAP controls let the server do the work:
+
+* the server-side sort control (RFC 2891) returns the entries ordered
+  by one or more attributes, and
+
+* the virtual list view (VLV) control returns only a window of that
+  sorted result: ``count`` entries starting at a given offset, along
+  with the server's estimate of the total number of entries.
+
+:py:meth:`stanford.green.ldap.LDAP.search` takes a ``sort_by`` argument
+(and, with it, ``offset`` and ``count``), and
+:py:meth:`~stanford.green.ldap.LDAP.search_window` and
+:py:meth:`~stanford.green.ldap.LDAP.search_page` return a
+:py:class:`ListingPage` holding the decoded entries of one window and
+where it falls in the whole listing.
+
+A sort key is an attribute name, optionally preceded by ``-`` to sort in
+descending order and followed by ``:`` and an ordering matching rule
+(e.g., ``-displayName`` or ``sn:caseIgnoreOrderingMatch``).
+
+The server must support the controls (for OpenLDAP, the ``sssvlv``
+overlay). Both are sent as critical, so a server that does not support
+them fails the search rather than returning unsorted entries.
+
+--------
+Examples
+--------
+
+Get entries 500 to 549 of the people tree sorted by display name::
+
+  from stanford.green.ldap import LDAP, BASEDN_PEOPLE
+
+  ldap1 = LDAP()
+  page  = ldap1.search_window(BASEDN_PEOPLE, 'displayName', offset=500, count=50,
+                              attrlist=['uid', 'displayName'])
+
+  for (dn, attributes) in page.entries.items():
+      print(attributes['displayName'])
+
+  print(f"{page.offset + 1} to {page.offset + len(page)} of about {page.total}")
+
+"""
+import logging
+
+from ldap.controls.sss import SSSRequestControl, SSSResponseControl  # type: ignore
+from ldap.controls.vlv import VLVRequestControl, VLVResponseControl  # type: ignore
+
+## TYPING
+from typing import Any, Optional
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+class GreenLDAPListingException(Exception):
+    """Used when the server could not sort or window a search"""
+    pass
+
+
+def sort_keys(sort_by: str|list[str]) -> list[str]:
+    """Return ``sort_by`` as a list of sort keys.
+
+    :raises ValueError: if there are no sort keys or one is malformed.
+    """
+    keys = [sort_by] if isinstance(sort_by, str) else list(sort_by)
+    if (not keys):
+        raise ValueError("at least one sort key is needed")
+
+    for key in keys:
+        attribute = key.lstrip('-').split(':')
+        if ((not attribute[0]) or (len(attribute) > 2)):
+            msg = f"'{key}' is not a sort key; use [-]<attribute>[:<ordering rule>]"
+            raise ValueError(msg)
+
+    return keys
+
+def sort_control(sort_by: str|list[str]) -> Any:
+    """Return a (critical) server-side sort request control."""
+    return SSSRequestControl(criticality=True, ordering_rules=sort_keys(sort_by))
+
+def view_control(offset: int, count: int, context_id: Optional[str] = None) -> Any:
+    """Return a (critical) VLV request control for ``count`` entries from ``offset``.
+
+    ``offset`` counts from 0 (the VLV control itself counts from 1).
+
+    :raises ValueError: if ``offset`` is negative or ``count`` is less than 1.
+    """
+    if (offset < 0):
+        raise ValueError(f"offset must be at least 0, not {offset}")
+    if (count < 1):
+        raise ValueError(f"count must be at least 1, not {count}")
+
+    # A content count of 0 tells the server to take the offset as given.
+    return VLVRequestControl(criticality=True, before_count=0, after_count=count - 1,
+                             offset=offset + 1, content_count=0, context_id=context_id)
+
+def check_sort_result(response_controls: list[Any]) -> None:
+    """Raise :py:exc:`GreenLDAPListingException` if the server reports the sort failed."""
+    for control in response_controls:
+        if ((control.controlType == SSSResponseControl.controlType) and control.result):
+            msg = f"server-side sort failed (result code {control.result}"
+            if (control.attribute_type_error):
+                msg += f", attribute {control.attribute_type_error}"
+            raise GreenLDAPListingException(msg + ")")
+
+
+class ListingPage():
+    """One window of a sorted listing.
+
+    :ivar entries: the decoded entries, a dict from DN to attributes (as
+      :py:meth:`stanford.green.ldap.LDAP.search` returns them) in sort order.
+    :ivar offset: the position of the first entry in the whole listing,
+      counting from 0. The server moves a window asked for past the end
+      of the listing back onto its last entry, so this can be less than
+      the offset asked for.
+    :ivar total: the server's estimate of the number of entries in the
+      whole listing.
+    :ivar context_id: the opaque VLV context the server returned, to pass
+      with the request for the next window (``None`` if there was none).
+    """
+    __slots__ = ('entries', 'offset', 'total', 'context_id')
+
+    def __init__(self,
+                 entries:    dict[str, Any],
+                 offset:     int,
+                 total:      int,
+                 context_id: Optional[str] = None):
+        self.entries    = entries
+        self.offset     = offset
+        self.total      = total
+        self.context_id = context_id
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def has_more(self) -> bool:
+        """``True`` if the listing has entries after this window."""
+        return (self.offset + len(self.entries)) < self.total
+
+    @classmethod
+    def from_response(cls, entries: dict[str, Any], response_controls: list[Any]) -> 'ListingPage':
+        """Build a page from the entries and response controls of a VLV search.
+
+        :raises GreenLDAPListingException: if the server reports the sort
+          or the view failed, or did not return a VLV response control.
+        """
+        check_sort_result(response_controls)
+
+        for control in response_controls:
+            if (control.controlType == VLVResponseControl.controlType):
+                if (control.result):
+                    msg = f"virtual list view failed (result code {control.result})"
+                    raise GreenLDAPListingException(msg)
+
+                logger.debug(f"VLV target position {control.target_position} of {control.content_count}")
+                return cls(entries, max(0, control.target_position - 1), control.content_count,
+                           control.context_id)
+
+        msg = "the server did not return a virtual list view response control"
+        raise GreenLDAPListingException(msg)
+
+    def __repr__(self) -> str:
+        return f"ListingPage(offset={self.offset}, entries={len(self.entries)}, total={self.total})"
@@ -0,0 +1,450 @@
+"""A local SQLite mirror of the account and people trees.
+
+--------
+Overview
+--------
+
+Services that only read SUNetID data can answer lookups from a local
+copy of the directory instead of searching ``ldap.stanford.edu`` each
+time. :py:class:`DirectoryMirror` keeps entries in an SQLite file in the
+same ``dn -> attributes`` shape :py:meth:`stanford.green.ldap.LDAP.search`
+returns, and has drop-in ``sunetid_info``, ``sunetid_people_info``, and
+``sunetid_account_info`` methods that read from it.
+
+Each entry is stored once as JSON. The values of ``uid``, ``suRegID``,
+``mail`` (see :py:data:`INDEXED_ATTRIBUTES`) and of every multi-valued
+attribute are also stored, lower-cased, in an indexed table so that
+:py:meth:`DirectoryMirror.lookup` can find entries by any of them (e.g.,
+everyone with a given ``suPrivilegeGroup``).
+
+The mirror is filled by
+
+* :py:meth:`DirectoryMirror.load_search`: stream a search into the
+  mirror (by default replacing what the mirror had under the same base DN),
+
+* :py:meth:`DirectoryMirror.load_jsonl`: load a dump written by
+  :py:mod:`stanford.green.ldap.export` (``.jsonl``, optionally compressed), or
+
+* :py:meth:`DirectoryMirror.apply_events`: apply the changes found by
+  :py:class:`stanford.green.ldap.sync.DirectorySync`.
+
+The database uses write-ahead logging, so readers (in any number of
+threads or processes) are not blocked while it is being loaded. Values
+of binary attributes are stored base64-encoded.
+
+--------
+Examples
+--------
+
+Load the trees once (e.g., from a nightly job)::
+
+  from stanford.green.ldap        import LDAP, BASEDN_ACCOUNTS, BASEDN_PEOPLE
+  from stanford.green.ldap.mirror import DirectoryMirror
+
+  ldap1  = LDAP()
+  mirror = DirectoryMirror('/var/lib/myapp/directory.sqlite3')
+  mirror.load_search(ldap1, BASEDN_ACCOUNTS)
+  mirror.load_search(ldap1, BASEDN_PEOPLE)
+
+and then look people up without going to the server::
+
+  mirror = DirectoryMirror('/var/lib/myapp/directory.sqlite3')
+  mirror.sunetid_info('jstanford')
+  mirror.lookup('mail', 'jstanford@stanford.edu')
+
+"""
+import bz2
+import gzip
+import json
+import logging
+import lzma
+import sqlite3
+import threading
+import time
+
+from stanford.green.ldap import LDAP, LDAPResult
+from stanford.green.ldap import BASEDN_ACCOUNTS, BASEDN_PEOPLE
+from stanford.green.ldap import GreenLDAPNoResultsException
+from stanford.green.ldap.export import text_value
+
+## TYPING
+from typing import Any, IO, Iterable, Optional, Tuple
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+# Single-valued attributes whose values are indexed (the values of every
+# multi-valued attribute are indexed too).
+INDEXED_ATTRIBUTES = frozenset({'uid', 'suregid', 'mail'})
+
+# Entries are written in transactions of this many.
+LOAD_BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    dn          TEXT PRIMARY KEY,
+    dn_lower    TEXT NOT NULL,
+    tree        TEXT NOT NULL,
+    generation  INTEGER NOT NULL,
+    attributes  TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_dn_lower ON entries (dn_lower);
+CREATE TABLE IF NOT EXISTS attribute_values (
+    dn          TEXT NOT NULL,
+    attribute   TEXT NOT NULL,
+    value       TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attribute_values_lookup ON attribute_values (attribute, value);
+CREATE INDEX IF NOT EXISTS attribute_values_dn ON attribute_values (dn);
+CREATE TABLE IF NOT EXISTS metadata (
+    key         TEXT PRIMARY KEY,
+    value       TEXT
+);
+"""
+
+def normalize_dn(dn: str) -> str:
+    """Return ``dn`` lower-cased and without spaces around the RDNs."""
+    return ','.join(rdn.strip() for rdn in dn.split(',')).lower()
+
+def tree_of(dn: str) -> str:
+    """Return ``'accounts'``, ``'people'``, or ``'other'`` for ``dn``."""
+    dn_lower = normalize_dn(dn)
+    if (dn_lower.endswith(BASEDN_ACCOUNTS)):
+        return 'accounts'
+    elif (dn_lower.endswith(BASEDN_PEOPLE)):
+        return 'people'
+    else:
+        return 'other'
+
+def open_dump(path: str) -> IO[str]:
+    """Open a (possibly gzip, bz2, or xz compressed) text dump for reading."""
+    if (path.endswith('.gz')):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    elif (path.endswith('.bz2')):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    elif (path.endswith('.xz')):
+        return lzma.open(path, 'rt', encoding='utf-8')
+    else:
+        return open(path, 'r', encoding='utf-8')
+
+
+class DirectoryMirror():
+    """An SQLite copy of directory entries with indexed lookups.
+
+    :param path: the SQLite database file (created if it does not exist).
+    :type path: str
+
+    :param timeout: seconds to wait for a lock held by another writer;
+      default: 30.
+    :type timeout: float
+
+    Each thread gets its own SQLite connection, so one mirror object can
+    be shared by the threads of an application.
+
+    """
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path    = path
+        self.timeout = timeout
+
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if (conn is None):
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+
+        return conn
+
+    def close(self) -> None:
+        """Close this thread's connection to the database."""
+        conn = getattr(self._local, 'conn', None)
+        if (conn is not None):
+            conn.close()
+            self._local.conn = None
+
+    ## Loading
+
+    @staticmethod
+    def _index_rows(dn: str, attribute_values: LDAPResult) -> list[Tuple[str, str, str]]:
+        rows = []
+        for (attribute, value) in attribute_values.items():
+            attribute = attribute.lower()
+            if (isinstance(value, list)):
+                for item in value:
+                    rows.append((dn, attribute, str(item).lower()))
+            elif (attribute in INDEXED_ATTRIBUTES):
+                rows.append((dn, attribute, str(value).lower()))
+
+        return rows
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: list[Tuple[str, Any]], generation: int) -> None:
+        dns = [(dn,) for (dn, _attribute_values) in batch]
+        conn.executemany('DELETE FROM attribute_values WHERE dn = ?', dns)
+
+        entry_rows = []
+        index_rows = []
+        for (dn, attribute_values) in batch:
+            attribute_values = {attribute: text_value(value) for (attribute, value) in attribute_values.items()}
+            entry_rows.append((dn, normalize_dn(dn), tree_of(dn), generation,
+                               json.dumps(attribute_values, ensure_ascii=False)))
+            index_rows.extend(self._index_rows(dn, attribute_values))
+
+        conn.executemany(
+            'INSERT OR REPLACE INTO entries (dn, dn_lower, tree, generation, attributes) VALUES (?, ?, ?, ?, ?)',
+            entry_rows,
+        )
+        conn.executemany('INSERT INTO attribute_values (dn, attribute, value) VALUES (?, ?, ?)', index_rows)
+
+    def load_entries(
+            self,
+            entries: Iterable[Tuple[str, Any]],
+            basedn:  Optional[str] = None,
+            replace: bool = False,
+    ) -> int:
+        """Add (or update) ``(dn, attributes)`` pairs in the mirror.
+
+        :param entries: the entries, e.g., ``search_result.items()``.
+        :type entries: Iterable
+
+        :param basedn: the base DN the entries were read from.
+        :type basedn: str
+
+        :param replace: if ``True`` (which needs ``basedn``) then, once all
+          entries are loaded, remove every entry at or below ``basedn``
+          that was not in ``entries``; default: ``False``.
+        :type replace: bool
+
+        :return: the number of entries loaded.
+        :rtype: int
+
+        Entries are committed in batches of :py:data:`LOAD_BATCH_SIZE`, so
+        readers see a load in progress as a mix of old and new entries.
+        """
+        if (replace and (basedn is None)):
+            msg = "replacing entries needs the basedn they were read from"
+            raise ValueError(msg)
+
+        conn       = self._connection()
+        generation = time.time_ns()
+
+        count = 0
+        batch: list[Tuple[str, Any]] = []
+        for entry in entries:
+            batch.append(entry)
+            if (len(batch) >= LOAD_BATCH_SIZE):
+                with conn:
+                    self._write_batch(conn, batch, generation)
+                count += len(batch)
+                batch = []
+
+        with conn:
+            if (batch):
+                self._write_batch(conn, batch, generation)
+                count += len(batch)
+
+            if (replace and (basedn is not None)):
+                basedn_lower = normalize_dn(basedn)
+                stale = ('SELECT dn FROM entries WHERE generation != ? '
+                         'AND (dn_lower = ? OR substr(dn_lower, -?) = ?)')
+                parameters = (generation, basedn_lower, len(basedn_lower) + 1, f",{basedn_lower}")
+                conn.execute(f"DELETE FROM attribute_values WHERE dn IN ({stale})", parameters)
+                removed = conn.execute(f"DELETE FROM entries WHERE dn IN ({stale})", parameters).rowcount
+                logger.info(f"removed {removed} entries no longer under {basedn}")
+
+            if (basedn is not None):
+                conn.execute('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)',
+                             (f"loaded_at:{normalize_dn(basedn)}", str(time.time())))
+
+        logger.info(f"loaded {count} entries into {self.path}")
+        return count
+
+    def load_search(
+            self,
+            ldap1:     LDAP,
+            basedn:    str,
+            filterstr: str='(objectClass=*)',
+            attrlist:  Optional[list[str]]=None,
+            replace:   bool=True,
+            page_size: int=500,
+    ) -> int:
+        """Stream the results of a search into the mirror.
+
+        By default the search replaces what the mirror had under
+        ``basedn`` (see :py:meth:`load_entries`); pass ``replace=False``
+        when the filter only selects some of the entries.
+
+        :return: the number of entries loaded.
+        :rtype: int
+        """
+        entries = ldap1.search_iter(basedn, filterstr=filterstr, attrlist=attrlist, page_size=page_size)
+        return self.load_entries(entries, basedn=basedn, replace=replace)
+
+    def load_jsonl(self, path: str, basedn: Optional[str] = None, replace: bool = False) -> int:
+        """Load a JSON Lines dump (one object per entry, with its DN in ``dn``).
+
+        The dump may be compressed (``.gz``, ``.bz2``, or ``.xz``).
+
+        :return: the number of entries loaded.
+        :rtype: int
+        """
+        def entries() -> Iterable[Tuple[str, Any]]:
+            with open_dump(path) as fh:
+                for line in fh:
+                    if (not line.strip()):
+                        continue
+                    record = json.loads(line)
+                    dn     = record.pop('dn')
+                    yield (dn, record)
+
+        return self.load_entries(entries(), basedn=basedn, replace=replace)
+
+    def apply_events(self, events: Iterable[Any]) -> dict[str, int]:
+        """Apply :py:class:`~stanford.green.ldap.sync.SyncEvent` changes.
+
+        :return: the number of events of each kind applied.
+        :rtype: dict[str, int]
+        """
+        conn   = self._connection()
+        counts = {'add': 0, 'modify': 0, 'delete': 0}
+
+        with conn:
+            generation = time.time_ns()
+            for event in events:
+                if (event.action == 'delete'):
+                    conn.execute('DELETE FROM attribute_values WHERE dn = ?', (event.dn,))
+                    conn.execute('DELETE FROM entries WHERE dn = ?', (event.dn,))
+                else:
+                    self._write_batch(conn, [(event.dn, event.attributes)], generation)
+                counts[event.action] += 1
+
+        return counts
+
+    def delete(self, dn: str) -> bool:
+        """Remove the entry ``dn``; return ``True`` if it was in the mirror."""
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM attribute_values WHERE dn = ?', (dn,))
+            return (conn.execute('DELETE FROM entries WHERE dn = ?', (dn,)).rowcount > 0)
+
+    ## Reading
+
+    @staticmethod
+    def _select(attribute_values: dict[str, Any], attrlist: Optional[list[str]]) -> dict[str, Any]:
+        if (attrlist is None):
+            return attribute_values
+
+        wanted = {attribute.lower() for attribute in attrlist}
+        return {attribute: value for (attribute, value) in attribute_values.items()
+                if (attribute.lower() in wanted)}
+
+    def get(self, dn: str, attrlist: Optional[list[str]] = None) -> Optional[dict[str, Any]]:
+        """Return the attributes of the entry ``dn``, or ``None`` if it is not in the mirror."""
+        row = self._connection().execute(
+            'SELECT attributes FROM entries WHERE dn_lower = ?', (normalize_dn(dn),)
+        ).fetchone()
+        if (row is None):
+            return None
+        else:
+            return self._select(json.loads(row[0]), attrlist)
+
+    def lookup(
+            self,
+            attribute: str,
+            value:     str,
+            tree:      Optional[str]=None,
+            attrlist:  Optional[list[str]]=None,
+    ) -> dict[str, LDAPResult]:
+        """Return the entries whose ``attribute`` has the value ``value``.
+
+        :param attribute: an indexed attribute: one of
+          :py:data:`INDEXED_ATTRIBUTES` or any multi-valued attribute.
+        :type attribute: str
+
+        :param value: the value to match (case-insensitively).
+        :type value: str
+
+        :param tree: only return entries in this tree (``'accounts'``,
+          ``'people'``, or ``'other'``); default: all.
+        :type tree: str
+
+        :param attrlist: the attributes to return; default: all.
+        :type attrlist: list[str]
+
+        :return: a dict from DN to attributes, like
+          :py:meth:`stanford.green.ldap.LDAP.search` (but empty rather than
+          raising an exception when nothing matches).
+        :rtype: dict
+        """
+        query = ('SELECT e.dn, e.attributes FROM attribute_values v JOIN entries e ON e.dn = v.dn '
+                 'WHERE v.attribute = ? AND v.value = ?')
+        parameters = [attribute.lower(), value.lower()]
+        if (tree is not None):
+            query += ' AND e.tree = ?'
+            parameters.append(tree)
+
+        results = {}
+        for (dn, attributes_json) in self._connection().execute(query, parameters):
+            results[dn] = self._select(json.loads(attributes_json), attrlist)
+
+        return results
+
+    def _sunetid_search(self, sunetid: str, tree: Optional[str], attrlist: Optional[list[str]]) -> dict[str, LDAPResult]:
+        results = self.lookup('uid', sunetid, tree=tree, attrlist=attrlist)
+        if (len(results) == 0):
+            msg = f"no results for uid={sunetid} in the mirror"
+            raise GreenLDAPNoResultsException(msg)
+
+        return results
+
+    def sunetid_account_info(self, sunetid: str, attrlist: Optional[list[str]]=None) -> dict[str, LDAPResult]:
+        """Return the account tree entry for ``sunetid``.
+
+        Like :py:meth:`stanford.green.ldap.LDAP.sunetid_account_info`
+        this raises :py:exc:`~stanford.green.ldap.GreenLDAPNoResultsException`
+        if there is no such entry.
+        """
+        return self._sunetid_search(sunetid, 'accounts', attrlist)
+
+    def sunetid_people_info(self, sunetid: str, attrlist: Optional[list[str]]=None) -> dict[str, LDAPResult]:
+        """Return the people tree entry for ``sunetid``.
+
+        Like :py:meth:`stanford.green.ldap.LDAP.sunetid_people_info`
+        this raises :py:exc:`~stanford.green.ldap.GreenLDAPNoResultsException`
+        if there is no such entry.
+        """
+        return self._sunetid_search(sunetid, 'people', attrlist)
+
+    def sunetid_info(self, sunetid: str, attrlist: Optional[list[str]]=None) -> dict[str, LDAPResult]:
+        """Return the account and people tree entries for ``sunetid``.
+
+        Like :py:meth:`stanford.green.ldap.LDAP.sunetid_info` this raises
+        :py:exc:`~stanford.green.ldap.GreenLDAPNoResultsException` if there
+        are no such entries.
+        """
+        return self._sunetid_search(sunetid, None, attrlist)
+
+    ## Bookkeeping
+
+    def loaded_at(self, basedn: str) -> Optional[float]:
+        """Return when ``basedn`` was last loaded (seconds since the epoch), if ever."""
+        row = self._connection().execute(
+            'SELECT value FROM metadata WHERE key = ?', (f"loaded_at:{normalize_dn(basedn)}",)
+        ).fetchone()
+        return None if (row is None) else float(row[0])
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of entries in each tree and of indexed values."""
+        conn  = self._connection()
+        stats = {'accounts': 0, 'people': 0, 'other': 0}
+        for (tree, count) in conn.execute('SELECT tree, COUNT(*) FROM entries GROUP BY tree'):
+            stats[tree] = count
+        stats['indexed_values'] = conn.execute('SELECT COUNT(*) FROM attribute_values').fetchone()[0]
+
+        return stats
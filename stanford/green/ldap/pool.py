@@ -0,0 +1,388 @@
+"""A thread-safe pool of bound LDAP connections.
+
+--------
+Overview
+--------
+
+Binding to an LDAP server with GSSAPI is expensive compared to the
+searches most applications do afterwards. The
+:py:class:`LDAPConnectionPool` class keeps a bounded set of already-bound
+connections that threads check out, use, and check back in.
+
+Connections are created by a *factory* (normally
+:py:meth:`stanford.green.ldap.LDAP.connect`), so the pool itself knows
+nothing about how to bind. Connections are
+
+* health-checked (with a "Who am I?" request) when they have been
+  idle for more than ``idle_check_seconds`` seconds,
+
+* recycled once they are more than ``max_lifetime`` seconds old, and
+
+* discarded and replaced (i.e., rebound) when they turn out to be dead.
+
+You will not usually create a pool directly; instead pass ``pool_size``
+to :py:class:`stanford.green.ldap.LDAP`.
+
+--------
+Examples
+--------
+
+Use a pool directly::
+
+  from stanford.green.ldap      import LDAP
+  from stanford.green.ldap.pool import LDAPConnectionPool
+
+  ldap1 = LDAP(connect_on_init=False)
+  pool  = LDAPConnectionPool(ldap1.connect, size=8)
+
+  with pool.connection() as conn:
+      conn.whoami_s()
+
+  print(pool.stats())
+
+"""
+import collections
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import ldap      # type: ignore
+
+## TYPING
+from typing import Any, Callable, Iterator, Optional
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+# These python-ldap exceptions mean the connection itself is unusable
+# (as opposed to, say, a search that found nothing).
+DEAD_CONNECTION_EXCEPTIONS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.UNAVAILABLE)
+
+class GreenLDAPPoolTimeout(Exception):
+    """Used when no pooled connection becomes available in time"""
+    pass
+
+class GreenLDAPPoolClosed(Exception):
+    """Used when checking out a connection from a closed pool"""
+    pass
+
+
+class PooledConnection():
+    """A bound LDAP connection together with its pool bookkeeping.
+
+    :param conn: a bound python-ldap connection object.
+    :type conn: Any
+
+    :param generation: the pool generation the connection was created in.
+    :type generation: int
+
+    """
+    def __init__(self, conn: Any, generation: int):
+        self.conn       = conn
+        self.generation = generation
+        self.created_at = time.monotonic()
+        self.last_used  = self.created_at
+
+    def age(self) -> float:
+        """Seconds since this connection was created."""
+        return time.monotonic() - self.created_at
+
+    def idle_time(self) -> float:
+        """Seconds since this connection was last checked in."""
+        return time.monotonic() - self.last_used
+
+    def close(self) -> None:
+        """Unbind the connection, ignoring any errors."""
+        try:
+            self.conn.unbind_s()
+        except Exception as excpt:
+            logger.debug(f"error unbinding pooled connection: {excpt}")
+
+
+class LDAPConnectionPool():
+    """A bounded, thread-safe pool of bound LDAP connections.
+
+    :param factory: a callable taking no arguments that returns a new
+      bound python-ldap connection object.
+    :type factory: Callable[[], Any]
+
+    :param size: the maximum number of connections (idle plus checked
+      out) the pool will hold; default: 4.
+    :type size: int
+
+    :param max_lifetime: connections older than this many seconds are
+      closed and replaced when next checked out or checked in; default: 3600.
+    :type max_lifetime: float
+
+    :param idle_check_seconds: connections idle for longer than this many
+      seconds are health-checked before being handed out; default: 60.
+    :type idle_check_seconds: float
+
+    :param checkout_timeout: the number of seconds :py:meth:`checkout`
+      waits for a free connection before raising
+      :py:exc:`GreenLDAPPoolTimeout`; default: 10.
+    :type checkout_timeout: float
+
+    :param prefill: if ``True`` create and bind all ``size`` connections
+      when the pool is created so that no request pays for a bind;
+      default: ``True``.
+    :type prefill: bool
+
+    """
+    def __init__(self,
+                 factory:            Callable[[], Any],
+                 size:               int   = 4,
+                 max_lifetime:       float = 3600.0,
+                 idle_check_seconds: float = 60.0,
+                 checkout_timeout:   float = 10.0,
+                 prefill:            bool  = True):
+        if (size < 1):
+            msg = "the pool size must be at least 1"
+            raise ValueError(msg)
+
+        self.factory            = factory
+        self.size               = size
+        self.max_lifetime       = max_lifetime
+        self.idle_check_seconds = idle_check_seconds
+        self.checkout_timeout   = checkout_timeout
+
+        self._cond       = threading.Condition(threading.Lock())
+        self._idle: collections.deque[PooledConnection] = collections.deque()
+        self._total      = 0     # idle + checked out + being created
+        self._generation = 0
+        self._closed     = False
+
+        self._stats = {
+            'checkouts':             0,
+            'waits':                 0,
+            'timeouts':              0,
+            'created':               0,
+            'create_failures':       0,
+            'recycled':              0,
+            'health_checks':         0,
+            'health_check_failures': 0,
+            'discarded':             0,
+        }
+
+        if (prefill):
+            self.fill()
+
+    def _count(self, stat: str) -> None:
+        # Callers must hold self._cond.
+        self._stats[stat] += 1
+
+    def _create(self) -> PooledConnection:
+        """Call the factory; the caller must already have reserved a slot."""
+        try:
+            conn = self.factory()
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._count('create_failures')
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._count('created')
+            generation = self._generation
+
+        return PooledConnection(conn, generation)
+
+    def _is_healthy(self, pooled: PooledConnection) -> bool:
+        with self._cond:
+            self._count('health_checks')
+
+        try:
+            pooled.conn.whoami_s()
+        except ldap.LDAPError as excpt:
+            logger.info(f"pooled LDAP connection failed health check: {excpt}")
+            with self._cond:
+                self._count('health_check_failures')
+            return False
+        else:
+            return True
+
+    def _replace(self, pooled: PooledConnection) -> PooledConnection:
+        """Close ``pooled`` and return a new connection in its slot."""
+        pooled.close()
+        return self._create()
+
+    def fill(self) -> None:
+        """Create connections until the pool holds ``size`` of them."""
+        while True:
+            with self._cond:
+                if (self._closed or (self._total >= self.size)):
+                    return
+                self._total += 1
+
+            pooled = self._create()
+            with self._cond:
+                self._idle.append(pooled)
+                self._cond.notify()
+
+    def checkout(self, timeout: Optional[float] = None) -> PooledConnection:
+        """Check out a healthy connection, waiting if all are in use.
+
+        :param timeout: seconds to wait for a free connection; defaults to
+          ``self.checkout_timeout``.
+        :type timeout: float
+
+        :return: the checked-out connection; pass it back to :py:meth:`checkin`
+          when done with it.
+        :rtype: PooledConnection
+
+        :raises GreenLDAPPoolTimeout: if no connection became free in time.
+        :raises GreenLDAPPoolClosed: if the pool has been closed.
+        """
+        if (timeout is None):
+            timeout = self.checkout_timeout
+
+        deadline = time.monotonic() + timeout
+        pooled: Optional[PooledConnection] = None
+        with self._cond:
+            waited = False
+            while True:
+                if (self._closed):
+                    msg = "the LDAP connection pool is closed"
+                    raise GreenLDAPPoolClosed(msg)
+
+                if (self._idle):
+                    # LIFO: the most recently used connection is the one
+                    # least likely to have been dropped by the server.
+                    pooled = self._idle.pop()
+                    break
+
+                if (self._total < self.size):
+                    # Reserve a slot; we create the connection outside the lock.
+                    self._total += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0):
+                    self._count('timeouts')
+                    msg = f"no LDAP connection became available within {timeout} seconds"
+                    raise GreenLDAPPoolTimeout(msg)
+
+                if (not waited):
+                    self._count('waits')
+                    waited = True
+
+                self._cond.wait(remaining)
+
+            self._count('checkouts')
+
+        if (pooled is None):
+            return self._create()
+
+        if (pooled.age() > self.max_lifetime):
+            logger.debug("recycling pooled LDAP connection (max lifetime reached)")
+            with self._cond:
+                self._count('recycled')
+            return self._replace(pooled)
+
+        if ((pooled.idle_time() > self.idle_check_seconds) and (not self._is_healthy(pooled))):
+            logger.debug("rebinding dead pooled LDAP connection")
+            return self._replace(pooled)
+
+        return pooled
+
+    def checkin(self, pooled: PooledConnection, discard: bool = False) -> None:
+        """Return a checked-out connection to the pool.
+
+        :param pooled: the connection returned by :py:meth:`checkout`.
+        :type pooled: PooledConnection
+
+        :param discard: set to ``True`` if the connection is known to be
+          broken; it is closed and its slot freed for a new connection.
+        :type discard: bool
+        """
+        with self._cond:
+            stale = (pooled.generation != self._generation)
+            too_old = (pooled.age() > self.max_lifetime)
+            keep = not (discard or self._closed or stale or too_old)
+
+            if (keep):
+                pooled.last_used = time.monotonic()
+                self._idle.append(pooled)
+            else:
+                self._total -= 1
+                if (discard):
+                    self._count('discarded')
+                elif (too_old or stale):
+                    self._count('recycled')
+
+            self._cond.notify()
+
+        if (not keep):
+            pooled.close()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[Any]:
+        """Context manager that checks out a connection and checks it back in.
+
+        If the body raises one of the exceptions indicating the connection
+        is dead (e.g., ``ldap.SERVER_DOWN``) the connection is discarded
+        rather than returned to the pool.
+        """
+        pooled = self.checkout(timeout=timeout)
+        discard = False
+        try:
+            yield pooled.conn
+        except DEAD_CONNECTION_EXCEPTIONS:
+            discard = True
+            raise
+        finally:
+            self.checkin(pooled, discard=discard)
+
+    def recycle_all(self) -> None:
+        """Replace every connection in the pool.
+
+        Idle connections are closed immediately; connections currently
+        checked out are closed when they are checked in. New connections
+        are created on demand.
+        """
+        with self._cond:
+            self._generation += 1
+            idle = list(self._idle)
+            self._idle.clear()
+            self._total -= len(idle)
+            for _ in idle:
+                self._count('recycled')
+            self._cond.notify_all()
+
+        for pooled in idle:
+            pooled.close()
+
+    def close(self) -> None:
+        """Close all idle connections and refuse further checkouts.
+
+        Connections still checked out are closed when checked in.
+        """
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._total -= len(idle)
+            self._cond.notify_all()
+
+        for pooled in idle:
+            pooled.close()
+
+    def stats(self) -> dict[str, int]:
+        """Return a snapshot of the pool counters.
+
+        Besides the running counters (``checkouts``, ``waits``,
+        ``timeouts``, ``created``, ``create_failures``, ``recycled``,
+        ``health_checks``, ``health_check_failures``, and ``discarded``)
+        the returned dict has the current ``size``, ``idle``, and
+        ``in_use`` connection counts.
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size']   = self.size
+            stats['idle']   = len(self._idle)
+            stats['in_use'] = self._total - len(self._idle)
+
+        return stats
@@ -0,0 +1,196 @@
+"""Renew the Kerberos ticket and rebind before the ticket expires.
+
+--------
+Overview
+--------
+
+An :py:class:`stanford.green.ldap.LDAP` object binds with GSSAPI, so its
+connections are only as good as the Kerberos ticket they were bound
+with. Given a :py:class:`stanford.green.kerberos.KerberosTicket` (the
+``kerberos_ticket`` argument), the object uses a
+:py:class:`CredentialRenewer` to renew the ticket and rebind in a
+background thread some time *before* the ticket expires, so that no
+request waits for :command:`kinit` or a bind, and no request fails
+because the ticket has expired.
+
+The renewal time is chosen at random in the window from ``margin``
+seconds before the expiry back to ``margin * (1 + jitter)`` seconds
+before it. Workers sharing a ticket file therefore do not all renew and
+rebind at the same moment: the first to renew gets a new ticket (under
+the ticket file's lock) and the others find the ticket already renewed
+and only rebind.
+
+If the expiry cannot be read from the ticket file the renewal is done
+every ``fallback_interval`` seconds instead; a renewal that fails is
+retried after ``retry_seconds`` seconds. Renewals are never less than
+``retry_seconds`` seconds apart, so a ticket whose lifetime is shorter
+than the margin is renewed every ``retry_seconds`` seconds rather than
+over and over.
+
+--------
+Examples
+--------
+
+::
+
+  from stanford.green.kerberos import KerberosTicket
+  from stanford.green.ldap     import LDAP
+
+  kt    = KerberosTicket('/etc/krb5.keytab', 'host/myserver.stanford.edu@stanford.edu',
+                         '/tmp/krb5cc_myapp')
+  ldap1 = LDAP(pool_size=4, kerberos_ticket=kt, rebind_margin=600)
+
+  print(ldap1.rebind_stats())
+
+"""
+import logging
+import random
+import threading
+import time
+
+## TYPING
+from typing import Any, Callable, Optional
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+class CredentialRenewer():
+    """Call ``renew`` in a daemon thread shortly before a credential expires.
+
+    :param renew: a callable that renews the credential (and rebinds) and
+      returns its new expiry in seconds since the epoch, or ``None`` if
+      that is not known. An exception means the renewal failed.
+    :type renew: Callable[[], Optional[float]]
+
+    :param margin: renew at least this many seconds before the expiry;
+      default: 600.
+    :type margin: float
+
+    :param jitter: renew up to ``jitter * margin`` seconds earlier still,
+      chosen at random for each renewal; default: 0.5.
+    :type jitter: float
+
+    :param retry_seconds: seconds to wait before retrying a failed
+      renewal, and the least time between renewals; default: 30.
+    :type retry_seconds: float
+
+    :param fallback_interval: seconds between renewals while the expiry
+      is not known; default: 3600.
+    :type fallback_interval: float
+
+    The object is thread-safe. Call :py:meth:`schedule` with the expiry
+    of the current credential and :py:meth:`start` to begin renewing.
+    """
+    def __init__(self,
+                 renew:             Callable[[], Optional[float]],
+                 margin:            float = 600.0,
+                 jitter:            float = 0.5,
+                 retry_seconds:     float = 30.0,
+                 fallback_interval: float = 3600.0):
+        if (margin < 0):
+            msg = f"margin must be at least 0, not {margin}"
+            raise ValueError(msg)
+        if (retry_seconds <= 0):
+            msg = f"retry_seconds must be positive, not {retry_seconds}"
+            raise ValueError(msg)
+        if (not (0 <= jitter <= 1)):
+            msg = f"jitter must be between 0 and 1, not {jitter}"
+            raise ValueError(msg)
+
+        self.renew             = renew
+        self.margin            = margin
+        self.jitter            = jitter
+        self.retry_seconds     = retry_seconds
+        self.fallback_interval = fallback_interval
+
+        self.expiry: Optional[float] = None
+        self.next_renewal = time.time() + fallback_interval
+
+        self._lock   = threading.Lock()
+        self._wake   = threading.Event()
+        self._stop   = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._stats = {
+            'renewals': 0,
+            'failures': 0,
+        }
+
+    def schedule(self, expiry: Optional[float]) -> float:
+        """Plan the next renewal for a credential expiring at ``expiry``; return when that is.
+
+        Both times are in seconds since the epoch.
+        """
+        now = time.time()
+        with self._lock:
+            self.expiry = expiry
+            if (expiry is None):
+                self.next_renewal = now + self.fallback_interval
+            else:
+                # A credential that does not outlive the margin would
+                # otherwise be renewed again at once, and again after that.
+                early = random.uniform(0, self.jitter * self.margin)
+                self.next_renewal = max(now + self.retry_seconds, expiry - self.margin - early)
+            next_renewal = self.next_renewal
+
+        self._wake.set()
+        logger.debug(f"next credential renewal in {next_renewal - now:.0f} seconds")
+        return next_renewal
+
+    def seconds_until_renewal(self) -> float:
+        with self._lock:
+            return max(0.0, self.next_renewal - time.time())
+
+    def renew_now(self) -> bool:
+        """Renew now and schedule the next renewal; return ``True`` if the renewal worked."""
+        try:
+            expiry = self.renew()
+        except Exception:
+            logger.exception("credential renewal failed")
+            with self._lock:
+                self._stats['failures'] += 1
+                self.next_renewal = time.time() + self.retry_seconds
+            return False
+
+        with self._lock:
+            self._stats['renewals'] += 1
+        self.schedule(expiry)
+        return True
+
+    def _run(self) -> None:
+        while (not self._stop.is_set()):
+            wait = self.seconds_until_renewal()
+            if (wait > 0):
+                # Wake up at least once a minute in case the clock jumps.
+                self._wake.clear()
+                self._wake.wait(min(wait, 60.0))
+                continue
+            self.renew_now()
+
+    def start(self) -> None:
+        """Start renewing in a daemon thread (if not already started)."""
+        with self._lock:
+            if (self._thread is not None):
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ldap-credential-renewal', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the renewal thread."""
+        with self._lock:
+            thread       = self._thread
+            self._thread = None
+        self._stop.set()
+        self._wake.set()
+        if (thread is not None):
+            thread.join()
+
+    def stats(self) -> dict[str, Any]:
+        """Return the counters along with the current ``expiry`` and ``next_renewal`` times."""
+        with self._lock:
+            stats: dict[str, Any] = dict(self._stats)
+            stats['expiry']       = self.expiry
+            stats['next_renewal'] = self.next_renewal
+            return stats
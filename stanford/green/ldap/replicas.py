@@ -0,0 +1,304 @@
+"""Latency-aware selection of LDAP replicas.
+
+.. _exponential-backoff-ca: https://github.com/macrotex/python-exponential-backoff-ca
+
+--------
+Overview
+--------
+
+When :py:class:`stanford.green.ldap.LDAP` is given a list of replica
+hosts it uses a :py:class:`ReplicaSet` to decide which one each
+operation goes to.
+
+* A background thread *probes* every host every ``probe_interval``
+  seconds (by default by reading the root DSE anonymously) and keeps an
+  exponentially weighted moving average (EWMA) of the round-trip times.
+
+* Operations go to the healthy host with the lowest average; hosts that
+  failed recently come after those that did not.
+
+* After ``failure_threshold`` consecutive failures (of operations or of
+  probes) a host is *ejected*: it gets no operations until a probe
+  succeeds. Ejected hosts are probed with waits drawn from an
+  `ExponentialBackoff <exponential-backoff-ca_>`_ iterator, so a host that
+  stays down is probed less and less often.
+
+If every host is ejected, operations go to the one due to be probed
+soonest rather than failing outright.
+
+--------
+Examples
+--------
+
+::
+
+  from stanford.green.ldap import LDAP
+
+  ldap1 = LDAP(host=['ldap1.stanford.edu', 'ldap2.stanford.edu', 'ldap3.stanford.edu'],
+               pool_size=4)
+  ldap1.sunetid_info('jstanford')
+  print(ldap1.replica_stats())
+
+"""
+import logging
+import threading
+import time
+
+import ldap  # type: ignore
+
+from exponential_backoff_ca import ExponentialBackoff
+
+## TYPING
+from typing import Any, Callable, Optional
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+def probe_root_dse(host: str, timeout: float = 5.0) -> None:
+    """Read the root DSE of ``host`` anonymously; raise if that fails."""
+    ldap_conn = ldap.initialize(f"ldap://{host}")
+    try:
+        ldap_conn.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+        ldap_conn.set_option(ldap.OPT_TIMEOUT, timeout)
+        ldap_conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['1.1'])
+    finally:
+        ldap_conn.unbind_s()
+
+
+class Replica():
+    """What a :py:class:`ReplicaSet` knows about one host.
+
+    :ivar host: the host name.
+    :ivar rtt: the moving average of the probe round-trip times in
+      seconds (``None`` until the first probe).
+    :ivar failures: the number of consecutive failures.
+    :ivar ejected: ``True`` while the host is out of rotation.
+    :ivar next_probe: when (a :py:func:`time.monotonic` value) the host is
+      next probed.
+    """
+    __slots__ = ('host', 'rtt', 'failures', 'ejected', 'next_probe', 'backoff',
+                 'probes', 'probe_failures', 'ejections')
+
+    def __init__(self, host: str):
+        self.host                  = host
+        self.rtt: Optional[float]  = None
+        self.failures              = 0
+        self.ejected               = False
+        self.next_probe            = 0.0
+        self.backoff: Optional[ExponentialBackoff] = None
+
+        self.probes         = 0
+        self.probe_failures = 0
+        self.ejections      = 0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            'rtt_ms':         None if (self.rtt is None) else self.rtt * 1000,
+            'failures':       self.failures,
+            'ejected':        self.ejected,
+            'probes':         self.probes,
+            'probe_failures': self.probe_failures,
+            'ejections':      self.ejections,
+        }
+
+
+class ReplicaSet():
+    """Pick the fastest healthy host of a set of replicas.
+
+    :param hosts: the host names, in order of preference (used until
+      there are round-trip times to go by).
+    :type hosts: list[str]
+
+    :param probe: a callable taking a host name that raises an exception
+      if the host is not usable; default: :py:func:`probe_root_dse`.
+    :type probe: Callable[[str], Any]
+
+    :param probe_interval: seconds between probes of a healthy host;
+      default: 30.
+    :type probe_interval: float
+
+    :param alpha: the weight of each new round-trip time in the moving
+      average (between 0 and 1); default: 0.3.
+    :type alpha: float
+
+    :param failure_threshold: the number of consecutive failures that
+      ejects a host; default: 2.
+    :type failure_threshold: int
+
+    :param backoff_slot_seconds: the slot time of the
+      ``ExponentialBackoff`` between probes of an ejected host; default: 1.
+    :type backoff_slot_seconds: float
+
+    :param backoff_iterations: the number of ``ExponentialBackoff``
+      iterations; after that an ejected host is probed every
+      ``max_probe_wait`` seconds; default: 8.
+    :type backoff_iterations: int
+
+    :param max_probe_wait: the longest wait between probes of an ejected
+      host; default: 60.
+    :type max_probe_wait: float
+
+    The object is thread-safe. Probes run in a daemon thread started by
+    :py:meth:`start` (or are run one round at a time by calling
+    :py:meth:`run_probes`).
+    """
+    def __init__(self,
+                 hosts:                list[str],
+                 probe:                Optional[Callable[[str], Any]] = None,
+                 probe_interval:       float = 30.0,
+                 alpha:                float = 0.3,
+                 failure_threshold:    int   = 2,
+                 backoff_slot_seconds: float = 1.0,
+                 backoff_iterations:   int   = 8,
+                 max_probe_wait:       float = 60.0):
+        if (not hosts):
+            msg = "at least one replica host is needed"
+            raise ValueError(msg)
+        if (not (0 < alpha <= 1)):
+            msg = f"alpha must be between 0 and 1, not {alpha}"
+            raise ValueError(msg)
+
+        self.probe                = probe if (probe is not None) else probe_root_dse
+        self.probe_interval       = probe_interval
+        self.alpha                = alpha
+        self.failure_threshold    = failure_threshold
+        self.backoff_slot_seconds = backoff_slot_seconds
+        self.backoff_iterations   = backoff_iterations
+        self.max_probe_wait       = max_probe_wait
+
+        self.replicas = [Replica(host) for host in hosts]
+        self._by_host = {replica.host: replica for replica in self.replicas}
+
+        self._lock   = threading.Lock()
+        self._stop   = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def hosts(self) -> list[str]:
+        return [replica.host for replica in self.replicas]
+
+    ## Selection
+
+    def choose(self) -> str:
+        """Return the host the next operation should go to."""
+        with self._lock:
+            candidates = [replica for replica in self.replicas if (not replica.ejected)]
+            if (not candidates):
+                return min(self.replicas, key=lambda replica: replica.next_probe).host
+
+            # min() keeps the first of equals, so the order of the hosts
+            # decides until there are round-trip times.
+            best = min(candidates, key=lambda replica: (replica.failures, replica.rtt or 0.0))
+            return best.host
+
+    def record_success(self, host: str, rtt: Optional[float] = None) -> None:
+        """Note that ``host`` worked, taking ``rtt`` seconds if given."""
+        with self._lock:
+            replica = self._by_host[host]
+            replica.failures = 0
+            if (rtt is not None):
+                replica.rtt = rtt if (replica.rtt is None) else (self.alpha * rtt + (1 - self.alpha) * replica.rtt)
+
+            if (replica.ejected):
+                replica.ejected    = False
+                replica.backoff    = None
+                replica.next_probe = time.monotonic() + self.probe_interval
+                logger.warning(f"LDAP replica {host} is back in rotation")
+
+    def record_failure(self, host: str) -> None:
+        """Note that ``host`` failed, ejecting it after enough failures in a row."""
+        with self._lock:
+            replica = self._by_host[host]
+            replica.failures += 1
+            if (replica.ejected):
+                replica.next_probe = time.monotonic() + self._next_backoff(replica)
+            elif (replica.failures >= self.failure_threshold):
+                replica.ejected    = True
+                replica.ejections += 1
+                replica.backoff    = ExponentialBackoff(self.backoff_slot_seconds, self.backoff_iterations,
+                                                        limit_value=self.max_probe_wait)
+                replica.next_probe = time.monotonic() + self._next_backoff(replica)
+                logger.warning(f"LDAP replica {host} taken out of rotation after {replica.failures} failures")
+
+    def _next_backoff(self, replica: Replica) -> float:
+        # The caller must hold self._lock.
+        try:
+            return float(next(replica.backoff)) if (replica.backoff is not None) else self.max_probe_wait
+        except StopIteration:
+            return self.max_probe_wait
+
+    ## Probing
+
+    def probe_host(self, host: str) -> bool:
+        """Probe ``host`` now, recording the outcome; return ``True`` if it worked."""
+        start = time.perf_counter()
+        try:
+            self.probe(host)
+        except Exception as excpt:
+            logger.info(f"probe of LDAP replica {host} failed: {excpt}")
+            self.record_failure(host)
+            with self._lock:
+                replica = self._by_host[host]
+                replica.probes         += 1
+                replica.probe_failures += 1
+                if (not replica.ejected):
+                    # Check again soon rather than after a full interval.
+                    replica.next_probe = time.monotonic() + min(self.probe_interval, self.backoff_slot_seconds)
+            return False
+
+        rtt = time.perf_counter() - start
+        with self._lock:
+            replica = self._by_host[host]
+            replica.probes += 1
+            if (not replica.ejected):
+                replica.next_probe = time.monotonic() + self.probe_interval
+        self.record_success(host, rtt)
+        return True
+
+    def run_probes(self) -> int:
+        """Probe every host that is due; return the number probed."""
+        now = time.monotonic()
+        with self._lock:
+            due = [replica.host for replica in self.replicas if (replica.next_probe <= now)]
+
+        for host in due:
+            self.probe_host(host)
+
+        return len(due)
+
+    def seconds_until_next_probe(self) -> float:
+        with self._lock:
+            next_probe = min(replica.next_probe for replica in self.replicas)
+        return max(0.0, next_probe - time.monotonic())
+
+    def _run(self) -> None:
+        while (not self._stop.is_set()):
+            try:
+                self.run_probes()
+            except Exception:
+                logger.exception("LDAP replica probing failed")
+            self._stop.wait(min(self.seconds_until_next_probe(), self.probe_interval))
+
+    def start(self) -> None:
+        """Start probing in a daemon thread (if not already started)."""
+        with self._lock:
+            if (self._thread is not None):
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ldap-replica-probe', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the probing thread."""
+        with self._lock:
+            thread       = self._thread
+            self._thread = None
+        self._stop.set()
+        if (thread is not None):
+            thread.join()
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Return what is known about each host, keyed by host name."""
+        with self._lock:
+            return {replica.host: replica.as_dict() for replica in self.replicas}
@@ -0,0 +1,360 @@
+"""An attribute registry built from the server schema.
+
+--------
+Overview
+--------
+
+To decode a search entry we need to know, for each attribute, whether it
+is single- or multi-valued and whether its values are text or binary.
+:py:class:`AttributeRegistry` answers both questions with case-insensitive
+O(1) lookups.
+
+A registry starts from a static multiplicity table (by default the
+tables in :py:mod:`stanford.green.ldap`) and can be updated from the
+server's subschema subentry, which lists every attribute type with its
+``SINGLE-VALUE`` flag and syntax. Reading the subschema takes a while, so
+the result can be saved to a local JSON file and loaded from there
+quickly the next time the application starts (see
+:py:meth:`stanford.green.ldap.LDAP.load_schema`).
+
+Attributes the registry does not know are decoded as multi-valued text
+where their values are valid UTF-8 and left as byte-strings where they
+are not, so decoding never fails on an unknown attribute. Attributes
+requested with the ``;binary`` option are always left as byte-strings.
+
+--------
+Examples
+--------
+
+Load the server schema (using a cache file that is at most a day old)::
+
+  from stanford.green.ldap import LDAP
+
+  ldap1 = LDAP()
+  ldap1.load_schema('/var/cache/myapp/ldap-schema.json')
+
+  ldap1.registry.is_single_valued('suseasemailsystem')  # True
+  ldap1.registry.is_single_valued('noSuchAttribute')    # None
+
+"""
+import functools
+import json
+import logging
+import os
+import time
+
+import ldap         # type: ignore
+import ldap.schema  # type: ignore
+
+## TYPING
+from typing import Any, Iterable, Optional, Tuple
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+# LDAP syntaxes whose values are not text; values of attributes with
+# these syntaxes are left as byte-strings.
+BINARY_SYNTAXES = frozenset({
+    '1.3.6.1.4.1.1466.115.121.1.4',   # Audio
+    '1.3.6.1.4.1.1466.115.121.1.5',   # Binary
+    '1.3.6.1.4.1.1466.115.121.1.8',   # Certificate
+    '1.3.6.1.4.1.1466.115.121.1.9',   # Certificate List
+    '1.3.6.1.4.1.1466.115.121.1.10',  # Certificate Pair
+    '1.3.6.1.4.1.1466.115.121.1.23',  # Fax
+    '1.3.6.1.4.1.1466.115.121.1.28',  # JPEG
+    '1.3.6.1.4.1.1466.115.121.1.40',  # Octet String
+})
+
+# The most decoding plans an AttributeRegistry memoizes (one per distinct
+# tuple of attribute names).
+PLAN_CACHE_SIZE = 1024
+
+def decode_lenient(value: bytes) -> str|bytes:
+    """Return ``value`` decoded from UTF-8, or ``value`` itself if it is not valid UTF-8."""
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value
+
+
+class DecodingPlan():
+    """How to decode entries having a particular tuple of attribute names.
+
+    :ivar text: ``(attribute_name, single_valued)`` pairs of the attributes
+      whose values are decoded from UTF-8.
+    :ivar binary: ``(attribute_name, single_valued)`` pairs of the
+      attributes whose values are left as byte-strings.
+    :ivar unknown: ``(attribute_name, single_valued)`` pairs of the
+      attributes the registry does not know, whose values are decoded with
+      :py:func:`decode_lenient`.
+    """
+    __slots__ = ('text', 'binary', 'unknown')
+
+    def __init__(self,
+                 text:    Tuple[Tuple[str, bool], ...],
+                 binary:  Tuple[Tuple[str, bool], ...],
+                 unknown: Tuple[Tuple[str, bool], ...] = ()):
+        self.text    = text
+        self.binary  = binary
+        self.unknown = unknown
+
+
+class MultiplicityIndex():
+    """A frozen, case-insensitive index of a static multiplicity table.
+
+    :param multiplicity: a mapping from attribute name to ``'single'`` or
+      ``'multi'``.
+    :type multiplicity: dict[str, str]
+
+    Unlike :py:class:`AttributeRegistry` this never changes after it is
+    built, so it is safe to share and its lookups are plain ``frozenset``
+    membership tests. The sets hold each name both as spelled in the
+    table and case-folded, so the usual spelling is found without
+    folding it first.
+
+    :ivar single: the names of the single-valued attributes.
+    :ivar multi: the names of the multi-valued attributes.
+    """
+    __slots__ = ('single', 'multi')
+
+    single: frozenset[str]
+    multi:  frozenset[str]
+
+    def __init__(self, multiplicity: dict[str, str]):
+        single: set[str] = set()
+        multi:  set[str] = set()
+        for (name, value) in multiplicity.items():
+            names = single if (value == 'single') else multi
+            names.add(name)
+            names.add(name.casefold())
+
+        object.__setattr__(self, 'single', frozenset(single))
+        object.__setattr__(self, 'multi', frozenset(multi))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __len__(self) -> int:
+        return len({name.casefold() for name in self.single | self.multi})
+
+    def __contains__(self, attribute_name: str) -> bool:
+        return self.is_single_valued(attribute_name) is not None
+
+    def is_single_valued(self, attribute_name: str) -> Optional[bool]:
+        """Return ``True`` or ``False``, or ``None`` if the attribute is unknown."""
+        if (attribute_name in self.single):
+            return True
+        elif (attribute_name in self.multi):
+            return False
+
+        key = attribute_name.casefold()
+        if (key in self.single):
+            return True
+        elif (key in self.multi):
+            return False
+        else:
+            return None
+
+    def classify(self, attribute_name: str) -> Optional[str]:
+        """Return ``'single'``, ``'multi'``, or ``None`` if the attribute is unknown."""
+        single_valued = self.is_single_valued(attribute_name)
+        if (single_valued is None):
+            return None
+        else:
+            return 'single' if single_valued else 'multi'
+
+    def classify_all(self, attribute_names: Iterable[str]) -> list[Optional[str]]:
+        """Return :py:meth:`classify` of each of ``attribute_names``, in order."""
+        single = self.single
+        multi  = self.multi
+        return [('single' if (name in single) else 'multi' if (name in multi) else self.classify(name))
+                for name in attribute_names]
+
+    def partition(self, attribute_names: Iterable[str]) -> Tuple[list[str], list[str], list[str]]:
+        """Split ``attribute_names`` into single-valued, multi-valued, and unknown ones.
+
+        :return: three lists of the names (as given, in order).
+        """
+        single_names:  list[str] = []
+        multi_names:   list[str] = []
+        unknown_names: list[str] = []
+        for name in attribute_names:
+            single_valued = self.is_single_valued(name)
+            if (single_valued is None):
+                unknown_names.append(name)
+            elif (single_valued):
+                single_names.append(name)
+            else:
+                multi_names.append(name)
+
+        return (single_names, multi_names, unknown_names)
+
+
+class AttributeRegistry():
+    """Case-insensitive attribute multiplicity and syntax information.
+
+    :param multiplicity: a mapping from attribute name to ``'single'`` or
+      ``'multi'`` (e.g., :py:data:`stanford.green.ldap.ATTRIBUTE_TO_MULTIPLICITY`).
+    :type multiplicity: dict[str, str]
+
+    """
+    def __init__(self, multiplicity: dict[str, str]):
+        # Both dicts are keyed by the lower-cased attribute name.
+        self._single_valued: dict[str, bool] = {
+            name.lower(): (value == 'single') for (name, value) in multiplicity.items()
+        }
+        self._syntax: dict[str, str] = {}
+
+        self._plans = functools.lru_cache(maxsize=PLAN_CACHE_SIZE)(self._compile_plan)
+        self._warned: set[str] = set()
+
+        self.source    = 'static'
+        self.loaded_at: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._single_valued)
+
+    def __contains__(self, attribute_name: str) -> bool:
+        return attribute_name.lower() in self._single_valued
+
+    def is_single_valued(self, attribute_name: str) -> Optional[bool]:
+        """Return ``True`` or ``False``, or ``None`` if the attribute is unknown."""
+        return self._single_valued.get(attribute_name.lower())
+
+    def is_binary(self, attribute_name: str) -> bool:
+        """Return ``True`` if the attribute's syntax is a binary one or it has the ``;binary`` option."""
+        (name, *options) = attribute_name.lower().split(';')
+        return ('binary' in options) or (self._syntax.get(name) in BINARY_SYNTAXES)
+
+    def syntax(self, attribute_name: str) -> Optional[str]:
+        """Return the OID of the attribute's syntax if known."""
+        return self._syntax.get(attribute_name.lower())
+
+    def update(self, attributes: dict[str, dict[str, Any]], replace: bool = True) -> None:
+        """Add or replace attributes.
+
+        :param attributes: maps each attribute name to a dict with the keys
+          ``single`` (a bool) and ``syntax`` (an OID string or ``None``).
+        :type attributes: dict
+
+        :param replace: if ``False`` keep the multiplicity of attributes
+          the registry already knows (syntaxes are always updated);
+          default: ``True``.
+        :type replace: bool
+        """
+        for (name, info) in attributes.items():
+            key = name.lower()
+            if (replace or (key not in self._single_valued)):
+                self._single_valued[key] = bool(info['single'])
+            if (info.get('syntax')):
+                self._syntax[key] = info['syntax']
+            else:
+                self._syntax.pop(key, None)
+
+        # The plans compiled so far may be out of date.
+        self._plans.cache_clear()
+
+    def decoding_plan(self, attribute_names: Tuple[str, ...]) -> DecodingPlan:
+        """Return the (memoized) :py:class:`DecodingPlan` for ``attribute_names``.
+
+        The ``objectClass`` attribute is left out of the plan. Unknown
+        attributes are treated as multi-valued and go in the plan's
+        ``unknown`` pairs (and a warning is logged the first time each one
+        is seen). Attribute options (e.g., ``;lang-en``) are ignored when
+        looking an attribute up, except that ``;binary`` makes it binary.
+        The plans of the ``PLAN_CACHE_SIZE`` most recently used tuples of
+        attribute names are kept.
+        """
+        return self._plans(attribute_names)
+
+    def _compile_plan(self, attribute_names: Tuple[str, ...]) -> DecodingPlan:
+        text    = []
+        binary  = []
+        unknown = []
+        for attribute in attribute_names:
+            if (attribute == 'objectClass'):
+                continue
+
+            single_valued = self.is_single_valued(attribute.split(';', 1)[0])
+            if (self.is_binary(attribute)):
+                binary.append((attribute, bool(single_valued)))
+            elif (single_valued is None):
+                if (attribute.lower() not in self._warned):
+                    self._warned.add(attribute.lower())
+                    logger.warning(f"'{attribute}' is not a recognized attribute; decoding as multi-valued")
+                unknown.append((attribute, False))
+            else:
+                text.append((attribute, single_valued))
+
+        return DecodingPlan(tuple(text), tuple(binary), tuple(unknown))
+
+    ## Server schema
+
+    def load_server_schema(self, ldap_conn: Any, replace: bool = False) -> int:
+        """Update the registry from the server's subschema subentry.
+
+        :param ldap_conn: a bound python-ldap connection.
+        :type ldap_conn: Any
+
+        :param replace: if ``True`` the server's ``SINGLE-VALUE`` flags
+          replace what the registry already has. The default, ``False``,
+          keeps the static tables authoritative for the attributes they
+          list (they describe how Stanford populates an attribute, which
+          can be stricter than the schema allows; e.g., ``mail`` is
+          single-valued in the people tree) and takes everything else
+          from the server.
+        :type replace: bool
+
+        :return: the number of attribute names read from the server.
+        :rtype: int
+        """
+        subschemasubentry_dn = ldap_conn.search_subschemasubentry_s()
+        if (subschemasubentry_dn is None):
+            msg = "the server did not return a subschema subentry"
+            raise RuntimeError(msg)
+
+        entry     = ldap_conn.read_subschemasubentry_s(subschemasubentry_dn, attrs=['attributeTypes'])
+        subschema = ldap.schema.SubSchema(entry, check_uniqueness=0)
+
+        attributes = {}
+        for oid in subschema.listall(ldap.schema.AttributeType):
+            attribute_type = subschema.get_obj(ldap.schema.AttributeType, oid)
+            syntax         = subschema.get_inheritedattr(ldap.schema.AttributeType, oid, 'syntax')
+            for name in attribute_type.names:
+                attributes[name] = {
+                    'single': attribute_type.single_value,
+                    'syntax': syntax,
+                }
+
+        self.update(attributes, replace=replace)
+        self.source    = 'server'
+        self.loaded_at = time.time()
+        logger.info(f"loaded {len(attributes)} attribute names from {subschemasubentry_dn}")
+
+        return len(attributes)
+
+    def save(self, path: str) -> None:
+        """Write the registry to the JSON file ``path`` (atomically)."""
+        data = {
+            'source':    self.source,
+            'loaded_at': self.loaded_at,
+            'attributes': {
+                name: {'single': single, 'syntax': self._syntax.get(name)}
+                for (name, single) in self._single_valued.items()
+            },
+        }
+
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> None:
+        """Update the registry from a JSON file written by :py:meth:`save`."""
+        with open(path, 'r', encoding='utf-8') as fh:
+            data = json.load(fh)
+
+        self.update(data['attributes'])
+        self.source    = data.get('source', 'file')
+        self.loaded_at = data.get('loaded_at')
@@ -0,0 +1,411 @@
+"""Incremental directory synchronization.
+
+--------
+Overview
+--------
+
+Re-reading a whole tree to find out what changed transfers every
+unchanged value again. :py:class:`DirectorySync` instead keeps a small
+state file between runs and on each run transfers only what changed
+since the last one, reporting each change as a :py:class:`SyncEvent`
+(``add``, ``modify``, or ``delete``).
+
+Two methods are supported:
+
+1. ``syncrepl``: RFC 4533 content synchronization (in refreshOnly
+   mode). The server sends the entries added or changed since the
+   *cookie* saved by the previous run, and the UUIDs of the entries
+   deleted (or of those still present, from which the deletions are
+   worked out). Used when the server's root DSE lists the Sync Request
+   control.
+
+2. ``poll``: a search for ``(modifyTimestamp>=T)`` where ``T`` is the
+   highest ``modifyTimestamp`` seen so far (the *high-water mark*).
+   Because a deleted entry no longer matches any filter, deletions are
+   found by listing the DNs (and no attributes) of the tree and
+   comparing them with the DNs seen before; set ``detect_deletes`` to
+   ``False`` to skip that step.
+
+The first run (or a run whose state file is missing or was written for a
+different search) is a full read in which every entry is an ``add``.
+The state file is only written once a run has completed, so a run that
+fails or is interrupted is simply repeated the next time.
+
+--------
+Examples
+--------
+
+Keep a copy of the people tree up to date::
+
+  from stanford.green.ldap      import LDAP, BASEDN_PEOPLE
+  from stanford.green.ldap.sync import DirectorySync
+
+  ldap1 = LDAP()
+  sync  = DirectorySync(ldap1, BASEDN_PEOPLE, '/var/lib/myapp/people-sync.json',
+                        attrlist=['uid', 'displayName', 'suAffiliation'])
+
+  for event in sync.sync():
+      if (event.action == 'delete'):
+          mirror.pop(event.dn, None)
+      else:
+          mirror[event.dn] = event.attributes
+
+"""
+import json
+import logging
+import os
+import time
+
+from ldap.syncrepl import SyncreplConsumer  # type: ignore
+
+from stanford.green.ldap import LDAP, LDAPResult
+
+## TYPING
+from typing import Any, Iterator, Optional, cast
+## END OF TYPING
+
+## Set up logging
+logger = logging.getLogger(__name__)
+
+# The OID of the RFC 4533 Sync Request control.
+SYNC_REQUEST_CONTROL_OID = '1.3.6.1.4.1.4203.1.9.1.1'
+
+STATE_VERSION = 1
+
+def _single_value(value: Any) -> Any:
+    """Return the value of a single-valued attribute decoded as a list or not."""
+    # The registry of an LDAP object need not know modifyTimestamp, in
+    # which case its one value comes back in a list.
+    if (isinstance(value, list)):
+        return value[0] if value else None
+    return value
+
+
+class SyncEvent():
+    """One change found by :py:meth:`DirectorySync.sync`.
+
+    :ivar action: ``'add'``, ``'modify'``, or ``'delete'``.
+    :ivar dn: the DN of the entry.
+    :ivar attributes: the entry's (decoded) attributes for ``add`` and
+      ``modify``; ``None`` for ``delete``.
+    """
+    __slots__ = ('action', 'dn', 'attributes')
+
+    def __init__(self, action: str, dn: str, attributes: Optional[LDAPResult] = None):
+        self.action     = action
+        self.dn         = dn
+        self.attributes = attributes
+
+    def __repr__(self) -> str:
+        return f"SyncEvent({self.action!r}, {self.dn!r})"
+
+
+class _SyncreplSession(SyncreplConsumer):  # type: ignore[misc]
+    """Collect the results of one refreshOnly syncrepl search as events.
+
+    python-ldap's ``SyncreplConsumer`` is meant to be mixed into an
+    ``LDAPObject``; it only needs ``search_ext`` and ``result4``, so here
+    they are delegated to an existing connection instead.
+    """
+    def __init__(self, ldap_conn: Any, decode: Any, cookie: Optional[str], uuids: dict[str, str]):
+        self.search_ext = ldap_conn.search_ext
+        self.result4    = ldap_conn.result4
+
+        self.decode  = decode
+        self.cookie  = cookie
+        self.uuids   = uuids        # entryUUID -> DN
+        self.present: set[str] = set()
+        self.events: list[SyncEvent] = []
+
+    def syncrepl_get_cookie(self) -> Optional[str]:
+        return self.cookie
+
+    def syncrepl_set_cookie(self, cookie: str) -> None:
+        self.cookie = cookie
+
+    def syncrepl_entry(self, dn: str, attrs: dict[str, list[bytes]], uuid: str) -> None:
+        previous_dn = self.uuids.get(uuid)
+        (dn, attribute_values) = self.decode((dn, attrs))
+
+        if (previous_dn is None):
+            self.events.append(SyncEvent('add', dn, attribute_values))
+        elif (previous_dn != dn):
+            # The entry was renamed.
+            self.events.append(SyncEvent('delete', previous_dn))
+            self.events.append(SyncEvent('add', dn, attribute_values))
+        else:
+            self.events.append(SyncEvent('modify', dn, attribute_values))
+
+        self.uuids[uuid] = dn
+
+    def syncrepl_delete(self, uuids: list[str]) -> None:
+        for uuid in uuids:
+            dn = self.uuids.pop(uuid, None)
+            if (dn is not None):
+                self.events.append(SyncEvent('delete', dn))
+
+    def syncrepl_present(self, uuids: Optional[list[str]], refreshDeletes: bool = False) -> None:
+        if (uuids is not None):
+            self.present.update(uuids)
+            return
+
+        if (not refreshDeletes):
+            # The end of a present phase: every entry we know of that the
+            # server did not list as present has been deleted.
+            self.syncrepl_delete([uuid for uuid in self.uuids if (uuid not in self.present)])
+
+        self.present = set()
+
+    def syncrepl_refreshdone(self) -> None:
+        pass
+
+
+class DirectorySync():
+    """Report the changes to a subtree since the previous run.
+
+    :param ldap1: the ``LDAP`` object to search with.
+    :type ldap1: LDAP
+
+    :param basedn: the base DN of the subtree to follow (e.g., ``BASEDN_PEOPLE``).
+    :type basedn: str
+
+    :param state_file: the JSON file in which the cookie or high-water
+      mark (and the DNs needed to report deletions) are kept between runs.
+    :type state_file: str
+
+    :param filterstr: only follow entries matching this filter; default:
+      ``(objectClass=*)``.
+    :type filterstr: str
+
+    :param attrlist: the attributes to report; default: all.
+    :type attrlist: list[str]
+
+    :param scope: the search scope; default: ``'sub'``.
+    :type scope: str
+
+    :param method: ``'syncrepl'``, ``'poll'``, or ``None`` (the default)
+      to use ``syncrepl`` if the server supports it and ``poll`` otherwise.
+    :type method: str
+
+    :param detect_deletes: in ``poll`` mode, list the tree's DNs on each
+      run to find deleted entries; default: ``True``.
+    :type detect_deletes: bool
+
+    :param page_size: the page size of ``poll`` mode searches; default: 500.
+    :type page_size: int
+
+    """
+    def __init__(self,
+                 ldap1:          LDAP,
+                 basedn:         str,
+                 state_file:     str,
+                 filterstr:      str = '(objectClass=*)',
+                 attrlist:       Optional[list[str]] = None,
+                 scope:          str = 'sub',
+                 method:         Optional[str] = None,
+                 detect_deletes: bool = True,
+                 page_size:      int = 500):
+        if (method not in (None, 'syncrepl', 'poll')):
+            msg = f"unknown sync method '{method}'"
+            raise ValueError(msg)
+
+        self.ldap1          = ldap1
+        self.basedn         = basedn
+        self.state_file     = state_file
+        self.filterstr      = filterstr
+        self.attrlist       = attrlist
+        self.scope          = scope
+        self.method         = method
+        self.detect_deletes = detect_deletes
+        self.page_size      = page_size
+
+        self.last_run: dict[str, Any] = {}
+
+    ## State
+
+    def _search_description(self) -> dict[str, Any]:
+        return {
+            'basedn':    self.basedn,
+            'filterstr': self.filterstr,
+            'attrlist':  self.attrlist,
+            'scope':     self.scope,
+        }
+
+    def load_state(self) -> dict[str, Any]:
+        """Return the saved state, or an empty state if there is none usable."""
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as fh:
+                state = json.load(fh)
+        except FileNotFoundError:
+            return {}
+
+        if ((state.get('version') != STATE_VERSION) or (state.get('search') != self._search_description())):
+            logger.warning(f"sync state in {self.state_file} is for a different search; starting over")
+            return {}
+
+        return cast(dict[str, Any], state)
+
+    def save_state(self, state: dict[str, Any]) -> None:
+        """Write ``state`` to the state file (atomically)."""
+        state['version'] = STATE_VERSION
+        state['search']  = self._search_description()
+
+        tmp_path = f"{self.state_file}.tmp.{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(state, fh)
+        os.replace(tmp_path, self.state_file)
+
+    def reset(self) -> None:
+        """Forget the saved state so the next run is a full read."""
+        try:
+            os.remove(self.state_file)
+        except FileNotFoundError:
+            pass
+
+    ## Method selection
+
+    def server_supports_syncrepl(self) -> bool:
+        """Return ``True`` if the root DSE lists the Sync Request control."""
+        with self.ldap1.connection() as ldap_conn:
+            root_dse = ldap_conn.read_rootdse_s(attrlist=['supportedControl'])
+
+        supported = [oid.decode('utf-8') for oid in root_dse.get('supportedControl', [])]
+        return (SYNC_REQUEST_CONTROL_OID in supported)
+
+    def resolve_method(self) -> str:
+        """Return the sync method to use (checking the server once if needed)."""
+        if (self.method is None):
+            self.method = 'syncrepl' if self.server_supports_syncrepl() else 'poll'
+            logger.info(f"using the {self.method} method to sync {self.basedn}")
+
+        return self.method
+
+    ## Syncing
+
+    def sync(self) -> Iterator[SyncEvent]:
+        """Yield the changes since the previous run, then save the new state.
+
+        The state is saved only if the generator is run to the end.
+        Statistics about the run (the method, whether it was a full read,
+        the number of events of each kind, and the elapsed time) are left
+        in ``self.last_run``.
+        """
+        method = self.resolve_method()
+        state  = self.load_state()
+
+        counts = {'add': 0, 'modify': 0, 'delete': 0}
+        start  = time.monotonic()
+        full   = (state.get('method') != method)
+
+        if (full):
+            state = {}
+
+        new_state: dict[str, Any] = {'method': method}
+        if (method == 'syncrepl'):
+            events = self._sync_syncrepl(state, new_state)
+        else:
+            events = self._sync_poll(state, new_state)
+
+        for event in events:
+            counts[event.action] += 1
+            yield event
+
+        self.save_state(new_state)
+
+        self.last_run = {
+            'method':  method,
+            'full':    full,
+            'seconds': time.monotonic() - start,
+            **counts,
+        }
+        logger.info(f"synced {self.basedn}: {self.last_run}")
+
+    def _sync_syncrepl(self, state: dict[str, Any], new_state: dict[str, Any]) -> Iterator[SyncEvent]:
+        """Yield events from a refreshOnly syncrepl search and fill in ``new_state``."""
+        uuids: dict[str, str] = dict(state.get('uuids', {}))
+        cookie = state.get('cookie')
+
+        with self.ldap1.connection() as ldap_conn:
+            session = _SyncreplSession(ldap_conn, self.ldap1.process_result, cookie, uuids)
+            msgid   = session.syncrepl_search(
+                self.basedn,
+                self.ldap1.scope_normalize(self.scope),
+                mode='refreshOnly',
+                filterstr=self.filterstr,
+                attrlist=self.attrlist,
+            )
+
+            in_progress = True
+            while (in_progress):
+                in_progress = session.syncrepl_poll(msgid=msgid, all=0)
+                yield from session.events
+                session.events = []
+
+        new_state['cookie'] = session.cookie
+        new_state['uuids']  = session.uuids
+
+    def _sync_poll(self, state: dict[str, Any], new_state: dict[str, Any]) -> Iterator[SyncEvent]:
+        """Yield events from a ``modifyTimestamp`` search and fill in ``new_state``."""
+        known_dns: set[str] = set(state.get('dns', []))
+        high_water_mark: Optional[str] = state.get('high_water_mark')
+
+        # The search uses ">=" so that changes made in the same second as
+        # the last one seen are not missed; the DNs already reported at
+        # the high-water mark itself are skipped.
+        seen_at_mark: set[str] = set(state.get('seen_at_mark', []))
+
+        # modifyTimestamp is an operational attribute, so it has to be
+        # asked for by name.
+        if (self.attrlist is None):
+            attrlist = ['*', 'modifyTimestamp']
+        elif ('modifytimestamp' not in {attribute.lower() for attribute in self.attrlist}):
+            attrlist = self.attrlist + ['modifyTimestamp']
+        else:
+            attrlist = self.attrlist
+        strip_timestamp = (attrlist is not self.attrlist)
+
+        if (high_water_mark is None):
+            filterstr = self.filterstr
+        else:
+            filterstr = f"(&{self.filterstr}(modifyTimestamp>={high_water_mark}))"
+
+        new_high_water_mark = high_water_mark
+        new_seen_at_mark    = set(seen_at_mark)
+        for (dn, attribute_values) in self.ldap1.search_iter(self.basedn, filterstr=filterstr, attrlist=attrlist,
+                                                              scope=self.scope, page_size=self.page_size):
+            timestamp: Any
+            if (strip_timestamp):
+                timestamp = _single_value(attribute_values.pop('modifyTimestamp', None))
+            else:
+                timestamp = _single_value(attribute_values.get('modifyTimestamp'))
+
+            # GeneralizedTime values in the same format compare correctly
+            # as strings.
+            if (timestamp is not None):
+                if ((timestamp == high_water_mark) and (dn in seen_at_mark)):
+                    continue
+
+                if ((new_high_water_mark is None) or (timestamp > new_high_water_mark)):
+                    new_high_water_mark = timestamp
+                    new_seen_at_mark    = set()
+                if (timestamp == new_high_water_mark):
+                    new_seen_at_mark.add(dn)
+
+            action = 'modify' if (dn in known_dns) else 'add'
+            known_dns.add(dn)
+            yield SyncEvent(action, dn, attribute_values)
+
+        if (self.detect_deletes and (high_water_mark is not None)):
+            # Asking for the attribute "1.1" returns DNs only.
+            current_dns = {dn for (dn, _attribute_values) in
+                           self.ldap1.search_iter(self.basedn, filterstr=self.filterstr, attrlist=['1.1'],
+                                                  scope=self.scope, page_size=self.page_size)}
+            for dn in sorted(known_dns - current_dns):
+                yield SyncEvent('delete', dn)
+            # An entry added since the first search is picked up by the
+            # next run.
+            known_dns &= current_dns
+
+        new_state['high_water_mark'] = new_high_water_mark
+        new_state['seen_at_mark']    = sorted(new_seen_at_mark)
+        new_state['dns']             = sorted(known_dns)
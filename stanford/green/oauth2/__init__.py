@@ -14,7 +14,31 @@ Once you
 have the access token it is up to you to use it to make API calls.
 
 There is built-in file-based caching to minimize the number of times
-you have to go out to the access token endpoint.
+you have to go out to the access token endpoint. In front of the file
+cache each :py:class:`ApiAccessTokenEndpoint` keeps the token in memory,
+so repeated calls to :py:meth:`~ApiAccessTokenEndpoint.get_token` from
+the same process do not touch the disk until the token is about to
+expire.
+
+By default a new token is only fetched once the cached one has expired,
+so the caller that finds it expired waits for the token endpoint (and
+any retries). With ``refresh_ahead`` set, the token is instead renewed
+in a background thread part way through its lifetime, while callers go
+on getting the current token::
+
+  # Renew the token after about 75% of its lifetime (give or take 10%).
+  api_access = ApiAccessTokenEndpoint('oauth2', url, client_id, client_secret,
+                                      exp_backoff, refresh_ahead=0.75, refresh_jitter=0.1)
+
+When the token has to be fetched only one caller fetches it: other
+threads of the same process wait for that fetch, and other processes
+using the same ``cache_directory`` wait (for at most ``fetch_lock_timeout``
+seconds) on a lock file and then take the token from the file cache.
+:py:meth:`~ApiAccessTokenEndpoint.stats` counts the fetches saved this
+way. For example, in each worker of a web application::
+
+  api_access = ApiAccessTokenEndpoint('oauth2', url, client_id, client_secret,
+                                      exp_backoff, cache_directory='/var/cache/myapp/token')
 
 
 --------
@@ -91,10 +115,12 @@ import base64
 import datetime
 import hashlib
 import logging
+import os
 import pytz
 import random
 import requests
 from requests.exceptions import HTTPError
+import threading
 import time
 
 # diskcache does not have type hint support, so tell the type checker to
@@ -102,8 +128,10 @@ import time
 from diskcache import Cache   # type: ignore
 
 from exponential_backoff_ca import ExponentialBackoff
+from filelock import FileLock, Timeout
 
 from stanford.green          import utc_datetime_secs_from_now
+from stanford.green.utility.singleflight import SingleFlight
 from stanford.green.zulutime import dt_to_zulu_string, zulu_string_to_utc
 
 ## TYPING
@@ -111,6 +139,11 @@ from typing import Optional, cast, Any
 AccessTokenDict = dict[str, str|int|datetime.datetime]
 ## END OF TYPING
 
+# Cached tokens are treated as expired this many seconds early so that we
+# never hand out a token that expires in the time it takes to make the
+# API call.
+CACHE_EXPIRY_MARGIN = 5
+
 class AccessToken():
     """An object representing an OAuth access token returned by an OAuth Authorization Server.
 
@@ -245,9 +278,20 @@ class ApiAccessTokenEndpoint():
     :param timeout: the maximum time in seconds to wait for each request attempt; default: 15.0.
     :type timeout: float
 
-    :param use_cache: if set to ``True`` the access token will be cached; default: ``True``.
+    :param use_cache: if set to ``True`` the access token will be cached, both in
+      memory and in a file-based cache shared with other processes; default: ``True``.
     :type use_cache: bool
 
+    :param cache_directory: (only relevant if ``use_cache`` is set) the directory of the
+      file-based cache; processes that give the same directory share the cached token
+      and take turns fetching it; default: ``None`` (a new temporary directory).
+    :type cache_directory: str
+
+    :param fetch_lock_timeout: (only relevant if ``use_cache`` is set) the most seconds to
+      wait for another process to finish fetching a token before fetching one anyway;
+      default: 30.
+    :type fetch_lock_timeout: float
+
     :param verbose: if set to ``True`` progress information will be sent to standard output; default: ``False``.
     :type verbose: bool
 
@@ -259,6 +303,19 @@ class ApiAccessTokenEndpoint():
       client wants access to; default: the empty list
     :type scopes: list[str]
 
+    :param refresh_ahead: if set, renew the token in the background once this fraction
+      (between 0 and 1) of its remaining lifetime has passed; needs ``use_cache``;
+      default: ``None`` (only fetch a token when the cached one has expired).
+    :type refresh_ahead: float
+
+    :param refresh_jitter: (only relevant if ``refresh_ahead`` is set) move each renewal
+      earlier or later by up to this fraction of the token's lifetime, at random, so that
+      many processes do not all renew at the same moment; default: 0.1.
+    :type refresh_jitter: float
+
+    In refresh-ahead mode the renewals run in daemon timer threads; call
+    :py:meth:`close` to stop them.
+
     """
 
     def __init__(
@@ -271,9 +328,14 @@ class ApiAccessTokenEndpoint():
             timeout:           float=15.0,
             use_cache:         bool=True,
             verbose:           bool=False,
+            cache_directory:   Optional[str]=None,
+            fetch_lock_timeout: float=30.0,
             # OAuth stuff:
             grant_type:        str='client_credentials',
             scopes:            list[str]=[],
+            # Refresh-ahead:
+            refresh_ahead:     Optional[float]=None,
+            refresh_jitter:    float=0.1,
     ):
         valid_endpoints = ['acs_api', 'oauth2']
         if (endpoint_type not in valid_endpoints):
@@ -297,13 +359,56 @@ class ApiAccessTokenEndpoint():
 
         self.base_headers = {'Accept': 'application/json'}
 
+        if (refresh_ahead is not None):
+            if (not use_cache):
+                msg = "refresh_ahead needs use_cache"
+                raise ValueError(msg)
+            if (not (0 < refresh_ahead < 1)):
+                msg = f"refresh_ahead must be between 0 and 1, not {refresh_ahead}"
+                raise ValueError(msg)
+            if (not (0 <= refresh_jitter < refresh_ahead)):
+                msg = f"refresh_jitter must be at least 0 and less than refresh_ahead, not {refresh_jitter}"
+                raise ValueError(msg)
+
+        self.refresh_ahead  = refresh_ahead
+        self.refresh_jitter = refresh_jitter
+
         if (self.use_cache):
             # We set the cache_key to be the SHA256 hash of the url. This way
             # we avoid reading anyone else's cache.
             m = hashlib.sha256()
             m.update(url.encode('ascii'))
             self.cache_key = 'access_token_' + m.hexdigest()
-            self.cache     = Cache()  # Cache the access token
+            self.cache     = Cache(cache_directory)  # Cache the access token
+
+            # Processes sharing the cache hold this lock while fetching.
+            self.fetch_lock_file = os.path.join(self.cache.directory, f"{self.cache_key}.lock")
+
+        self.fetch_lock_timeout = fetch_lock_timeout
+
+        # Threads of this process that miss the cache at the same time
+        # share one fetch.
+        self._single_flight = SingleFlight()
+
+        # The in-memory (L1) cache in front of the file cache: the token
+        # and the time.monotonic() value after which it must not be used.
+        # They are kept in one tuple so that get_token() can read them
+        # without taking the lock; the lock serializes updates.
+        self._memory_lock = threading.Lock()
+        self._memory_token: Optional[tuple[AccessToken, float]] = None
+
+        # The pending refresh-ahead timer.
+        self._refresh_lock = threading.Lock()
+        self._refresh_timer: Optional[threading.Timer] = None
+        self._closed = False
+
+        self._stats = {
+            'fetches':          0,
+            'suppressed':       0,
+            'lock_timeouts':    0,
+            'refreshes':        0,
+            'refresh_failures': 0,
+        }
 
         self.logger = logging.getLogger(__name__)
 
@@ -347,10 +452,11 @@ class ApiAccessTokenEndpoint():
         """
         self.progress('entering cache_set()')
 
-        # We subtract 5 seconds from expires_in to avoid a situation where
-        # the current time is so close to the expires time that we return a
-        # token that will expire in the time it takes to make the API call.
-        self.cache.set(self.cache_key, value, expire=(expires_in - 5))
+        # We subtract CACHE_EXPIRY_MARGIN seconds from expires_in to avoid
+        # a situation where the current time is so close to the expires
+        # time that we return a token that will expire in the time it
+        # takes to make the API call.
+        self.cache.set(self.cache_key, value, expire=(expires_in - CACHE_EXPIRY_MARGIN))
 
     def cache_get(self) -> AccessToken:
         """Get the cached value.
@@ -362,6 +468,35 @@ class ApiAccessTokenEndpoint():
         self.progress('entering cache_get()')
         return cast(AccessToken, self.cache.get(self.cache_key))
 
+    def memory_cache_set(self, value: AccessToken, expires_in: int) -> None:
+        """Keep ``value`` in memory for ``expires_in`` seconds (less the usual margin).
+
+        :param value: the AccessToken to keep.
+        :type value: ``AccessToken``
+
+        :param expires_in: the number of seconds the token is still valid.
+        :type expires_in: int
+
+        The deadline is measured with :py:func:`time.monotonic`, so it is
+        not affected by changes to the system clock.
+        """
+        deadline = time.monotonic() + (expires_in - CACHE_EXPIRY_MARGIN)
+        with self._memory_lock:
+            self._memory_token = (value, deadline)
+
+    def memory_cache_get(self) -> Optional[AccessToken]:
+        """Return the token kept in memory, or ``None`` if there is none or it is too old."""
+        entry = self._memory_token
+        if ((entry is not None) and (time.monotonic() < entry[1])):
+            return entry[0]
+        else:
+            return None
+
+    def memory_cache_clear(self) -> None:
+        """Forget the token kept in memory (the file cache is not affected)."""
+        with self._memory_lock:
+            self._memory_token = None
+
     def get_token(self,
                   expires_at_override: Optional[datetime.datetime] = None) -> AccessToken:
         """Get access token (uses cache if enabled).
@@ -374,7 +509,13 @@ class ApiAccessTokenEndpoint():
         :rtype: ``AccessToken``
 
         If the value is cached, uses the cached value, otherwise gets the
-        access token using :py:func:`_get_token`.
+        access token using :py:func:`_get_token`. The token last returned
+        is kept in memory (see :py:meth:`memory_cache_get`) and returned
+        without reading the file cache for as long as it is valid.
+
+        On a cache miss only one thread per process, and one process per
+        cache directory, fetches the token; the others wait for it (see
+        :py:meth:`_fetch_shared`).
 
         There are circumstances (e.g., during unit testing) when we want
         to override the expires_at time that was set by the token API
@@ -387,22 +528,172 @@ class ApiAccessTokenEndpoint():
             self.progress(msg)
             return self._get_token()
 
+        # This is the hot path, so no progress messages here.
+        access_token_memory = self.memory_cache_get()
+        if (access_token_memory is not None):
+            return access_token_memory
+
         with Cache(self.cache.directory) as _:
             access_token_cached = self.cache_get()
             if (access_token_cached is None):
                 self.progress('cache MISS')
-                access_token = self._get_token()
-
-                if (expires_at_override is not None):
-                    access_token.expires_at = expires_at_override
+                access_token = self._single_flight.do(
+                    (self.cache_key, expires_at_override),
+                    lambda: self._fetch_shared(expires_at_override=expires_at_override),
+                )
 
-                # Cache this value.
-                self.cache_set(access_token, expires_in=access_token.expires_in())
+                self.memory_cache_set(access_token, access_token.expires_in())
+                self._schedule_refresh(access_token)
                 return access_token
             else:
                 self.progress("cache HIT")
+                self.memory_cache_set(access_token_cached, access_token_cached.expires_in())
+                self._schedule_refresh(access_token_cached)
+                return access_token_cached
+
+    def _fetch_shared(
+            self,
+            expires_at_override: Optional[datetime.datetime] = None,
+            newer_than:          Optional[datetime.datetime] = None,
+    ) -> AccessToken:
+        """Fetch a token and put it in the file cache, one process at a time.
+
+        :param expires_at_override: as for :py:meth:`get_token`.
+        :type expires_at_override: Optional[datetime.datetime]
+
+        :param newer_than: if set, a token in the file cache only counts
+          if it expires after this.
+        :type newer_than: Optional[datetime.datetime]
+
+        The lock file ``self.fetch_lock_file`` is held while fetching.
+        Once we have it the file cache is read again: if another process
+        put a token there while we waited, that token is returned rather
+        than fetching another. If the lock is not free within
+        ``self.fetch_lock_timeout`` seconds (say, the process holding it
+        hung) we fetch the token without it.
+        """
+        lock = FileLock(self.fetch_lock_file)
+        try:
+            lock.acquire(timeout=self.fetch_lock_timeout)
+        except Timeout:
+            msg = f"waited {self.fetch_lock_timeout} seconds for another process to fetch the access token"
+            self.logger.warning(f"{msg}; fetching it ourselves")
+            with self._memory_lock:
+                self._stats['lock_timeouts'] += 1
+            return self._fetch_and_cache(expires_at_override)
+
+        try:
+            access_token_cached = self.cache_get()
+            if ((access_token_cached is not None)
+                    and ((newer_than is None) or (access_token_cached.expires_at > newer_than))):
+                self.progress("another process fetched the access token")
+                with self._memory_lock:
+                    self._stats['suppressed'] += 1
                 return access_token_cached
 
+            return self._fetch_and_cache(expires_at_override)
+        finally:
+            lock.release()
+
+    def _fetch_and_cache(self, expires_at_override: Optional[datetime.datetime] = None) -> AccessToken:
+        """Fetch a token with :py:meth:`_get_token` and put it in the file cache."""
+        access_token = self._get_token()
+        with self._memory_lock:
+            self._stats['fetches'] += 1
+
+        if (expires_at_override is not None):
+            access_token.expires_at = expires_at_override
+
+        # Cache this value.
+        self.cache_set(access_token, expires_in=access_token.expires_in())
+        return access_token
+
+    ## Refresh-ahead
+
+    def _schedule_refresh(self, access_token: AccessToken, delay: Optional[float] = None) -> None:
+        """Arrange for ``access_token`` to be renewed in the background (refresh-ahead mode only).
+
+        Unless ``delay`` (in seconds) is given, the renewal is due after
+        ``refresh_ahead`` (plus or minus up to ``refresh_jitter``) of the
+        token's remaining lifetime. Any renewal already pending is
+        cancelled.
+        """
+        if (self.refresh_ahead is None):
+            return
+
+        if (delay is None):
+            lifetime = access_token.expires_in()
+            fraction = self.refresh_ahead + random.uniform(-self.refresh_jitter, self.refresh_jitter)
+            delay    = min(lifetime * fraction, lifetime - CACHE_EXPIRY_MARGIN)
+        delay = max(0.0, delay)
+
+        with self._refresh_lock:
+            if (self._closed):
+                return
+            if (self._refresh_timer is not None):
+                self._refresh_timer.cancel()
+            timer = threading.Timer(delay, self._refresh)
+            timer.daemon = True
+            self._refresh_timer = timer
+            timer.start()
+
+        self.progress(f"will refresh the access token in {round(delay, 1)} seconds")
+
+    def _refresh(self) -> None:
+        """Renew the token ahead of its expiry (runs in a refresh timer thread).
+
+        If another process sharing the file cache has already renewed the
+        token, that token is used rather than fetching another (see
+        :py:meth:`_fetch_shared`).
+        """
+        self.progress("refreshing the access token ahead of its expiry")
+        current = self.memory_cache_get()
+        try:
+            with Cache(self.cache.directory) as _:
+                newer_than   = None if (current is None) else current.expires_at
+                access_token = self._fetch_shared(newer_than=newer_than)
+        except Exception:
+            self.logger.exception("refreshing the access token failed")
+            with self._memory_lock:
+                self._stats['refresh_failures'] += 1
+
+            # Try again while the current token is still good; once it
+            # has expired the next get_token() call fetches a new one.
+            if ((current is not None) and (current.expires_in() > 2 * CACHE_EXPIRY_MARGIN)):
+                self._schedule_refresh(current, delay=(current.expires_in() - CACHE_EXPIRY_MARGIN) / 2)
+            return
+
+        self.memory_cache_set(access_token, access_token.expires_in())
+        with self._memory_lock:
+            self._stats['refreshes'] += 1
+        self._schedule_refresh(access_token)
+
+    def close(self) -> None:
+        """Cancel any pending refresh-ahead renewal and stop scheduling new ones."""
+        with self._refresh_lock:
+            self._closed = True
+            if (self._refresh_timer is not None):
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+
+    def stats(self) -> dict[str, int]:
+        """Return a snapshot of the counters.
+
+        * ``fetches``: the tokens fetched from the token endpoint.
+        * ``coalesced``: the cache misses that waited for a fetch by another
+          thread of this process instead of fetching.
+        * ``suppressed``: the fetches not made because another process had
+          put a token in the file cache by the time we had the fetch lock.
+        * ``lock_timeouts``: the fetches made without the fetch lock because
+          it was not free within ``fetch_lock_timeout`` seconds.
+        * ``refreshes`` and ``refresh_failures``: the refresh-ahead renewals
+          that worked and that failed.
+        """
+        with self._memory_lock:
+            stats = dict(self._stats)
+        stats['coalesced'] = self._single_flight.stats()['coalesced']
+        return stats
+
     def _get_token(self) -> AccessToken:
         """Get the access token from the token endpoint.
 
@@ -0,0 +1,133 @@
+"""Coalesce concurrent identical calls into one.
+
+--------
+Overview
+--------
+
+When several threads ask for the same thing at the same time (e.g., the
+same LDAP search when a popular user logs in), only the first needs to
+do the work. :py:class:`SingleFlight` runs a function once per *key*
+while a call with that key is in flight; threads that arrive in the
+meantime wait for that call and get its result, or its exception.
+
+This is only about calls that overlap in time. Once a call has
+finished, the next call with the same key runs the function again;
+caching results is a separate concern.
+
+--------
+Examples
+--------
+
+::
+
+  from stanford.green.utility.singleflight import SingleFlight
+
+  flight = SingleFlight()
+
+  def user_info(sunetid):
+      return flight.do(sunetid, lambda: expensive_lookup(sunetid))
+
+  print(flight.stats())  # {'calls': ..., 'coalesced': ...}
+
+"""
+import threading
+
+## TYPING
+from typing import Any, Callable, Hashable, Optional, TypeVar
+T = TypeVar('T')
+## END OF TYPING
+
+class _Call():
+    """A call in flight."""
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self) -> None:
+        self.done                          = threading.Event()
+        self.result: Any                   = None
+        self.error: Optional[BaseException] = None
+        self.waiters                       = 0
+
+
+class SingleFlight():
+    """Run at most one call per key at a time, sharing its outcome.
+
+    The object is thread-safe. The counters returned by :py:meth:`stats`
+    are ``calls`` (the calls that ran the function) and ``coalesced``
+    (the calls that waited for another call's outcome instead).
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+
+        self._stats = {
+            'calls':     0,
+            'coalesced': 0,
+        }
+
+    def do(self, key: Hashable, function: Callable[[], T], copy: Optional[Callable[[T], T]] = None) -> T:
+        """Return ``function()``, or the outcome of a call with ``key`` already in flight.
+
+        :param key: identifies calls that are interchangeable.
+        :type key: Hashable
+
+        :param function: the function to call if no call with ``key`` is
+          in flight.
+        :type function: Callable
+
+        :param copy: if given, a function returning a copy of a result
+          that shares nothing mutable with it; default: ``None``.
+        :type copy: Callable
+
+        If the call in flight raises an exception, every thread waiting
+        for it raises that same exception. Without ``copy``, waiting
+        threads get the very object the function returned, so callers
+        must not modify it. With ``copy``, each waiting thread gets its
+        own copy, and so does the calling thread if any thread waited;
+        a call that nobody waited for is not copied.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if (call is None):
+                call = _Call()
+                self._calls[key] = call
+                self._stats['calls'] += 1
+                leader = True
+            else:
+                self._stats['coalesced'] += 1
+                call.waiters += 1
+                leader = False
+
+        if (not leader):
+            call.done.wait()
+            if (call.error is not None):
+                raise call.error
+            if (copy is not None):
+                return copy(call.result)
+            return call.result  # type: ignore[no-any-return]
+
+        try:
+            call.result = function()
+        except BaseException as excpt:
+            call.error = excpt
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        # No thread can start waiting for the call once it is out of
+        # _calls, so call.waiters is final here. The waiters copy
+        # call.result, so it must not be handed out to be modified.
+        if ((copy is not None) and (call.waiters > 0)):
+            return copy(call.result)
+        return call.result  # type: ignore[no-any-return]
+
+    def in_flight(self) -> int:
+        """Return the number of calls currently in flight."""
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self) -> dict[str, int]:
+        """Return a snapshot of the counters."""
+        with self._lock:
+            return dict(self._stats)
@@ -1,14 +1,34 @@
 """Unit testing.
 """
 import unittest
+import unittest.mock
 
+import asyncio
 import datetime
+import gzip
+import json
+import ldap  # type: ignore
+from ldap.controls import SimplePagedResultsControl  # type: ignore
 import logging
+import lzma
+import os
 import pytz
+import re
+import socket
+from exponential_backoff_ca import ExponentialBackoff
+import struct
 import sys
+import tempfile
+import threading
+import time
 
 from stanford.green import random_uid
 
+from stanford.green import utc_datetime_secs_from_now
+from stanford.green.kerberos import KerberosTicket, ccache_expiry
+from stanford.green.oauth2 import AccessToken, ApiAccessTokenEndpoint, CACHE_EXPIRY_MARGIN
+from requests.exceptions import HTTPError
+from filelock import FileLock
 from stanford.green.zulutime import is_zulu_string
 from stanford.green.zulutime import zulu_string_to_utc
 from stanford.green.zulutime import dt_to_zulu_string
@@ -17,7 +37,24 @@ from stanford.green.ldap import account_attribute_is_single_valued
 from stanford.green.ldap import account_attribute_is_multi_valued
 from stanford.green.ldap import people_attribute_is_single_valued
 from stanford.green.ldap import people_attribute_is_multi_valued
-from stanford.green.ldap import LDAP
+from stanford.green.ldap import uid_filter, uid_filter_chunks
+from stanford.green.ldap import LDAP, BASEDN_ACCOUNTS, BASEDN_PEOPLE, ATTRIBUTE_TO_MULTIPLICITY
+from stanford.green.ldap import GreenLDAPNoResultsException, GreenUnknownLDAPAttribute
+from stanford.green.ldap.aio import AsyncLDAP
+from stanford.green.ldap.cache import LDAPResultCache, NO_RESULTS, search_key
+from stanford.green.ldap.schema import AttributeRegistry, MultiplicityIndex, PLAN_CACHE_SIZE
+from stanford.green.ldap.compact import CompactResultSet
+from stanford.green.ldap.export import JSONLinesWriter, CSVWriter, ParquetWriter, export, export_search, open_text
+from stanford.green.ldap.sync import DirectorySync, _SyncreplSession
+from stanford.green.ldap.mirror import DirectoryMirror
+from stanford.green.ldap.groups import GroupBitmap, PrivilegeGroupIndex
+from stanford.green.ldap.rebind import CredentialRenewer
+from stanford.green.ldap.replicas import ReplicaSet
+from stanford.green.ldap.limits import SearchLimits, GreenLDAPSizeLimitException, GreenLDAPTimeLimitException
+from stanford.green.ldap.listing import ListingPage, GreenLDAPListingException, sort_keys, view_control
+from stanford.green.ldap.instrument import OperationStats, PrometheusAggregator, SlowQueryLogger
+from stanford.green.ldap.pool import LDAPConnectionPool, GreenLDAPPoolTimeout
+from stanford.green.utility.singleflight import SingleFlight
 
 ## Logging
 logger = logging.getLogger(__name__)
@@ -123,6 +160,118 @@ class TestGreen(unittest.TestCase):
         print(dt_to_zulu_string(local_time))
 
 
+    def test_token_memory_cache(self):
+        api_access = ApiAccessTokenEndpoint('oauth2', 'https://token.example.com/token', 'client', 'secret',
+                                            ExponentialBackoff(1.0, 1))
+        token = AccessToken('token1', utc_datetime_secs_from_now(3600))
+        try:
+            with unittest.mock.patch.object(api_access, '_get_token', return_value=token) as get_token, \
+                 unittest.mock.patch.object(api_access, 'cache_get', wraps=api_access.cache_get) as cache_get:
+                self.assertIs(api_access.get_token(), token)
+                self.assertIs(api_access.get_token(), token)
+                # The second call is served from memory. (The file cache is
+                # read again once the fetch lock is held.)
+                self.assertEqual((get_token.call_count, cache_get.call_count), (1, 2))
+
+                # Without the in-memory copy the file cache is read again.
+                api_access.memory_cache_clear()
+                self.assertEqual(api_access.get_token().token, 'token1')
+                self.assertEqual((get_token.call_count, cache_get.call_count), (1, 3))
+
+            # A token about to expire is not kept in memory.
+            api_access.memory_cache_set(token, CACHE_EXPIRY_MARGIN)
+            self.assertIsNone(api_access.memory_cache_get())
+        finally:
+            api_access.cache.clear()
+
+    def test_token_refresh_ahead(self):
+        with self.assertRaises(ValueError):
+            ApiAccessTokenEndpoint('oauth2', 'https://token.example.com/token', 'client', 'secret',
+                                   ExponentialBackoff(1.0, 1), use_cache=False, refresh_ahead=0.75)
+
+        api_access = ApiAccessTokenEndpoint('oauth2', 'https://token.example.com/token', 'client', 'secret',
+                                            ExponentialBackoff(1.0, 1), refresh_ahead=0.5, refresh_jitter=0.1)
+        token1 = AccessToken('token1', utc_datetime_secs_from_now(1000))
+        token2 = AccessToken('token2', utc_datetime_secs_from_now(2000))
+        token3 = AccessToken('token3', utc_datetime_secs_from_now(3000))
+        try:
+            with unittest.mock.patch.object(api_access, '_get_token', side_effect=[token1, token2]) as get_token:
+                self.assertIs(api_access.get_token(), token1)
+                self.assertTrue(400 <= api_access._refresh_timer.interval <= 600)
+
+                # The renewal replaces the token callers get and schedules the next.
+                api_access._refresh()
+                self.assertIs(api_access.get_token(), token2)
+                self.assertTrue(800 <= api_access._refresh_timer.interval <= 1200)
+
+                # A token another process put in the file cache is used as is.
+                api_access.cache_set(token3, expires_in=token3.expires_in())
+                api_access._refresh()
+                self.assertEqual(api_access.get_token().token, 'token3')
+                self.assertEqual(get_token.call_count, 2)
+
+            # A failed renewal is retried while the current token is good.
+            with unittest.mock.patch.object(api_access, '_get_token', side_effect=HTTPError("unavailable")):
+                api_access.cache.clear()
+                api_access._refresh()
+            self.assertEqual(api_access.get_token().token, 'token3')
+            self.assertEqual(api_access.stats(), {'fetches': 2, 'suppressed': 1, 'lock_timeouts': 0, 'coalesced': 0,
+                                                  'refreshes': 2, 'refresh_failures': 1})
+            self.assertTrue(1400 <= api_access._refresh_timer.interval <= 1500)
+        finally:
+            api_access.close()
+            api_access.cache.clear()
+        self.assertIsNone(api_access._refresh_timer)
+
+    def test_token_single_fetch(self):
+        def endpoint(directory, **kwargs):
+            return ApiAccessTokenEndpoint('oauth2', 'https://token.example.com/token', 'client', 'secret',
+                                          ExponentialBackoff(1.0, 1), cache_directory=directory, **kwargs)
+
+        def slow_token():
+            time.sleep(0.2)
+            return AccessToken('token1', utc_datetime_secs_from_now(3600))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Threads missing the cache together share one fetch.
+            api_access = endpoint(tmpdir)
+            with unittest.mock.patch.object(api_access, '_get_token', side_effect=slow_token) as get_token:
+                threads = [threading.Thread(target=api_access.get_token) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(get_token.call_count, 1)
+            self.assertEqual(api_access.stats()['fetches'], 1)
+            api_access.cache.clear()
+
+            # A process waiting for the fetch lock takes the token another
+            # process fetched while it waited.
+            other = endpoint(tmpdir)
+            lock  = FileLock(other.fetch_lock_file)
+            lock.acquire()
+            results = []
+            with unittest.mock.patch.object(other, '_get_token') as get_token:
+                thread = threading.Thread(target=lambda: results.append(other.get_token()))
+                thread.start()
+                time.sleep(0.2)
+                token = AccessToken('token2', utc_datetime_secs_from_now(3600))
+                api_access.cache_set(token, expires_in=token.expires_in())
+                lock.release()
+                thread.join()
+            get_token.assert_not_called()
+            self.assertEqual(results[0].token, 'token2')
+            self.assertEqual(other.stats()['suppressed'], 1)
+            api_access.cache.clear()
+
+            # If the lock is not released in time, fetch anyway.
+            hasty = endpoint(tmpdir, fetch_lock_timeout=0.05)
+            with FileLock(hasty.fetch_lock_file):
+                with unittest.mock.patch.object(hasty, '_get_token', side_effect=slow_token):
+                    self.assertEqual(hasty.get_token().token, 'token1')
+            self.assertEqual(hasty.stats()['lock_timeouts'], 1)
+            hasty.cache.clear()
+
     def test_ldap_attributes(self):
         ## ACCOUNTS TREE
         single_valued_account_attributes = [
@@ -311,5 +460,1224 @@ class TestGreen(unittest.TestCase):
         results = ldap1.sunetid_info('adamhl', attrlist=['suMailDrop', 'displayName'])
         print(results)
 
+    def test_ldap_connection_pool(self):
+
+        class FakeConnection():
+            def __init__(self):
+                self.dead = False
+
+            def whoami_s(self):
+                if (self.dead):
+                    raise ldap.SERVER_DOWN("connection is dead")
+                return 'dn:uid=jstanford,cn=accounts,dc=stanford,dc=edu'
+
+            def unbind_s(self):
+                pass
+
+        pool = LDAPConnectionPool(FakeConnection, size=2, idle_check_seconds=0.0)
+        self.assertEqual(pool.stats()['idle'], 2)
+
+        # Checking out every connection means the next checkout times out.
+        conn1 = pool.checkout()
+        conn2 = pool.checkout()
+        self.assertEqual(pool.stats()['in_use'], 2)
+        with self.assertRaises(GreenLDAPPoolTimeout) as _:
+            pool.checkout(timeout=0.01)
+
+        pool.checkin(conn1)
+        pool.checkin(conn2, discard=True)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+        # A connection that fails its health check is replaced.
+        with pool.connection() as conn:
+            conn.dead = True
+        with pool.connection() as conn:
+            self.assertFalse(conn.dead)
+
+        # Recycling closes the idle connections.
+        pool.recycle_all()
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_search_multi(self):
+
+        class FakeConnection():
+            """Answers one entry per search and records the call order."""
+            def __init__(self):
+                self.calls   = []
+                self.pending = {}
+
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None):
+                msgid = len(self.calls) + 1
+                self.calls.append(('search_ext', basedn))
+                self.pending[msgid] = [
+                    (ldap.RES_SEARCH_ENTRY, [(f"uid=jstanford,{basedn}", {'uid': [b'jstanford']})], msgid, []),
+                    (ldap.RES_SEARCH_RESULT, [], msgid, []),
+                ]
+                return msgid
+
+            def result3(self, msgid, all=1, timeout=None):
+                self.calls.append(('result3', msgid))
+                return self.pending[msgid].pop(0)
+
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeConnection()
+        results = ldap1.sunetid_info('jstanford')
+
+        self.assertEqual(sorted(results), [f"uid=jstanford,{BASEDN_ACCOUNTS}", f"uid=jstanford,{BASEDN_PEOPLE}"])
+        # Both searches are sent before any result is read.
+        self.assertEqual(ldap1.ldap.calls[:2], [('search_ext', BASEDN_ACCOUNTS), ('search_ext', BASEDN_PEOPLE)])
+
+    def test_fetch_dns(self):
+
+        class FakeConnection():
+            """Answers base-scope searches newest first, tracking how many are outstanding."""
+            def __init__(self):
+                self.queue           = []
+                self.dns             = {}
+                self.max_outstanding = 0
+                self.abandoned       = []
+
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None):
+                msgid = len(self.dns) + 1
+                self.dns[msgid] = basedn
+                self.queue.append(msgid)
+                self.max_outstanding = max(self.max_outstanding, len(self.queue))
+                return msgid
+
+            def result3(self, msgid, all=1, timeout=None):
+                msgid = self.queue[-1]
+                dn    = self.dns[msgid]
+                if (dn.startswith('uid=gone')):
+                    self.queue.pop()
+                    raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', 'msgid': msgid})
+                if (self.queue.count(msgid) == 1):
+                    self.queue.append(msgid)
+                    return (ldap.RES_SEARCH_ENTRY, [(dn.upper(), {'uid': [dn[4:].split(',')[0].encode()]})],
+                            msgid, [])
+                self.queue.pop()
+                self.queue.remove(msgid)
+                return (ldap.RES_SEARCH_RESULT, [], msgid, [])
+
+            def abandon(self, msgid):
+                self.abandoned.append(msgid)
+
+        dns = [f"uid=user{n},{BASEDN_ACCOUNTS}" for n in range(10)]
+        dns.insert(3, f"uid=gone,{BASEDN_ACCOUNTS}")
+
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeConnection()
+        (results, missing) = ldap1.fetch_dns(dns + dns[:2], attrlist=['uid'], window=4)
+
+        # Results are keyed by the DNs as given, whatever the server returns.
+        self.assertEqual(list(results), [dn for dn in dns if (dn not in missing)])
+        self.assertEqual(results[dns[0]], {'uid': 'user0'})
+        self.assertEqual(missing, [f"uid=gone,{BASEDN_ACCOUNTS}"])
+        self.assertEqual(len(ldap1.ldap.dns), len(dns))
+        self.assertEqual(ldap1.ldap.max_outstanding, 4)
+        self.assertEqual(ldap1.ldap.abandoned, [])
+
+        with self.assertRaises(ValueError):
+            ldap1.fetch_dns(dns, window=0)
+
+    def test_search_iter(self):
+
+        class FakeConnection():
+            """Sends the given pages of uids, handing back a cookie while more pages are left."""
+            def __init__(self, pages):
+                self.pages     = pages
+                self.msgid     = 0
+                self.requests  = []
+                self.abandoned = []
+
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None):
+                self.msgid += 1
+                if (serverctrls):
+                    (control,) = serverctrls
+                    page = int(control.cookie) if control.cookie else 0
+                    self.requests.append((control.size, control.cookie))
+                    uids = self.pages[page]
+                    cookie = str(page + 1).encode() if (page + 1 < len(self.pages)) else b''
+                    controls = [SimplePagedResultsControl(True, size=control.size, cookie=cookie)]
+                else:
+                    self.requests.append(None)
+                    uids     = sum(self.pages, [])
+                    controls = []
+                self.pending = [(ldap.RES_SEARCH_ENTRY, [(f"uid={uid},{basedn}", {'uid': [uid.encode()]})],
+                                 self.msgid, []) for uid in uids]
+                self.pending.append((ldap.RES_SEARCH_RESULT, [], self.msgid, controls))
+                return self.msgid
+
+            def result3(self, msgid, all=1, timeout=None):
+                return self.pending.pop(0)
+
+            def abandon(self, msgid):
+                self.abandoned.append(msgid)
+
+        pages = [['a', 'b'], ['c', 'd'], ['e']]
+
+        # Each page's cookie is sent back until the server returns an empty one.
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeConnection(pages)
+        results = list(ldap1.search_iter(BASEDN_PEOPLE, page_size=2))
+        self.assertEqual([attributes['uid'] for (dn, attributes) in results], ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(results[0][0], f"uid=a,{BASEDN_PEOPLE}")
+        self.assertEqual(ldap1.ldap.requests, [(2, ''), (2, b'1'), (2, b'2')])
+        self.assertEqual(ldap1.ldap.abandoned, [])
+
+        # Without a page size no paging control is sent.
+        ldap1.ldap = FakeConnection(pages)
+        results = list(ldap1.search_iter(BASEDN_PEOPLE, page_size=None))
+        self.assertEqual(len(results), 5)
+        self.assertEqual(ldap1.ldap.requests, [None])
+
+        # Closing the generator early abandons the search it is reading.
+        ldap1.ldap = FakeConnection(pages)
+        iterator = ldap1.search_iter(BASEDN_PEOPLE, page_size=2)
+        self.assertEqual([next(iterator)[1]['uid'] for _ in range(3)], ['a', 'b', 'c'])
+        iterator.close()
+        self.assertEqual(ldap1.ldap.abandoned, [2])
+
+        # A search read to the end is not abandoned.
+        ldap1.ldap = FakeConnection([['a']])
+        self.assertEqual(len(list(ldap1.search_iter(BASEDN_PEOPLE))), 1)
+        self.assertEqual(ldap1.ldap.abandoned, [])
+
+    def test_search_limits(self):
+
+        class FakeConnection():
+            """Sends the given entries one at a time, then a final result or an exception."""
+            def __init__(self, count, final=None, delay=0.0):
+                self.count     = count
+                self.final     = final
+                self.delay     = delay
+                self.sent      = 0
+                self.arguments = None
+                self.timeouts  = []
+                self.abandoned = []
+
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None, **kwargs):
+                self.arguments = kwargs
+                self.sent      = 0
+                return 7
+
+            def result3(self, msgid, all=1, timeout=None):
+                self.timeouts.append(timeout)
+                time.sleep(self.delay)
+                if (self.sent < self.count):
+                    self.sent += 1
+                    return (ldap.RES_SEARCH_ENTRY, [(f"uid=user{self.sent},{BASEDN_ACCOUNTS}", {})], msgid, [])
+                if (self.final is not None):
+                    raise self.final
+                return (ldap.RES_SEARCH_RESULT, [], msgid, [])
+
+            def abandon(self, msgid):
+                self.abandoned.append(msgid)
+
+        self.assertRaises(ValueError, SearchLimits, time_limit=0)
+
+        # Within the limits: a complete result, not truncated.
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeConnection(3)
+        results = ldap1.search(BASEDN_ACCOUNTS, limits=SearchLimits(server_time_limit=5, size_limit=10,
+                                                                    poll_timeout=2.0))
+        self.assertEqual(len(results), 3)
+        self.assertFalse(results.truncated)
+        self.assertEqual(ldap1.ldap.arguments, {'timeout': 5, 'sizelimit': 10})
+        self.assertEqual(ldap1.ldap.timeouts, [2.0] * 4)
+
+        # More entries than the size limit: raise, or return what arrived.
+        ldap1.ldap = FakeConnection(5)
+        with self.assertRaises(GreenLDAPSizeLimitException):
+            ldap1.search(BASEDN_ACCOUNTS, limits=SearchLimits(size_limit=2))
+        self.assertEqual(ldap1.ldap.abandoned, [7])
+
+        ldap1.ldap = FakeConnection(2, final=ldap.SIZELIMIT_EXCEEDED({'desc': 'Size limit exceeded'}))
+        results = ldap1.search(BASEDN_ACCOUNTS, limits=SearchLimits(size_limit=2, partial=True))
+        self.assertTrue(results.truncated)
+        self.assertEqual(len(results), 2)
+        # The server ended that search itself, so there is nothing to abandon.
+        self.assertEqual(ldap1.ldap.abandoned, [])
+
+        # A stalled server: the client gives up and abandons the search.
+        ldap1.ldap = FakeConnection(1, final=ldap.TIMEOUT())
+        results = ldap1.search(BASEDN_ACCOUNTS, limits=SearchLimits(poll_timeout=0.5, partial=True))
+        self.assertTrue(results.truncated)
+        self.assertEqual(list(results), [f"uid=user1,{BASEDN_ACCOUNTS}"])
+        self.assertEqual(ldap1.ldap.abandoned, [7])
+
+        # Past the overall deadline nothing more is read.
+        ldap1.ldap = FakeConnection(50, delay=0.01)
+        with self.assertRaises(GreenLDAPTimeLimitException):
+            ldap1.search(BASEDN_ACCOUNTS, limits=SearchLimits(time_limit=0.05))
+        self.assertLess(ldap1.ldap.sent, 50)
+        self.assertTrue(all((timeout <= 0.05) for timeout in ldap1.ldap.timeouts))
+
+        # A cached result is held to the size limit too.
+        ldap1 = LDAP(connect_on_init=False, cache=LDAPResultCache(ttl=60))
+        ldap1.ldap = FakeConnection(5)
+        self.assertEqual(len(ldap1.search(BASEDN_ACCOUNTS)), 5)
+        with self.assertRaises(GreenLDAPSizeLimitException):
+            ldap1.search(BASEDN_ACCOUNTS, limits=SearchLimits(size_limit=2))
+        results = ldap1.search(BASEDN_ACCOUNTS, limits=SearchLimits(size_limit=2, partial=True))
+        self.assertTrue(results.truncated)
+        self.assertEqual(len(results), 2)
+        results = ldap1.search(BASEDN_ACCOUNTS, limits=SearchLimits(size_limit=5))
+        self.assertFalse(results.truncated)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(ldap1.ldap.sent, 5)
+
+    def test_async_ldap(self):
+
+        class FakeConnection():
+            """Answers each filter with the given pages (or exception), one result per call in turn."""
+            def __init__(self, answers):
+                (self.socket, self.other_socket) = socket.socketpair()
+                self.answers   = answers
+                self.pending   = {}
+                self.msgid     = 0
+                self.searches  = []
+                self.abandoned = []
+                self.hold      = False
+                self.error     = None
+
+            def fileno(self):
+                return self.socket.fileno()
+
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None):
+                self.msgid += 1
+                answer = self.answers[filterstr]
+                if (isinstance(answer, Exception)):
+                    self.pending[self.msgid] = [type(answer)({'msgid': self.msgid, 'desc': str(answer)})]
+                    return self.msgid
+
+                cookie = serverctrls[0].cookie if serverctrls else ''
+                page   = int(cookie) if cookie else 0
+                self.searches.append((filterstr, page, bool(serverctrls)))
+                controls = []
+                if (serverctrls and (page + 1 < len(answer))):
+                    controls = [SimplePagedResultsControl(True, cookie=str(page + 1).encode())]
+                self.pending[self.msgid] = (
+                    [(ldap.RES_SEARCH_ENTRY, [(dn, {'uid': [dn.encode()]})], self.msgid, []) for dn in answer[page]]
+                    + [(ldap.RES_SEARCH_RESULT, [], self.msgid, controls)]
+                )
+                return self.msgid
+
+            def result3(self, msgid, all=1, timeout=None):
+                if (self.error is not None):
+                    raise self.error
+                if (self.hold):
+                    return (None, None, None, None)
+                # Take one result from each search in turn, so that they interleave.
+                for msgid in list(self.pending):
+                    results = self.pending.pop(msgid)
+                    result  = results.pop(0)
+                    if (results):
+                        self.pending[msgid] = results
+                    if (isinstance(result, Exception)):
+                        raise result
+                    return result
+                return (None, None, None, None)
+
+            def abandon(self, msgid):
+                self.abandoned.append(msgid)
+                self.pending.pop(msgid, None)
+
+            def unbind_s(self):
+                self.socket.close()
+                self.other_socket.close()
+
+        answers = {
+            '(sn=A)':  [['a1', 'a2', 'a3']],
+            '(sn=B)':  [['b1', 'b2'], ['b3', 'b4'], ['b5']],
+            '(sn=C)':  ldap.FILTER_ERROR('bad filter'),
+            '(sn=D)':  ldap.NO_SUCH_OBJECT('no such object'),
+        }
+
+        async def collect(ldap1, filterstr, page_size=None):
+            return [dn async for (dn, attributes) in ldap1.search_iter(BASEDN_PEOPLE, filterstr=filterstr,
+                                                                       page_size=page_size)]
+
+        async def run():
+            ldap1 = AsyncLDAP(poll_interval=0.01)
+            fake  = FakeConnection(answers)
+            ldap1.sync.connect = lambda: fake
+            async with ldap1:
+                # Nothing watches the connection while no search is outstanding.
+                self.assertIsNone(ldap1._poller)
+                self.assertFalse(ldap1._reading)
+
+                # Interleaved results reach the search they belong to; a
+                # paged search follows the cookies to the last page.
+                (a, b) = await asyncio.gather(collect(ldap1, '(sn=A)'), collect(ldap1, '(sn=B)', page_size=2))
+                self.assertEqual(a, ['a1', 'a2', 'a3'])
+                self.assertEqual(b, ['b1', 'b2', 'b3', 'b4', 'b5'])
+                self.assertEqual(sorted(fake.searches),
+                                 [('(sn=A)', 0, False), ('(sn=B)', 0, True), ('(sn=B)', 1, True),
+                                  ('(sn=B)', 2, True)])
+                self.assertEqual((await ldap1.search(BASEDN_PEOPLE, filterstr='(sn=A)'))['a2'], {'uid': 'a2'})
+                self.assertIsNone(ldap1._poller)
+                self.assertFalse(ldap1._reading)
+                self.assertEqual(fake.abandoned, [])
+
+                # Leaving a search early abandons it.
+                iterator = ldap1.search_iter(BASEDN_PEOPLE, filterstr='(sn=A)')
+                async for (dn, attributes) in iterator:
+                    break
+                await iterator.aclose()
+                self.assertEqual(fake.abandoned, [fake.msgid])
+                self.assertEqual(ldap1._queues, {})
+                self.assertFalse(ldap1._reading)
+
+                # An error for one search fails only that search.
+                with self.assertRaises(GreenLDAPNoResultsException):
+                    await ldap1.search(BASEDN_PEOPLE, filterstr='(sn=D)')
+                (c, a) = await asyncio.gather(collect(ldap1, '(sn=C)'), collect(ldap1, '(sn=A)'),
+                                              return_exceptions=True)
+                self.assertIsInstance(c, ldap.FILTER_ERROR)
+                self.assertEqual(a, ['a1', 'a2', 'a3'])
+
+                # A broken connection fails every search and is no longer watched.
+                fake.hold = True
+                searches  = [asyncio.ensure_future(collect(ldap1, filterstr)) for filterstr in ('(sn=A)', '(sn=B)')]
+                while (len(ldap1._queues) < 2):
+                    await asyncio.sleep(0.01)
+                self.assertTrue(ldap1._reading)
+                self.assertIsNotNone(ldap1._poller)
+                fake.error = ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+                for search in searches:
+                    with self.assertRaises(ldap.SERVER_DOWN):
+                        await search
+                self.assertEqual(ldap1._queues, {})
+                self.assertFalse(ldap1._reading)
+                self.assertIsNone(ldap1._poller)
+                fake.error = None
+                fake.hold  = False
+
+        asyncio.run(run())
+
+    def test_search_window(self):
+
+        class VLVResponse():
+            controlType = '2.16.840.1.113730.3.4.10'
+            def __init__(self, target_position, content_count, result=0):
+                self.target_position = target_position
+                self.content_count   = content_count
+                self.result          = result
+                self.context_id      = 'context'
+
+        class FakeConnection():
+            """Answers a windowed search of a sorted 100-entry listing."""
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None):
+                self.serverctrls = serverctrls
+                view  = serverctrls[1]
+                first = view.offset
+                entries = [(f"uid=user{i:03d},{basedn}", {'uid': [f"user{i:03d}".encode()]})
+                           for i in range(first - 1, min(100, first + view.after_count))]
+                self.pending = [(ldap.RES_SEARCH_ENTRY, [entry], 1, []) for entry in entries]
+                self.pending.append((ldap.RES_SEARCH_RESULT, [], 1, [VLVResponse(first, 100)]))
+                return 1
+
+            def result3(self, msgid, all=1, timeout=None):
+                return self.pending.pop(0)
+
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeConnection()
+
+        page = ldap1.search_page(BASEDN_PEOPLE, '-displayName', page=3, page_size=10)
+        self.assertEqual(ldap1.ldap.serverctrls[0].ordering_rules, ['-displayName'])
+        self.assertEqual((page.offset, len(page), page.total, page.has_more), (20, 10, 100, True))
+        self.assertEqual(list(page.entries)[0], f"uid=user020,{BASEDN_PEOPLE}")
+
+        results = ldap1.search(BASEDN_PEOPLE, sort_by='displayName', offset=95, count=10)
+        self.assertEqual(len(results), 5)
+
+        with self.assertRaises(ValueError):
+            ldap1.search(BASEDN_PEOPLE, offset=10, count=10)
+        with self.assertRaises(ValueError):
+            sort_keys(['displayName:a:b'])
+        with self.assertRaises(ValueError):
+            view_control(0, 0)
+        with self.assertRaises(GreenLDAPListingException):
+            ListingPage.from_response({}, [VLVResponse(0, 0, result=61)])
+
+    def test_single_flight(self):
+        release = threading.Event()
+
+        class FakeConnection():
+            """Answers one entry per search, but only once released."""
+            def __init__(self):
+                self.searches = 0
+
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None):
+                self.searches += 1
+                self.pending = [
+                    (ldap.RES_SEARCH_ENTRY, [(f"uid=jstanford,{basedn}", {'uid': [b'jstanford']})], 1, []),
+                    (ldap.RES_SEARCH_RESULT, [], 1, []),
+                ]
+                return 1
+
+            def result3(self, msgid, all=1, timeout=None):
+                release.wait(5)
+                return self.pending.pop(0)
+
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeConnection()
+
+        results = []
+        def search():
+            results.append(ldap1.search(BASEDN_PEOPLE, filterstr='(uid=jstanford)'))
+
+        threads = [threading.Thread(target=search) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while (ldap1.coalesce_stats()['coalesced'] < 4):
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        # One search went to the server and every caller got its result.
+        self.assertEqual(ldap1.ldap.searches, 1)
+        self.assertEqual(ldap1.coalesce_stats(), {'calls': 1, 'coalesced': 4})
+        self.assertEqual(len(results), 5)
+        # Each caller got a copy of its own.
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(len({id(result) for result in results}), 5)
+        results[0][next(iter(results[0]))]['uid'] = 'changed'
+        self.assertTrue(all(result == results[1] for result in results[1:]))
+        self.assertNotEqual(results[0], results[1])
+
+        # The same goes for sunetid_info, which searches both trees at once.
+        class FakeMultiConnection():
+            """Answers one entry per search, by message id, but only once released."""
+            def __init__(self):
+                self.searches = 0
+                self.pending  = {}
+
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None):
+                self.searches += 1
+                self.pending[self.searches] = [
+                    (ldap.RES_SEARCH_ENTRY, [(f"uid=jstanford,{basedn}", {'uid': [b'jstanford']})],
+                     self.searches, []),
+                    (ldap.RES_SEARCH_RESULT, [], self.searches, []),
+                ]
+                return self.searches
+
+            def result3(self, msgid, all=1, timeout=None):
+                release.wait(5)
+                return self.pending[msgid].pop(0)
+
+        release.clear()
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeMultiConnection()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(ldap1.sunetid_info('jstanford')))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while (ldap1.coalesce_stats()['coalesced'] < 2):
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(ldap1.ldap.searches, 2)
+        self.assertEqual(ldap1.coalesce_stats(), {'calls': 1, 'coalesced': 2})
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(results[0]), 2)
+        results[0][f"uid=jstanford,{BASEDN_ACCOUNTS}"]['uid'] = 'changed'
+        self.assertEqual([result[f"uid=jstanford,{BASEDN_ACCOUNTS}"]['uid'] for result in results],
+                         ['changed', 'jstanford', 'jstanford'])
+
+        # An exception reaches every waiter.
+        flight  = SingleFlight()
+        started = threading.Event()
+        errors  = []
+        def fail():
+            started.set()
+            while (flight.stats()['coalesced'] < 1):
+                time.sleep(0.01)
+            raise GreenLDAPNoResultsException('no LDAP results')
+        def call():
+            try:
+                flight.do('key', fail)
+            except GreenLDAPNoResultsException as excpt:
+                errors.append(excpt)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        call()
+        leader.join()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_privilege_group_index(self):
+        bitmap = GroupBitmap([1, 5000, 9000, 5000])
+        self.assertEqual(list(bitmap), [1, 5000, 9000])
+        self.assertIn(9000, bitmap)
+        self.assertNotIn(2, bitmap)
+        self.assertEqual(list(bitmap & GroupBitmap([5000, 7])), [5000])
+        self.assertEqual(list(bitmap - GroupBitmap([1])), [5000, 9000])
+        bitmap.discard(1)
+        self.assertEqual(len(bitmap), 2)
+
+        entries = [
+            (f"uid=user{i},{BASEDN_ACCOUNTS}",
+             {'uid': f"user{i}", 'suPrivilegeGroup': ['stanford:all'] + (['uit:staff'] if (i % 3 == 0) else [])})
+            for i in range(10000)
+        ]
+        index = PrivilegeGroupIndex()
+        self.assertEqual(index.load_entries(entries), 10000)
+
+        self.assertTrue(index.is_member('user9999', 'uit:staff'))
+        self.assertFalse(index.is_member('user1', 'uit:staff'))
+        self.assertFalse(index.is_member('nosuchuser', 'uit:staff'))
+        self.assertEqual(index.count('uit:staff'), 3334)
+        self.assertEqual(index.members_of_all(['uit:staff', 'stanford:all'])[:2], ['user0', 'user3'])
+        self.assertEqual(len(index.members_of_any(['uit:staff', 'stanford:all'])), 10000)
+
+        # Incremental updates.
+        index.set_user('user1', ['uit:staff'])
+        index.remove_user('user0')
+        self.assertEqual(index.groups_of('user1'), ['uit:staff'])
+        self.assertEqual(index.members('uit:staff')[:2], ['user1', 'user3'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/groups.idx"
+            index.save(path)
+
+            for use_mmap in (True, False):
+                loaded = PrivilegeGroupIndex()
+                loaded.load(path, use_mmap=use_mmap)
+                self.assertEqual(len(loaded), 9999)
+                self.assertTrue(loaded.is_member('user3', 'uit:staff'))
+                self.assertEqual(loaded.members('uit:staff'), index.members('uit:staff'))
+                loaded.set_user('user3', [])
+                self.assertEqual(loaded.groups_of('user3'), [])
+                self.assertEqual(loaded.groups_of('user6'), ['stanford:all', 'uit:staff'])
+                loaded.close()
+
+    def test_kerberos_rebind(self):
+
+        def counted(value):
+            return struct.pack('>I', len(value)) + value
+
+        def principal(realm, *components):
+            return struct.pack('>II', 1, len(components)) + counted(realm) + b''.join(map(counted, components))
+
+        def credential(server, endtime):
+            return (principal(b'STANFORD.EDU', b'host', b'myserver') + server
+                    + struct.pack('>H', 18) + counted(b'k' * 32)
+                    + struct.pack('>IIII', 1000, 1000, endtime, endtime) + b'\x00' + struct.pack('>I', 0)
+                    + struct.pack('>I', 0) + struct.pack('>I', 0) + counted(b'ticket') + counted(b''))
+
+        ccache = (struct.pack('>HH', 0x0504, 0) + principal(b'STANFORD.EDU', b'host', b'myserver')
+                  + credential(principal(b'STANFORD.EDU', b'krbtgt', b'STANFORD.EDU'), 2000000000)
+                  + credential(principal(b'STANFORD.EDU', b'ldap', b'ldap.stanford.edu'), 1900000000))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ticket_file = os.path.join(tmpdir, 'krb5cc')
+            with open(ticket_file, 'wb') as ticket:
+                ticket.write(ccache)
+
+            self.assertEqual(ccache_expiry(ticket_file), 2000000000)
+            self.assertIsNone(ccache_expiry(os.path.join(tmpdir, 'nonexistent')))
+            with open(ticket_file, 'wb') as ticket:
+                ticket.write(ccache[:-10])
+            self.assertIsNone(ccache_expiry(ticket_file))
+
+            # The ticket expires soon, so it needs renewing, but another
+            # process renews it while we wait for the lock: no kinit.
+            kt = KerberosTicket('/etc/krb5.keytab', 'host/myserver', ticket_file, age_limit_seconds=3600)
+            self.assertEqual(kt.ticket_lock_file, f"{ticket_file}.lock")
+            with unittest.mock.patch.object(kt, 'ticket_expiry', side_effect=[time.time() + 60, time.time() + 36000]):
+                with unittest.mock.patch('stanford.green.kerberos.run_command') as run_command:
+                    kt.create_ticket_file(min_lifetime_seconds=600)
+            run_command.assert_not_called()
+
+        # The renewal time falls between margin and margin * (1 + jitter)
+        # seconds before the expiry; a failed renewal is retried.
+        renewer = CredentialRenewer(lambda: None, margin=600, jitter=0.5, retry_seconds=30)
+        expiry  = time.time() + 36000
+        for _ in range(20):
+            self.assertTrue(expiry - 900 <= renewer.schedule(expiry) <= expiry - 600)
+
+        # A ticket that lives less than the margin is not renewed in a loop.
+        renewer.renew = unittest.mock.Mock(side_effect=lambda: time.time() + 60)
+        self.assertTrue(renewer.renew_now())
+        self.assertGreater(renewer.seconds_until_renewal(), 29)
+        self.assertGreater(renewer.schedule(time.time() - 10), time.time() + 29)
+        self.assertRaises(ValueError, CredentialRenewer, lambda: None, retry_seconds=0)
+
+        renewer.renew = unittest.mock.Mock(side_effect=RuntimeError("kinit failed"))
+        self.assertFalse(renewer.renew_now())
+        self.assertEqual(renewer.stats()['failures'], 1)
+        self.assertLessEqual(renewer.seconds_until_renewal(), 30)
+
+        # Without a pool the new connection is bound ahead of time and
+        # swapped in at the start of the next operation.
+        old_conn = unittest.mock.Mock()
+        new_conn = unittest.mock.Mock()
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = old_conn
+        with unittest.mock.patch.object(ldap1, 'connect', return_value=new_conn):
+            ldap1.rebind()
+        old_conn.unbind_s.assert_not_called()
+        with ldap1.connection() as ldap_conn:
+            self.assertIs(ldap_conn, new_conn)
+        old_conn.unbind_s.assert_called_once_with()
+        self.assertIsNone(ldap1.rebind_stats())
+
+    def test_replica_set(self):
+        down = {'ldap2'}
+        def probe(host):
+            if (host in down):
+                raise ldap.SERVER_DOWN(host)
+
+        replicas = ReplicaSet(['ldap1', 'ldap2', 'ldap3'], probe=probe, failure_threshold=2)
+        self.assertEqual(replicas.choose(), 'ldap1')   # no round-trip times yet
+
+        replicas.record_success('ldap1', 0.050)
+        replicas.record_success('ldap3', 0.010)
+        replicas.record_success('ldap3', 0.020)
+        self.assertAlmostEqual(replicas.stats()['ldap3']['rtt_ms'], 13.0)
+        replicas.record_success('ldap2', 0.001)
+        self.assertEqual(replicas.choose(), 'ldap2')
+
+        # Two failures in a row take a host out of rotation until a probe works.
+        replicas.record_failure('ldap2')
+        self.assertEqual(replicas.choose(), 'ldap3')
+        replicas.record_failure('ldap2')
+        self.assertTrue(replicas.stats()['ldap2']['ejected'])
+        self.assertFalse(replicas.probe_host('ldap2'))
+        self.assertEqual(replicas.choose(), 'ldap3')
+        down.clear()
+        self.assertTrue(replicas.probe_host('ldap2'))
+        self.assertFalse(replicas.stats()['ldap2']['ejected'])
+        self.assertEqual(replicas.stats()['ldap2']['ejections'], 1)
+
+        class FakeConnection():
+            def __init__(self, host):
+                self.host = host
+
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None):
+                if (self.host in dead):
+                    raise ldap.SERVER_DOWN(self.host)
+                return 1
+
+            def result3(self, msgid, all=1, timeout=None):
+                if (not hasattr(self, 'sent')):
+                    self.sent = True
+                    return (ldap.RES_SEARCH_ENTRY, [(f"uid=jstanford,{BASEDN_PEOPLE}", {'uid': [b'jstanford']})], 1, [])
+                return (ldap.RES_SEARCH_RESULT, [], 1, [])
+
+        # A search on a dead replica is retried on the next one.
+        dead  = {'ldap1'}
+        ldap1 = LDAP(host=['ldap1', 'ldap2'], connect_on_init=False)
+        ldap1.connect = FakeConnection
+        results = ldap1.search(BASEDN_PEOPLE, filterstr='(uid=jstanford)')
+        self.assertEqual(list(results), [f"uid=jstanford,{BASEDN_PEOPLE}"])
+        self.assertEqual(ldap1.replica_stats()['ldap1']['failures'], 1)
+        self.assertEqual(ldap1.replica_stats()['ldap2']['failures'], 0)
+
+        # An operation that works resets the count of failures in a row.
+        dead.clear()
+        ldap1.replicas.record_failure('ldap2')
+        ldap1.replicas.record_failure('ldap2')
+        ldap1.search(BASEDN_PEOPLE, filterstr='(uid=jstanford)')
+        self.assertEqual(ldap1.replica_stats()['ldap1']['failures'], 0)
+        ldap1.replicas.record_failure('ldap1')
+        self.assertEqual(ldap1.replica_stats()['ldap1']['failures'], 1)
+        self.assertFalse(ldap1.replica_stats()['ldap1']['ejected'])
+
+        # Closing unbinds every replica connection, even if one is dead.
+        connections = {host: unittest.mock.Mock() for host in ('ldap1', 'ldap2')}
+        connections['ldap1'].unbind_s.side_effect = ldap.SERVER_DOWN('ldap1')
+        ldap1._replica_connections = dict(connections)
+        ldap1.close()
+        connections['ldap2'].unbind_s.assert_called_once_with()
+        self.assertEqual(ldap1._replica_connections, {})
+
+    def test_instrumentation(self):
+        stats = OperationStats('search', BASEDN_PEOPLE, '(uid=jstanford)', None, 'sub')
+        stats.add_entries([('uid=jstanford', {'uid': [b'jstanford']})], time.perf_counter())
+        stats.total_seconds = 0.2
+        self.assertEqual((stats.entries, stats.bytes), (1, 25))
+
+        metrics = PrometheusAggregator(buckets=(0.1, 1.0))
+        metrics(stats)
+        text = metrics.render()
+        self.assertIn('green_ldap_operations_total{operation="search",outcome="ok"} 1', text)
+        self.assertIn('green_ldap_unbounded_attrlist_total{operation="search"} 1', text)
+        self.assertIn('green_ldap_operation_seconds_bucket{operation="search",le="0.1"} 0', text)
+        self.assertIn('green_ldap_operation_seconds_bucket{operation="search",le="1"} 1', text)
+        self.assertIn('green_ldap_operation_seconds_count{operation="search"} 1', text)
+        self.assertIn('green_ldap_operation_seconds_sum{operation="search"} 0.2', text)
+
+        with self.assertLogs('stanford.green.ldap.instrument', level='WARNING') as logs:
+            SlowQueryLogger(threshold_seconds=0.1)(stats)
+            SlowQueryLogger(threshold_seconds=1.0)(stats)
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].ldap_stats['filterstr'], '(uid=jstanford)')
+
+        # Large counters and sums are written in full, not rounded.
+        metrics = PrometheusAggregator(buckets=(0.1, 1.0))
+        stats.entries       = 1234567
+        stats.total_seconds = 1234567.5
+        for _ in range(3):
+            metrics(stats)
+        text = metrics.render()
+        self.assertIn('green_ldap_entries_total{operation="search"} 3703701\n', text)
+        self.assertIn('green_ldap_operation_seconds_sum{operation="search"} 3703702.5\n', text)
+
+        # A subclass that binds some other way is still instrumented.
+        class PasswordLDAP(LDAP):
+            def _bind(self, ldap_conn, host):
+                ldap_conn.simple_bind_s('cn=admin', 'secret')
+            def _credential_expiry(self):
+                return None
+
+        ldap1 = PasswordLDAP(connect_on_init=False)
+        binds = []
+        ldap1.add_hook(binds.append)
+        with unittest.mock.patch('ldap.initialize') as initialize:
+            ldap1.connect('ldap.example.com')
+        initialize.assert_called_once_with('ldap://ldap.example.com')
+        initialize.return_value.simple_bind_s.assert_called_once_with('cn=admin', 'secret')
+        initialize.return_value.sasl_non_interactive_bind_s.assert_not_called()
+        self.assertEqual([stats.operation for stats in binds], ['bind'])
+        self.assertIsNone(binds[0].error)
+        self.assertIsNone(ldap1.credential_expiry)
+
+    def test_uid_filter_chunks(self):
+        self.assertEqual(uid_filter(['jstanford']), '(uid=jstanford)')
+        self.assertEqual(uid_filter(['jstanford', 'lstanford']), '(|(uid=jstanford)(uid=lstanford))')
+
+        # Filter values must be escaped.
+        self.assertEqual(uid_filter(['*']), r'(uid=\2a)')
+
+        sunetids = [f"user{i:04d}" for i in range(250)]
+        chunks = list(uid_filter_chunks(sunetids, 100, 8192))
+        self.assertEqual([len(chunk) for chunk in chunks], [100, 100, 50])
+        self.assertEqual(sum(chunks, []), sunetids)
+
+        # Limiting the filter length makes the chunks smaller.
+        for chunk in uid_filter_chunks(sunetids, 100, 200):
+            self.assertTrue(len(uid_filter(chunk)) <= 200)
+
+    def test_ldap_result_cache(self):
+        # Equivalent searches share a key.
+        self.assertEqual(
+            search_key('cn=people, dc=stanford,dc=edu', 'uid=jstanford', ['sn', 'uid'], 'subtree'),
+            search_key('CN=people,dc=stanford,dc=edu', '(uid=jstanford)', ['uid', 'SN', 'sn'], 'sub'),
+        )
+        self.assertNotEqual(
+            search_key(BASEDN_PEOPLE, 'uid=jstanford', None, 'sub'),
+            search_key(BASEDN_PEOPLE, 'uid=jstanford', ['uid'], 'sub'),
+        )
+
+        result_set = {'uid=jstanford,cn=accounts,dc=stanford,dc=edu': {'uid': 'jstanford', 'suMailDrop': ['a', 'b']}}
+        key1 = search_key(BASEDN_ACCOUNTS, 'uid=jstanford', None, 'sub')
+        key2 = search_key(BASEDN_ACCOUNTS, 'uid=lstanford', None, 'sub')
+        key3 = search_key(BASEDN_ACCOUNTS, 'uid=nosuchuser', None, 'sub')
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = LDAPResultCache(maxsize=1, ttl=60, directory=directory)
+            self.assertIsNone(cache.get(key1))
+
+            cache.set(key1, result_set)
+            cached = cache.get(key1)
+            self.assertEqual(cached, result_set)
+
+            # Callers get a copy, not the cached object.
+            cached['uid=jstanford,cn=accounts,dc=stanford,dc=edu']['suMailDrop'].append('c')
+            self.assertEqual(cache.get(key1), result_set)
+
+            # With maxsize 1 this evicts key1 from memory, but the disk
+            # tier still has it.
+            cache.set(key2, result_set)
+            self.assertEqual(cache.stats()['evictions'], 1)
+            self.assertEqual(cache.get(key1), result_set)
+            self.assertEqual(cache.stats()['disk_hits'], 1)
+
+            cache.set_no_results(key3)
+            self.assertIs(cache.get(key3), NO_RESULTS)
+            self.assertEqual(cache.stats()['negative_hits'], 1)
+
+            cache.disk_cache.close()
+
+        # Entries expire.
+        cache = LDAPResultCache(ttl=0.01)
+        cache.set(key1, result_set)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(key1))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_attribute_registry(self):
+        registry = AttributeRegistry(ATTRIBUTE_TO_MULTIPLICITY)
+
+        # Lookups are case-insensitive.
+        self.assertTrue(registry.is_single_valued('suSeasEmailSystem'))
+        self.assertTrue(registry.is_single_valued('SUSEASEMAILSYSTEM'))
+        self.assertFalse(registry.is_single_valued('suprivilegegroup'))
+        self.assertIsNone(registry.is_single_valued('noSuchAttribute'))
+
+        # Unknown attributes are decoded as multi-valued; objectClass is dropped.
+        plan = registry.decoding_plan(('objectClass', 'uid', 'noSuchAttribute'))
+        self.assertEqual(plan.text, (('uid', True),))
+        self.assertEqual(plan.unknown, (('noSuchAttribute', False),))
+
+        # Decoding never fails on an unknown attribute: values that are not
+        # UTF-8 stay as byte-strings, and ;binary values are never decoded.
+        ldap1 = LDAP(connect_on_init=False)
+        raw = {'uid': [b'a'], 'jpegPhoto': [b'\xff\xd8\xff\xe0'], 'suNote': [b'caf\xc3\xa9', b'\xff'],
+               'userCertificate;binary': [b'0\x82']}
+        expected = {'uid': 'a', 'jpegPhoto': [b'\xff\xd8\xff\xe0'], 'suNote': ['caf\u00e9', b'\xff'],
+                    'userCertificate;binary': [b'0\x82']}
+        self.assertEqual(ldap1.process_result(('uid=a,cn=accounts,dc=stanford,dc=edu', raw)),
+                         ('uid=a,cn=accounts,dc=stanford,dc=edu', expected))
+        compact = CompactResultSet(ldap1.registry)
+        compact.add('uid=a,cn=accounts,dc=stanford,dc=edu', raw)
+        self.assertEqual(compact.to_dict(), {'uid=a,cn=accounts,dc=stanford,dc=edu': expected})
+
+        # The plan memo is bounded.
+        for n in range(PLAN_CACHE_SIZE + 10):
+            registry.decoding_plan(('uid', f"attribute{n}"))
+        self.assertEqual(registry._plans.cache_info().currsize, PLAN_CACHE_SIZE)
+
+        # Server information fills in attributes the static tables do not
+        # know without overriding the ones they do.
+        registry.update({
+            'jpegPhoto':       {'single': False, 'syntax': '1.3.6.1.4.1.1466.115.121.1.28'},
+            'noSuchAttribute': {'single': True,  'syntax': None},
+            'mail':            {'single': False, 'syntax': None},
+        }, replace=False)
+        self.assertTrue(registry.is_single_valued('noSuchAttribute'))
+        self.assertTrue(registry.is_single_valued('mail'))
+        self.assertTrue(registry.is_binary('jpegphoto'))
+        plan = registry.decoding_plan(('uid', 'jpegPhoto'))
+        self.assertEqual(plan.binary, (('jpegPhoto', False),))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/schema.json"
+            registry.save(path)
+            loaded = AttributeRegistry({})
+            loaded.load(path)
+            self.assertEqual(len(loaded), len(registry))
+            self.assertTrue(loaded.is_binary('jpegPhoto'))
+
+    def test_decoding_plan(self):
+        registry = AttributeRegistry(ATTRIBUTE_TO_MULTIPLICITY)
+
+        # Single- and multi-valued attributes are marked as such, in the
+        # order given; objectClass is left out.
+        names = ('objectClass', 'uid', 'suPrivilegeGroup', 'displayName', 'suAffiliation')
+        plan  = registry.decoding_plan(names)
+        self.assertEqual(plan.text, (('uid', True), ('suPrivilegeGroup', False), ('displayName', True),
+                                     ('suAffiliation', False)))
+        self.assertEqual((plan.binary, plan.unknown), ((), ()))
+
+        # The plan is compiled once per tuple of names.
+        self.assertIs(registry.decoding_plan(names), plan)
+        self.assertIsNot(registry.decoding_plan(tuple(reversed(names))), plan)
+        info = registry._plans.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 2))
+
+        # Updating the registry discards the compiled plans.
+        registry.update({'suAffiliation': {'single': True, 'syntax': None}})
+        plan = registry.decoding_plan(names)
+        self.assertEqual(plan.text[-1], ('suAffiliation', True))
+
+        # Every entry with the same attributes is decoded with the same plan.
+        ldap1 = LDAP(connect_on_init=False)
+        for uid in ('jstanford', 'lstanford'):
+            (dn, attributes) = ldap1.process_result((f"uid={uid},{BASEDN_ACCOUNTS}", {
+                'objectClass':      [b'account'],
+                'uid':              [uid.encode()],
+                'suPrivilegeGroup': [b'stanford:staff', b'uit:all'],
+            }))
+            self.assertEqual(attributes, {'uid': uid, 'suPrivilegeGroup': ['stanford:staff', 'uit:all']})
+        info = ldap1.registry._plans.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+    def test_multiplicity_index(self):
+        index = MultiplicityIndex(ATTRIBUTE_TO_MULTIPLICITY)
+        self.assertEqual(len(index), len({name.lower() for name in ATTRIBUTE_TO_MULTIPLICITY}))
+
+        # Lookups are case-insensitive and never raise.
+        self.assertEqual(index.classify('suSeasEmailSystem'), 'single')
+        self.assertEqual(index.classify('SUSEASEMAILSYSTEM'), 'single')
+        self.assertEqual(index.classify('suprivilegegroup'), 'multi')
+        self.assertIsNone(index.classify('noSuchAttribute'))
+        self.assertNotIn('noSuchAttribute', index)
+
+        names = ['uid', 'SuPrivilegeGroup', 'noSuchAttribute', 'MAIL']
+        self.assertEqual(index.classify_all(names), ['single', 'multi', None, 'single'])
+        self.assertEqual(index.partition(names), (['uid', 'MAIL'], ['SuPrivilegeGroup'], ['noSuchAttribute']))
+
+        with self.assertRaises(AttributeError):
+            index.single = frozenset()
+
+        # The predicates are wrappers over the indexes and still raise on
+        # unknown names.
+        self.assertTrue(account_attribute_is_single_valued('SUSEASEMAILSYSTEM'))
+        self.assertTrue(people_attribute_is_multi_valued('suprivilegegroup'))
+        with self.assertRaises(GreenUnknownLDAPAttribute):
+            account_attribute_is_single_valued('noSuchAttribute')
+
+    def test_compact_result_set(self):
+        result_set = CompactResultSet(AttributeRegistry(ATTRIBUTE_TO_MULTIPLICITY))
+        for sunetid in ['jstanford', 'lstanford']:
+            result_set.add(f"uid={sunetid},cn=accounts,dc=stanford,dc=edu", {
+                'objectClass':      [b'top'],
+                'uid':              [sunetid.encode()],
+                'suPrivilegeGroup': [b'stanford:staff', b'uit:all'],
+            })
+        result_set.finish()
+
+        entry = result_set['uid=jstanford,cn=accounts,dc=stanford,dc=edu']
+        self.assertEqual(entry['uid'], 'jstanford')
+        self.assertEqual(entry['suPrivilegeGroup'], ['stanford:staff', 'uit:all'])
+        self.assertEqual(dict(entry), {'uid': 'jstanford', 'suPrivilegeGroup': ['stanford:staff', 'uit:all']})
+        self.assertNotIn('objectClass', entry)
+
+        # Both entries share one shape and one tuple of group values.
+        other = result_set['uid=lstanford,cn=accounts,dc=stanford,dc=edu']
+        self.assertIs(entry.raw('suPrivilegeGroup'), other.raw('suPrivilegeGroup'))
+        self.assertEqual(result_set.stats(), {'entries': 2, 'shapes': 1, 'values': 4})
+        self.assertEqual(len(result_set.to_dict()), 2)
+
+    def test_export_writers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jsonl_path = os.path.join(tmpdir, 'people.jsonl.gz')
+            writer = JSONLinesWriter(jsonl_path, compression='gzip')
+            writer.write('uid=jstanford,cn=accounts,dc=stanford,dc=edu',
+                         {'uid': 'jstanford', 'suPrivilegeGroup': ['stanford:staff', 'uit:all']})
+            writer.close()
+            with gzip.open(jsonl_path, 'rt') as fh:
+                record = json.loads(fh.readline())
+            self.assertEqual(record['dn'], 'uid=jstanford,cn=accounts,dc=stanford,dc=edu')
+            self.assertEqual(record['suPrivilegeGroup'], ['stanford:staff', 'uit:all'])
+
+            csv_path = os.path.join(tmpdir, 'people.csv')
+            writer = CSVWriter(csv_path, ['uid', 'suPrivilegeGroup', 'jpegPhoto'])
+            writer.write('uid=jstanford,cn=accounts,dc=stanford,dc=edu',
+                         {'uid': 'jstanford', 'suPrivilegeGroup': ['stanford:staff', 'uit:all'],
+                          'jpegPhoto': b'\xff\xd8'})
+            writer.close()
+            with open(csv_path, 'r', encoding='utf-8') as fh:
+                lines = fh.read().splitlines()
+            self.assertEqual(lines[0], 'dn,uid,suPrivilegeGroup,jpegPhoto')
+            self.assertEqual(lines[1], '"uid=jstanford,cn=accounts,dc=stanford,dc=edu",jstanford,stanford:staff|uit:all,/9g=')
+
+        # The compression is taken from the file name unless given.
+        class FakeConnection():
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None):
+                self.pending = [
+                    (ldap.RES_SEARCH_ENTRY, [(f"uid=jstanford,{basedn}", {'uid': [b'jstanford']})], 1, []),
+                    (ldap.RES_SEARCH_RESULT, [], 1, []),
+                ]
+                return 1
+
+            def result3(self, msgid, all=1, timeout=None):
+                return self.pending.pop(0)
+
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeConnection()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jsonl_path = os.path.join(tmpdir, 'accounts.jsonl.gz')
+            self.assertEqual(export(ldap1, jsonl_path, BASEDN_ACCOUNTS), 1)
+            with gzip.open(jsonl_path, 'rt') as fh:
+                self.assertEqual(json.loads(fh.readline())['uid'], 'jstanford')
+
+            csv_path = os.path.join(tmpdir, 'accounts.csv.xz')
+            self.assertEqual(export(ldap1, csv_path, BASEDN_ACCOUNTS, attrlist=['uid']), 1)
+            with lzma.open(csv_path, 'rt') as fh:
+                self.assertEqual(fh.read().splitlines()[1], f'"uid=jstanford,{BASEDN_ACCOUNTS}",jstanford')
+
+            with self.assertRaises(ValueError):
+                export(ldap1, jsonl_path, BASEDN_ACCOUNTS, compression='bz2')
+            with self.assertRaises(ValueError):
+                export(ldap1, os.path.join(tmpdir, 'accounts.parquet.gz'), BASEDN_ACCOUNTS, attrlist=['uid'])
+
+        with self.assertRaises(ValueError):
+            open_text('/dev/null', compression='zip')
+
+    def test_export_parquet(self):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            self.skipTest("Parquet export needs pyarrow")
+
+        class FakeConnection():
+            """Answers every search with the same two entries, attribute names as in the schema."""
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None):
+                self.pending = [
+                    (ldap.RES_SEARCH_ENTRY, [(f"uid=jstanford,{basedn}",
+                                              {'uid': [b'jstanford'], 'displayName': [b'Jane Stanford'],
+                                               'suPrivilegeGroup': [b'stanford:staff', b'uit:all']})], 1, []),
+                    (ldap.RES_SEARCH_ENTRY, [(f"uid=lstanford,{basedn}", {'uid': [b'lstanford']})], 1, []),
+                    (ldap.RES_SEARCH_RESULT, [], 1, []),
+                ]
+                return 1
+
+            def result3(self, msgid, all=1, timeout=None):
+                return self.pending.pop(0)
+
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeConnection()
+        # Not spelled as the server spells them.
+        attrlist = ['uid', 'displayname', 'suprivilegegroup']
+        expected = {
+            'dn':               [f"uid=jstanford,{BASEDN_ACCOUNTS}", f"uid=lstanford,{BASEDN_ACCOUNTS}"],
+            'uid':              ['jstanford', 'lstanford'],
+            'displayname':      ['Jane Stanford', None],
+            'suprivilegegroup': [['stanford:staff', 'uit:all'], None],
+        }
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'accounts.parquet')
+            self.assertEqual(export(ldap1, path, BASEDN_ACCOUNTS, attrlist=attrlist, batch_size=1), 2)
+            table = pyarrow.parquet.read_table(path)
+            self.assertEqual(table.to_pydict(), expected)
+            self.assertTrue(pyarrow.types.is_list(table.schema.field('suprivilegegroup').type))
+            self.assertEqual(pyarrow.parquet.ParquetFile(path).metadata.num_row_groups, 2)
+
+            path   = os.path.join(tmpdir, 'accounts-zstd.parquet')
+            writer = ParquetWriter(path, attrlist, {'suprivilegegroup'}, compression='zstd')
+            self.assertEqual(export_search(ldap1, writer, BASEDN_ACCOUNTS, attrlist=attrlist), 2)
+            self.assertEqual(pyarrow.parquet.read_table(path).to_pydict(), expected)
+
+            path = os.path.join(tmpdir, 'accounts.csv')
+            self.assertEqual(export(ldap1, path, BASEDN_ACCOUNTS, attrlist=attrlist), 2)
+            with open(path, 'r', encoding='utf-8') as fh:
+                lines = fh.read().splitlines()
+            self.assertEqual(lines[1], f'"uid=jstanford,{BASEDN_ACCOUNTS}",jstanford,Jane Stanford,stanford:staff|uit:all')
+
+            with self.assertRaises(ValueError):
+                export(ldap1, path, BASEDN_ACCOUNTS)
+
+    def test_directory_sync_poll(self):
+
+        class FakeConnection():
+            """Answers searches of a directory of uid -> modifyTimestamp, honouring modifyTimestamp>=."""
+            def __init__(self):
+                self.entries  = {}
+                self.searches = []
+
+            def search_ext(self, basedn, scope, filterstr=None, attrlist=None, serverctrls=None):
+                self.searches.append(filterstr)
+                match = re.search(r'\(modifyTimestamp>=(\w+)\)', filterstr)
+                since = match.group(1) if match else ''
+                self.pending = []
+                for (uid, timestamp) in sorted(self.entries.items()):
+                    if (timestamp < since):
+                        continue
+                    if (attrlist == ['1.1']):
+                        attributes = {}
+                    else:
+                        attributes = {'uid': [uid.encode()], 'modifyTimestamp': [timestamp.encode()]}
+                    self.pending.append((ldap.RES_SEARCH_ENTRY, [(f"uid={uid},{basedn}", attributes)], 1, []))
+                self.pending.append((ldap.RES_SEARCH_RESULT, [], 1, []))
+                return 1
+
+            def result3(self, msgid, all=1, timeout=None):
+                return self.pending.pop(0)
+
+        ldap1 = LDAP(connect_on_init=False)
+        ldap1.ldap = FakeConnection()
+        ldap1.ldap.entries = {'a': '20240101000000Z', 'b': '20240101000000Z'}
+
+        def run(sync):
+            return [(event.action, event.dn.split(',')[0], event.attributes) for event in sync.sync()]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_file = os.path.join(tmpdir, 'state.json')
+            sync = DirectorySync(ldap1, BASEDN_ACCOUNTS, state_file, attrlist=['uid'], method='poll')
+
+            # The first run reads everything and sets the high-water mark.
+            self.assertEqual(run(sync), [('add', 'uid=a', {'uid': 'a'}), ('add', 'uid=b', {'uid': 'b'})])
+            with open(state_file, 'r', encoding='utf-8') as fh:
+                state = json.load(fh)
+            self.assertEqual(state['high_water_mark'], '20240101000000Z')
+            self.assertEqual(state['seen_at_mark'], [f"uid=a,{BASEDN_ACCOUNTS}", f"uid=b,{BASEDN_ACCOUNTS}"])
+            self.assertTrue(sync.last_run['full'])
+
+            # The entries already seen at the mark are not reported again.
+            self.assertEqual(run(sync), [])
+            self.assertIn('(modifyTimestamp>=20240101000000Z)', ldap1.ldap.searches[-2])
+            self.assertFalse(sync.last_run['full'])
+
+            # A change in the same second as the mark, a later change, and a delete.
+            ldap1.ldap.entries['c'] = '20240101000000Z'
+            ldap1.ldap.entries['b'] = '20240101000005Z'
+            del ldap1.ldap.entries['a']
+            self.assertEqual(run(sync), [('modify', 'uid=b', {'uid': 'b'}), ('add', 'uid=c', {'uid': 'c'}),
+                                         ('delete', 'uid=a', None)])
+            self.assertEqual(ldap1.ldap.searches[-1], '(objectClass=*)')
+            with open(state_file, 'r', encoding='utf-8') as fh:
+                state = json.load(fh)
+            self.assertEqual(state['high_water_mark'], '20240101000005Z')
+            self.assertEqual(state['seen_at_mark'], [f"uid=b,{BASEDN_ACCOUNTS}"])
+            self.assertEqual(state['dns'], [f"uid=b,{BASEDN_ACCOUNTS}", f"uid=c,{BASEDN_ACCOUNTS}"])
+            self.assertEqual(sync.last_run['delete'], 1)
+
+        # The LDAP object's registry is left alone.
+        self.assertNotIn('modifyTimestamp', ldap1.registry)
+
+    def test_syncrepl_session_events(self):
+        ldap1   = LDAP(connect_on_init=False)
+        uuids   = {'uuid-1': 'uid=jstanford,cn=accounts,dc=stanford,dc=edu',
+                   'uuid-2': 'uid=lstanford,cn=accounts,dc=stanford,dc=edu',
+                   'uuid-3': 'uid=gone,cn=accounts,dc=stanford,dc=edu'}
+        session = _SyncreplSession(unittest.mock.Mock(), ldap1.process_result, 'cookie-1', uuids)
+
+        session.syncrepl_entry('uid=jstanford,cn=accounts,dc=stanford,dc=edu', {'uid': [b'jstanford']}, 'uuid-1')
+        session.syncrepl_entry('uid=lstanford2,cn=accounts,dc=stanford,dc=edu', {'uid': [b'lstanford2']}, 'uuid-2')
+        session.syncrepl_entry('uid=new,cn=accounts,dc=stanford,dc=edu', {'uid': [b'new']}, 'uuid-4')
+        session.syncrepl_present(['uuid-1', 'uuid-2', 'uuid-4'])
+        session.syncrepl_present(None, refreshDeletes=False)
+        session.syncrepl_set_cookie('cookie-2')
+
+        self.assertEqual([(event.action, event.dn.split(',')[0]) for event in session.events], [
+            ('modify', 'uid=jstanford'),
+            ('delete', 'uid=lstanford'),
+            ('add',    'uid=lstanford2'),
+            ('add',    'uid=new'),
+            ('delete', 'uid=gone'),
+        ])
+        self.assertEqual(session.events[0].attributes, {'uid': 'jstanford'})
+        self.assertEqual(sorted(session.uuids), ['uuid-1', 'uuid-2', 'uuid-4'])
+        self.assertEqual(session.syncrepl_get_cookie(), 'cookie-2')
+
+    def test_directory_mirror(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mirror = DirectoryMirror(os.path.join(tmpdir, 'directory.sqlite3'))
+            mirror.load_entries([
+                ('uid=jstanford,cn=accounts,dc=stanford,dc=edu',
+                 {'uid': 'jstanford', 'suPrivilegeGroup': ['stanford:staff', 'uit:all']}),
+                ('suRegID=f0d08565850320613717ebf068585447,cn=people,dc=stanford,dc=edu',
+                 {'uid': 'jstanford', 'mail': 'jstanford@stanford.edu'}),
+                ('uid=lstanford,cn=accounts,dc=stanford,dc=edu',
+                 {'uid': 'lstanford', 'suPrivilegeGroup': ['uit:all']}),
+            ], basedn='dc=stanford,dc=edu')
+
+            self.assertEqual(len(mirror.sunetid_info('JStanford')), 2)
+            self.assertEqual(mirror.sunetid_account_info('jstanford', attrlist=['uid']),
+                             {'uid=jstanford,cn=accounts,dc=stanford,dc=edu': {'uid': 'jstanford'}})
+            self.assertEqual(list(mirror.sunetid_people_info('jstanford').values())[0]['mail'],
+                             'jstanford@stanford.edu')
+            self.assertEqual(len(mirror.lookup('suPrivilegeGroup', 'uit:all')), 2)
+            self.assertEqual(len(mirror.lookup('mail', 'JSTANFORD@stanford.edu')), 1)
+
+            # Replacing the accounts tree removes the entries not reloaded.
+            mirror.load_entries([('uid=jstanford,cn=accounts,dc=stanford,dc=edu', {'uid': 'jstanford'})],
+                                basedn=BASEDN_ACCOUNTS, replace=True)
+            self.assertEqual(mirror.stats(), {'accounts': 1, 'people': 1, 'other': 0, 'indexed_values': 3})
+            with self.assertRaises(GreenLDAPNoResultsException):
+                mirror.sunetid_account_info('lstanford')
+            mirror.close()
+
 if __name__ == '__main__':
     unittest.main()